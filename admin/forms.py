@@ -0,0 +1,24 @@
+from flask_wtf import FlaskForm
+from wtforms import FloatField, StringField, SubmitField
+from wtforms.validators import NumberRange, Optional
+
+
+# Runs the lottery round of the current winning draw, posted so the CSRF token is checked
+class RunLotteryForm(FlaskForm):
+    submit = SubmitField('Run Lottery')
+
+
+# Resumes a lottery round whose worker stopped, posted so the CSRF token is checked
+class ResumeJobForm(FlaskForm):
+    submit = SubmitField('Resume Round')
+
+
+# Request profiling settings of every worker process: routes is a comma separated list of endpoints profiled on every
+# request, sample_rate the percentage of other requests profiled
+class ProfileSettingsForm(FlaskForm):
+    routes = StringField()
+    sample_rate = FloatField(validators=[
+        Optional(),
+        NumberRange(min=0, max=100, message='Sample rate must be a percentage from 0 to 100')
+    ])
+    submit = SubmitField('Save Profiling Settings')
@@ -0,0 +1,276 @@
+# IMPORTS
+import argparse
+import logging
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_, select, update
+
+from app import db, app
+from admin.settlement import settle_round
+from models import User, Draw, LotteryJob, decrypt, decrypt_many
+
+
+# Returns the job that is still settling the given master draw, if any
+def unfinished_job(master_draw_id=None):
+    query = LotteryJob.query.filter(LotteryJob.status.in_(('queued', 'running')))
+    if master_draw_id is not None:
+        query = query.filter_by(master_draw_id=master_draw_id)
+    return query.order_by(LotteryJob.id.desc()).first()
+
+
+# Raised in a worker whose lease on its job has been taken over, e.g. after it stalled for longer than the lease
+class LeaseLost(Exception):
+    pass
+
+
+# Heartbeats older than this belong to workers that stopped
+def lease_expiry():
+    return datetime.now() - timedelta(seconds=app.config['JOB_LEASE_SECONDS'])
+
+
+# Takes the lease of a stalled job for a new worker, with a conditional UPDATE: of two admins resuming the job at the
+# same time only one gets it. Returns False if the job is finished or its worker is still renewing the lease.
+def take_over(job_id):
+    taken = db.session.execute(
+        update(LotteryJob)
+        .where(LotteryJob.id == job_id,
+               LotteryJob.status.in_(('queued', 'running')),
+               or_(LotteryJob.heartbeat == None, LotteryJob.heartbeat < lease_expiry()))
+        .values(heartbeat=datetime.now(), pid=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return taken.rowcount == 1
+
+
+# Claims the job for this process: a lease handed over by create_job or take_over (no pid yet), or an expired one.
+# Returns False if another worker holds the job.
+def claim_job(job_id):
+    claimed = db.session.execute(
+        update(LotteryJob)
+        .where(LotteryJob.id == job_id,
+               LotteryJob.status.in_(('queued', 'running')),
+               or_(LotteryJob.pid == None, LotteryJob.heartbeat == None, LotteryJob.heartbeat < lease_expiry()))
+        .values(pid=os.getpid(), heartbeat=datetime.now(), status='running')
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return claimed.rowcount == 1
+
+
+# Creates a job settling every user draw entered so far against the master draw.
+# The master draw is claimed with a conditional UPDATE so two admins running the lottery at the same time cannot both
+# start a round. Returns None if there is nothing to settle or the draw was already claimed, in which case the master
+# draw is left expired and reads as played.
+def create_job(master_draw):
+    upto_draw_id, total_draws = db.session.execute(
+        select(func.max(Draw.id), func.count(Draw.id))
+        .where(Draw.master_draw == False, Draw.been_played == False)
+    ).one()
+
+    if not total_draws:
+        return None
+
+    claimed = db.session.execute(
+        update(Draw)
+        .where(Draw.id == master_draw.id, Draw.been_played == False)
+        .values(been_played=True)
+        .execution_options(synchronize_session=False)
+    )
+    if claimed.rowcount != 1:
+        db.session.rollback()
+        return None
+
+    job = LotteryJob(master_draw_id=master_draw.id,
+                     lottery_round=master_draw.lottery_round,
+                     upto_draw_id=upto_draw_id,
+                     total_draws=total_draws)
+    db.session.add(job)
+    db.session.commit()
+
+    return job
+
+
+# Starts a worker process running the job, the worker outlives the request that started it. The caller must hold the
+# job's lease (create_job or take_over), the worker claims it when it starts.
+def spawn_worker(job):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [app.root_path, env.get('PYTHONPATH')]))
+
+    process = subprocess.Popen([sys.executable, '-m', 'admin.jobs', '--job', str(job.id)],
+                               env=env,
+                               stdin=subprocess.DEVNULL,
+                               start_new_session=True)
+
+    logging.info('Lottery job %s started in worker process %s', job.id, process.pid)
+    return process
+
+
+# Settles the job in the current process. Safe to call again on a job whose worker crashed: every settled chunk is
+# already marked as played, so the round carries on with the draws that are left. Does nothing if another worker
+# holds the job's lease.
+def run_job(job_id):
+    if not claim_job(job_id):
+        return db.session.get(LotteryJob, job_id)
+
+    pid = os.getpid()
+    job = db.session.get(LotteryJob, job_id)
+    job.error = None
+    job.started_on = job.started_on or datetime.now()
+    db.session.commit()
+
+    try:
+        master_draw = db.session.get(Draw, job.master_draw_id)
+        if master_draw is None:
+            raise LookupError('Master draw %s no longer exists' % job.master_draw_id)
+
+        master = db.session.get(User, master_draw.user_id)
+        winning_numbers = decrypt(master_draw.numbers, master)
+
+        # record progress of every chunk and renew the lease in the chunk's own transaction, the chunk is rolled back if
+        # another worker has taken the job over
+        def progress(draws, winners, last_id):
+            renewed = db.session.execute(
+                update(LotteryJob)
+                .where(LotteryJob.id == job_id, LotteryJob.pid == pid)
+                .values(draws_processed=LotteryJob.draws_processed + draws,
+                        winners=LotteryJob.winners + winners,
+                        last_draw_id=last_id,
+                        heartbeat=datetime.now())
+                .execution_options(synchronize_session=False)
+            )
+            if renewed.rowcount != 1:
+                raise LeaseLost('Lottery job %s was taken over by another worker' % job_id)
+
+        settle_round(job.lottery_round, winning_numbers, upto_id=job.upto_draw_id, progress=progress)
+
+        db.session.expire(job)
+        job.status = 'finished'
+        job.finished_on = datetime.now()
+        db.session.commit()
+
+    except LeaseLost:
+        db.session.rollback()
+        logging.warning('Lottery job %s taken over by another worker, process %s stopped', job_id, pid)
+
+    except Exception as error:
+        db.session.rollback()
+        job.status = 'failed'
+        job.error = repr(error)
+        job.finished_on = datetime.now()
+        db.session.commit()
+        logging.exception('Lottery job %s failed', job_id)
+
+    return job
+
+
+# Restarts every job whose worker stopped renewing its lease, e.g. after a crash or a reboot
+def resume_jobs():
+    resumed = []
+    for job in LotteryJob.query.filter(LotteryJob.status.in_(('queued', 'running'))).all():
+        if take_over(job.id):
+            resumed.append(run_job(job.id))
+    return resumed
+
+
+# Winning draws of a job as (lottery round, numbers, user id, email), only the winners are decrypted
+def job_results(job):
+    winners = db.session.execute(
+        select(Draw.numbers, Draw.user_id, User.email, User.private_key, User.secret_key, User.data_key)
+        .join(User, User.id == Draw.user_id)
+        .where(Draw.master_draw == False,
+               Draw.matches_master == True,
+               Draw.lottery_round == job.lottery_round,
+               Draw.id <= job.upto_draw_id)
+        .order_by(Draw.id)
+    ).all()
+
+    numbers = decrypt_many((winner.numbers, (winner.private_key, winner.secret_key, winner.data_key))
+                           for winner in winners)
+
+    return [(job.lottery_round, winner_numbers, winner.user_id, winner.email)
+            for winner, winner_numbers in zip(winners, numbers)]
+
+
+# Prize tiers of a job from the highest match count down, as (match count, number of tickets, winners) where winners
+# holds the (numbers, user id, email) of at most RESULTS_PER_TIER tickets of the tier
+def job_tiers(job):
+    tier_counts = db.session.execute(
+        select(Draw.match_count, func.count(Draw.id))
+        .where(Draw.master_draw == False,
+               Draw.lottery_round == job.lottery_round,
+               Draw.match_count >= app.config['PRIZE_TIER_MIN'],
+               Draw.id <= job.upto_draw_id)
+        .group_by(Draw.match_count)
+        .order_by(Draw.match_count.desc())
+    ).all()
+
+    tiers = []
+    for match_count, total in tier_counts:
+        winners = db.session.execute(
+            select(Draw.numbers, Draw.user_id, User.email, User.private_key, User.secret_key, User.data_key)
+            .join(User, User.id == Draw.user_id)
+            .where(Draw.master_draw == False,
+                   Draw.lottery_round == job.lottery_round,
+                   Draw.match_count == match_count,
+                   Draw.id <= job.upto_draw_id)
+            .order_by(Draw.id)
+            .limit(app.config['RESULTS_PER_TIER'])
+        ).all()
+        numbers = decrypt_many((winner.numbers, (winner.private_key, winner.secret_key, winner.data_key))
+                               for winner in winners)
+
+        tiers.append((match_count, total, [(winner_numbers, winner.user_id, winner.email)
+                                           for winner, winner_numbers in zip(winners, numbers)]))
+    return tiers
+
+
+# Runs the current lottery round from the command line, resuming an unfinished round first
+def run_lottery_round():
+    with app.app_context():
+        current_winning_draw = Draw.query.filter_by(master_draw=True).order_by(Draw.id.desc()).first()
+        if current_winning_draw is None:
+            print('No winning draw exists. Please add new winning draw.')
+            return None
+
+        job = unfinished_job(current_winning_draw.id)
+        if job is None:
+            if current_winning_draw.been_played:
+                print('Current winning draw expired. Add new winning draw for next round.')
+                return None
+
+            job = create_job(current_winning_draw)
+            if job is None:
+                if current_winning_draw.been_played:
+                    print('A lottery round is already running.')
+                else:
+                    print('No user draws entered.')
+                return None
+
+        job = run_job(job.id)
+        print('Lottery round %s %s: %s draws, %s winners (%.0f draws/s)' % (job.lottery_round,
+                                                                           job.status,
+                                                                           job.draws_processed,
+                                                                           job.winners,
+                                                                           job.throughput))
+        return job
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run or resume lottery rounds outside of a web request.')
+    parser.add_argument('--job', type=int, help='run the given lottery job (used by the admin page)')
+    parser.add_argument('--resume', action='store_true', help='resume every job whose worker has stopped')
+    args = parser.parse_args()
+
+    if args.job is not None:
+        with app.app_context():
+            run_job(args.job)
+    elif args.resume:
+        with app.app_context():
+            for resumed_job in resume_jobs():
+                print('Lottery job %s %s' % (resumed_job.id, resumed_job.status))
+    else:
+        run_lottery_round()
@@ -0,0 +1,253 @@
+# IMPORTS
+import gzip
+import io
+import json
+import os
+import struct
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Security events and the message that identifies them, as logged by the users blueprint and required_roles
+EVENTS = {
+    'login': 'Log in',
+    'logout': 'Log out',
+    'invalid_login': 'Invalid login attempt',
+    'unauthorized': 'Unauthorized Access Attempt',
+    'registration': 'User registration',
+}
+
+# Event codes stored in the offset index, 0 is any other line
+EVENT_CODES = {event: code for code, event in enumerate(EVENTS, start=1)}
+EVENT_NAMES = {code: event for event, code in EVENT_CODES.items()}
+
+# Timestamp format of the text log format, see security_logging.py
+TIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+# Bytes read per step when reading a log backwards
+BLOCK_SIZE = 64 * 1024
+
+# Sidecar offset index next to every log file: a header (inode of the indexed file, bytes indexed so far) followed by
+# one fixed size record per entry (byte offset, unix time, event code), appended to as the log grows
+INDEX_SUFFIX = '.idx'
+INDEX_HEADER = struct.Struct('<QQ')
+INDEX_RECORD = np.dtype([('offset', '<u8'), ('time', '<i8'), ('event', 'u1')])
+
+LogEntry = namedtuple('LogEntry', ['time', 'event', 'line'])
+
+# A page of entries, newest first, and the cursor of the next (older) page, None on the last page
+LogPage = namedtuple('LogPage', ['entries', 'older'])
+
+
+# Splits a log line, in the text or the JSON lines format, into its time and event name (None if it isn't a security
+# event)
+def parse_line(line):
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+            time = datetime.fromisoformat(entry['time'])
+            if entry.get('event') in EVENTS:
+                return time, entry['event']
+            message = entry.get('message', '')
+        except (ValueError, KeyError, TypeError):
+            time, message = None, line
+    else:
+        timestamp, _, message = line.partition(' : ')
+        try:
+            time = datetime.strptime(timestamp, TIME_FORMAT)
+        except ValueError:
+            time = None
+
+    for event, text in EVENTS.items():
+        if message.startswith('SECURITY - ' + text):
+            return time, event
+    return time, None
+
+
+def to_entry(line):
+    line = line.decode('utf-8', 'replace').rstrip('\r\n')
+    return LogEntry(*parse_line(line), line)
+
+
+# The log file followed by its rotated files (lottery.log.1, lottery.log.2023-01-01.gz, ...), newest first
+def log_files(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    rotated = [os.path.join(directory, file) for file in os.listdir(directory)
+               if file.startswith(name + '.') and not file.endswith(INDEX_SUFFIX)]
+    rotated.sort(key=lambda file: os.path.getmtime(file), reverse=True)
+    return [os.path.abspath(path)] + rotated
+
+
+# Opens a log file for reading, rotated files compressed with gzip are decompressed into memory since they can't be
+# read backwards. Offsets of compressed files are offsets in the decompressed contents.
+def open_log(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return io.BytesIO(f.read())
+    return open(path, 'rb')
+
+
+def log_size(f):
+    return f.seek(0, os.SEEK_END)
+
+
+# Yields (offset, line) for every line of a file that starts before end, from the last one backwards.
+# Only reads as many blocks from the end as the lines taken need.
+def reverse_lines(f, end):
+    position = end
+    buffer = b''
+    while True:
+        stop = len(buffer)
+        newline = buffer.rfind(b'\n', 0, stop)
+        while newline != -1:
+            if newline + 1 < stop:
+                yield position + newline + 1, buffer[newline + 1:stop]
+            stop = newline
+            newline = buffer.rfind(b'\n', 0, stop)
+        buffer = buffer[:stop]
+
+        if position == 0:
+            if buffer:
+                yield 0, buffer
+            return
+
+        size = min(BLOCK_SIZE, position)
+        position -= size
+        f.seek(position)
+        buffer = f.read(size) + buffer
+
+
+# Offset index of a log file, brought up to date with the lines appended since it was last read.
+# The records are memory-mapped, so only the pages a query touches are read.
+def load_index(path):
+    index_path = path + INDEX_SUFFIX
+    status = os.stat(path)
+    # compressed files are rotated files, which never change once written
+    compressed = path.endswith('.gz')
+
+    with os.fdopen(os.open(index_path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as index:
+        if fcntl:
+            fcntl.flock(index, fcntl.LOCK_EX)
+
+        header = index.read(INDEX_HEADER.size)
+        inode, indexed = INDEX_HEADER.unpack(header) if len(header) == INDEX_HEADER.size else (None, 0)
+
+        # new index, or the file was rotated away or truncated since: start over
+        stale = inode != status.st_ino or (not compressed and indexed > status.st_size)
+        if stale:
+            index.seek(0)
+            index.truncate(0)
+            index.write(INDEX_HEADER.pack(status.st_ino, 0))
+            indexed = 0
+
+        if stale or (not compressed and indexed < status.st_size):
+            records = []
+            with open_log(path) as f:
+                f.seek(indexed)
+                for line in f:
+                    # leave a line that is still being written for the next update
+                    if not line.endswith(b'\n'):
+                        break
+                    time, event = parse_line(line.decode('utf-8', 'replace'))
+                    records.append((indexed, int(time.timestamp()) if time else 0, EVENT_CODES.get(event, 0)))
+                    indexed += len(line)
+
+            index.seek(0, os.SEEK_END)
+            index.write(np.array(records, dtype=INDEX_RECORD).tobytes())
+            index.seek(0)
+            index.write(INDEX_HEADER.pack(status.st_ino, indexed))
+
+        index.seek(0, os.SEEK_END)
+        if index.tell() == INDEX_HEADER.size:
+            return np.zeros(0, dtype=INDEX_RECORD)
+
+    return np.memmap(index_path, dtype=INDEX_RECORD, mode='r', offset=INDEX_HEADER.size)
+
+
+def read_line(f, offset):
+    f.seek(offset)
+    return f.readline()
+
+
+class LogReader:
+    # path: the log file written by the app, rotated files next to it are read as well
+    def __init__(self, path):
+        self.path = path
+
+    def files(self):
+        return [file for file in log_files(self.path) if os.path.exists(file)]
+
+    # Cursor of the page of entries older than the one at offset
+    @staticmethod
+    def cursor(file, offset):
+        return '%s:%s' % (os.path.basename(file), offset)
+
+    # Returns the files to read, newest first, and the offset to read the first of them up to
+    def start(self, files, before):
+        if not before:
+            return files, None
+
+        name, _, offset = before.rpartition(':')
+        names = [os.path.basename(file) for file in files]
+        if name not in names or not offset.isdigit():
+            raise ValueError('Invalid log cursor %r' % before)
+        return files[names.index(name):], int(offset)
+
+    # Returns a page of the newest count entries older than the before cursor.
+    # events: only entries of these event types, since/until: only entries logged in this time range (datetimes)
+    def page(self, count=10, before=None, events=None, since=None, until=None):
+        files, end = self.start(self.files(), before)
+
+        if events or since or until:
+            return self.filtered_page(files, end, count, events, since, until)
+
+        entries = []
+        last = None
+        for file in files:
+            with open_log(file) as f:
+                for offset, line in reverse_lines(f, log_size(f) if end is None else end):
+                    if len(entries) == count:
+                        return LogPage(entries, self.cursor(*last))
+                    entries.append(to_entry(line))
+                    last = file, offset
+            end = None
+
+        return LogPage(entries, None)
+
+    # Filters through the offset index, only the matching lines are read from the log
+    def filtered_page(self, files, end, count, events, since, until):
+        codes = [EVENT_CODES[event] for event in events or ()]
+        entries = []
+        last = None
+
+        for file in files:
+            records = load_index(file)
+
+            # entries are appended in time order, so the time range is a slice of the index
+            stop = len(records) if end is None else np.searchsorted(records['offset'], end, 'left')
+            if until:
+                stop = min(stop, np.searchsorted(records['time'], until.timestamp(), 'right'))
+            first = np.searchsorted(records['time'], since.timestamp(), 'left') if since else 0
+
+            window = records[first:stop]
+            positions = np.nonzero(np.isin(window['event'], codes))[0] if codes else np.arange(len(window))
+
+            with open_log(file) as f:
+                for position in positions[::-1]:
+                    if len(entries) == count:
+                        return LogPage(entries, self.cursor(*last))
+                    last = file, int(window['offset'][position])
+                    entries.append(to_entry(read_line(f, last[1])))
+
+            # older files are entirely before the time range
+            if first > 0:
+                break
+            end = None
+
+        return LogPage(entries, None)
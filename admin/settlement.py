@@ -0,0 +1,203 @@
+# IMPORTS
+import logging
+import time
+
+import numpy as np
+from sqlalchemy import select, update
+
+from app import db, app
+from lottery import draw_index
+from lottery.matching import BALLS, to_masks, match_counts
+from models import User, Draw, decrypt_many, index_key, index_prefix
+
+
+class SettlementResult:
+    def __init__(self, lottery_round):
+        self.lottery_round = lottery_round
+        # (lottery round, numbers, user id, email) for every winning draw, same shape the admin page renders
+        self.results = []
+        # number of tickets per prize tier (match count) settled in this run
+        self.tiers = {}
+        self.processed = 0
+        self.chunks = 0
+        self.elapsed = 0.0
+        # time spent parsing decrypted numbers into masks, and on vectorized matching alone
+        self.parsing_elapsed = 0.0
+        self.matching_elapsed = 0.0
+
+    # Draws settled per second, used to size lottery rounds
+    @property
+    def throughput(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.processed / self.elapsed
+
+
+# Restricts a query to the unplayed user draws taking part in the round
+def unplayed(query, upto_id=None):
+    query = query.where(Draw.master_draw == False, Draw.been_played == False)
+    if upto_id is not None:
+        query = query.where(Draw.id <= upto_id)
+    return query
+
+
+# Returns the id, owner, numbers and index key of the next chunk of unplayed user draws after last_id
+def next_chunk(last_id, chunk_size, upto_id=None):
+    return db.session.execute(
+        unplayed(select(Draw.id, Draw.user_id, Draw.numbers, Draw.numbers_key), upto_id)
+        .where(Draw.id > last_id)
+        .order_by(Draw.id)
+        .limit(chunk_size)
+    ).all()
+
+
+# Finds every indexed winning draw with one equality query on the index key, returned as {draw id: (user id, email)}
+def indexed_winners(winning_key, upto_id=None):
+    if winning_key is None:
+        return {}
+
+    winners = db.session.execute(
+        unplayed(select(Draw.id, Draw.user_id, User.email).join(User, User.id == Draw.user_id), upto_id)
+        .where(Draw.numbers_key == winning_key)
+    ).all()
+
+    return {winner.id: (winner.user_id, winner.email) for winner in winners}
+
+
+# Loads the email and stored keys of every user owning a draw in the chunk with a single query
+def load_owners(chunk):
+    owner_ids = {draw.user_id for draw in chunk}
+    owners = db.session.execute(
+        select(User.id, User.email, User.private_key, User.secret_key, User.data_key).where(User.id.in_(owner_ids))
+    ).all()
+
+    return {owner.id: (owner.email, (owner.private_key, owner.secret_key, owner.data_key)) for owner in owners}
+
+
+# Settles every unplayed user draw against the winning numbers of the master draw.
+# Draws are streamed in chunks ordered by id. The numbers of every draw in a chunk are packed into a NumPy array of
+# bitmasks, read straight from bitmask index keys or decrypted (in parallel) otherwise, and the match count of the whole
+# chunk against the winning mask comes from one vectorized popcount. With prize tiers off (PRIZE_TIER_MIN above 6) draws
+# with an HMAC index key aren't decrypted at all, their jackpot winners come from a single indexed query up front.
+# Every chunk is written back with bulk UPDATEs (one per match count, then every draw in the chunk) and one commit.
+# Only draws with an id up to upto_id are settled when it is given. progress(draws, winners, last_id) is called before
+# every commit so callers can record their progress in the same transaction as the chunk.
+def settle_round(lottery_round, winning_numbers, chunk_size=None, upto_id=None, progress=None):
+    chunk_size = chunk_size or app.config['SETTLEMENT_CHUNK_SIZE']
+    tier_min = app.config['PRIZE_TIER_MIN']
+    settlement = SettlementResult(lottery_round)
+    started = time.perf_counter()
+    last_id = 0
+
+    prefix = index_prefix()
+    bitmask_prefix = draw_index.PREFIXES['bitmask']
+    winning_mask = draw_index.to_mask(winning_numbers)
+    winners = indexed_winners(index_key(winning_numbers), upto_id)
+
+    while True:
+        chunk = next_chunk(last_id, chunk_size, upto_id)
+        if not chunk:
+            break
+
+        # split the chunk into draws whose mask is in their index key, draws that have to be decrypted, and (without
+        # prize tiers) draws whose current HMAC index key is enough to tell whether they won
+        keyed = []
+        encrypted = []
+        for draw in chunk:
+            key = draw.numbers_key or ''
+            if prefix == bitmask_prefix and key.startswith(bitmask_prefix):
+                keyed.append(draw)
+            elif tier_min <= BALLS or prefix is None or not key.startswith(prefix):
+                encrypted.append(draw)
+
+        owners = {}
+        encrypted_numbers = []
+        if encrypted:
+            owners = load_owners(encrypted)
+            encrypted_numbers = decrypt_many((draw.numbers, owners[draw.user_id][1]) for draw in encrypted)
+
+        parsing_started = time.perf_counter()
+        masked = keyed + encrypted
+        masks = np.concatenate((np.array([draw_index.mask_of(draw.numbers_key) for draw in keyed], dtype=np.uint64),
+                                to_masks(encrypted_numbers)))
+        matching_started = time.perf_counter()
+        settlement.parsing_elapsed += matching_started - parsing_started
+        counts = match_counts(masks, winning_mask)
+        settlement.matching_elapsed += time.perf_counter() - matching_started
+
+        # draw ids per match count, the jackpot tier also covers winners only known through their HMAC index key
+        masked_ids = {draw.id for draw in masked}
+        by_count = {}
+        jackpot = []
+        for draw, count in zip(masked, counts.tolist()):
+            by_count.setdefault(count, []).append(draw.id)
+            if count == BALLS:
+                jackpot.append(draw)
+        jackpot += [draw for draw in chunk if draw.id in winners and draw.id not in masked_ids]
+        by_count[BALLS] = [draw.id for draw in jackpot]
+
+        unknown_owners = [draw for draw in jackpot if draw.id not in winners and draw.user_id not in owners]
+        if unknown_owners:
+            owners.update(load_owners(unknown_owners))
+        for draw in jackpot:
+            email = winners[draw.id][1] if draw.id in winners else owners[draw.user_id][0]
+            settlement.results.append((settlement.lottery_round, winning_numbers, draw.user_id, email))
+
+        for count, draw_ids in by_count.items():
+            if count >= tier_min and draw_ids:
+                settlement.tiers[count] = settlement.tiers.get(count, 0) + len(draw_ids)
+        winner_ids = by_count[BALLS]
+
+        # store the match count of every draw
+        for count, draw_ids in by_count.items():
+            if draw_ids:
+                db.session.execute(
+                    update(Draw)
+                    .where(Draw.id.in_(draw_ids))
+                    .values(match_count=count)
+                    .execution_options(synchronize_session=False)
+                )
+
+        # update winning draws (this will be used to highlight winning draws in the user's lottery page)
+        if winner_ids:
+            db.session.execute(
+                update(Draw)
+                .where(Draw.id.in_(winner_ids))
+                .values(matches_master=True)
+                .execution_options(synchronize_session=False)
+            )
+
+        # update every draw of the chunk as played in the current lottery round, draws are only ever inserted with a
+        # larger id so the id range covers exactly the rows of this chunk
+        db.session.execute(
+            update(Draw)
+            .where(Draw.master_draw == False,
+                   Draw.been_played == False,
+                   Draw.id > last_id,
+                   Draw.id <= chunk[-1].id)
+            .values(been_played=True, lottery_round=settlement.lottery_round)
+            .execution_options(synchronize_session=False)
+        )
+
+        if progress:
+            progress(len(chunk), len(winner_ids), chunk[-1].id)
+        db.session.commit()
+
+        last_id = chunk[-1].id
+        settlement.processed += len(chunk)
+        settlement.chunks += 1
+
+    settlement.elapsed = time.perf_counter() - started
+
+    logging.info('Lottery round %s settled: %s draws in %s chunks, %.2fs (%.0f draws/s, %.3fs parsing, %.3fs matching), '
+                 'tiers %s',
+                 settlement.lottery_round,
+                 settlement.processed,
+                 settlement.chunks,
+                 settlement.elapsed,
+                 settlement.throughput,
+                 settlement.parsing_elapsed,
+                 settlement.matching_elapsed,
+                 settlement.tiers)
+
+    return settlement
@@ -0,0 +1,125 @@
+# IMPORTS
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import select, tuple_
+
+from app import db
+from models import User
+
+# Orders the player listings can be sorted in, newest or highest first. Players that never logged in come last.
+SORTS = {'registered_on': User.registered_on,
+         # most recent login
+         'last_login': User.current_login,
+         'total_logins': User.total_logins}
+
+SORT_LABELS = {'registered_on': 'Registration date',
+               'last_login': 'Last login',
+               'total_logins': 'Total logins'}
+
+# Columns of the export, the password, PIN key and encryption keys are left out
+EXPORT_COLUMNS = [User.id, User.email, User.firstname, User.lastname, User.phone, User.role, User.date_of_birth,
+                  User.postcode, User.registered_on, User.current_login, User.last_login, User.current_ip,
+                  User.last_ip, User.total_logins]
+
+# Rows fetched from the database cursor at a time while exporting
+EXPORT_BATCH_SIZE = 1000
+
+# A page of players and the cursor of the next page, None on the last page
+UserPage = namedtuple('UserPage', ['users', 'next'])
+
+
+# Players (role 'user'), optionally only those whose email starts with email_prefix. The prefix is matched as a range
+# of the unique email index rather than with LIKE, which SQLite can't serve from that index.
+def players(email_prefix=None):
+    query = select(User).where(User.role == 'user')
+    if email_prefix:
+        upper = email_prefix[:-1] + chr(ord(email_prefix[-1]) + 1)
+        query = query.where(User.email >= email_prefix, User.email < upper)
+    return query
+
+
+# The cursor is the sort value and id of the last player shown, the sort value is empty for players without one
+def encode_cursor(sort, user):
+    value = getattr(user, sort.key)
+    if value is None:
+        value = ''
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    return '%s:%s' % (user.id, value)
+
+
+def decode_cursor(sort, cursor):
+    user_id, value = cursor.split(':', 1)
+    if value == '':
+        return int(user_id), None
+    if sort is User.total_logins:
+        return int(user_id), int(value)
+    return int(user_id), datetime.fromisoformat(value)
+
+
+# Returns the count players after the cursor in the given sort order, newest/highest first and ties by id. Every page
+# is read from the (role, sort column, id) index starting at the cursor, so later pages cost the same as the first.
+# Raises ValueError for a malformed cursor.
+def user_page(sort='registered_on', count=50, after=None, email_prefix=None):
+    column = SORTS[sort]
+    query = players(email_prefix)
+
+    after_id, after_value = decode_cursor(column, after) if after else (None, None)
+
+    users = []
+    # players with a sort value, then the ones without, as NULL sorts differently on every database
+    if after is None or after_value is not None:
+        with_value = query.where(column.is_not(None))
+        if after is not None:
+            with_value = with_value.where(tuple_(column, User.id) < (after_value, after_id))
+        users = db.session.scalars(with_value.order_by(column.desc(), User.id.desc()).limit(count + 1)).all()
+
+    if len(users) <= count:
+        without_value = query.where(column.is_(None))
+        if after is not None and after_value is None:
+            without_value = without_value.where(User.id < after_id)
+        users += db.session.scalars(without_value.order_by(User.id.desc()).limit(count + 1 - len(users))).all()
+
+    if len(users) > count:
+        return UserPage(users[:count], encode_cursor(column, users[count - 1]))
+    return UserPage(users, None)
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+# Yields every matching player as export rows, EXPORT_BATCH_SIZE at a time from a server side cursor, so the full list
+# is never held in memory
+def export_rows(email_prefix=None):
+    query = players(email_prefix).with_only_columns(*EXPORT_COLUMNS).order_by(User.id)
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for row in result:
+        yield [export_value(value) for value in row]
+
+
+# Players as CSV, one chunk of text per row after the header
+def export_csv(email_prefix=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow([column.key for column in EXPORT_COLUMNS])
+    for row in export_rows(email_prefix):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Players as JSON lines, one object per line
+def export_jsonl(email_prefix=None):
+    keys = [column.key for column in EXPORT_COLUMNS]
+    for row in export_rows(email_prefix):
+        yield json.dumps(dict(zip(keys, row))) + '\n'
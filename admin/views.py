@@ -1,15 +1,38 @@
 # IMPORTS
-import random
-from flask import Blueprint, render_template, flash, redirect, url_for
+from datetime import datetime
+from flask import Blueprint, render_template, flash, redirect, url_for, jsonify, request, Response, stream_with_context
 from flask_login import current_user
 from sqlalchemy.orm import make_transient
 
-from app import db, required_roles
-from models import User, Draw
+from app import db, app, required_roles, query_profiler, metrics, request_profiler
+from database import read_only
+from admin.forms import ResumeJobForm, RunLotteryForm, ProfileSettingsForm
+from admin.jobs import create_job, spawn_worker, take_over, unfinished_job, job_results, job_tiers
+from admin.log_reader import LogReader, EVENTS
+from admin.user_listing import SORTS, SORT_LABELS, user_page, export_csv, export_jsonl
+from lottery.quick_pick import quick_picks, format_draws
+from security_events import events_per_minute, top_offenders, login_ratio
+from users.rate_limit import login_limiter
+from users.identity_cache import identity_cache
+from models import User, Draw, LotteryJob, key_cache, key_pool, crypto_executor
 
 # CONFIG
 admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
 
+# Security log written by the app, rotated files included
+log_reader = LogReader(app.config['LOG_FILE'])
+
+
+# Parses a time filter from the logs form, None if it is empty or invalid
+def parse_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        flash('Invalid time %s, filter ignored.' % value)
+        return None
+
 
 # VIEWS
 # view admin homepage
@@ -24,6 +47,11 @@ def admin():
 @required_roles('admin')
 def generate_winning_draw():
 
+    # the current winning draw cannot be replaced while its round is still being settled
+    if unfinished_job():
+        flash("Current lottery round is still running.")
+        return redirect(url_for('admin.admin'))
+
     # get current winning draw
     current_winning_draw = Draw.query.filter_by(master_draw=True).first()
     lottery_round = 1
@@ -37,26 +65,15 @@ def generate_winning_draw():
         db.session.delete(current_winning_draw)
         db.session.commit()
 
-    # get new winning numbers for draw
-    winning_numbers = random.sample(range(1, 60), 6)
-    winning_numbers.sort()
-    winning_numbers_string = ''
-    for i in range(6):
-        winning_numbers_string += str(winning_numbers[i]) + ' '
-    winning_numbers_string = winning_numbers_string[:-1]
-
-    # # create a new draw object with symmetric encryption.
-    # new_winning_draw = Draw(user_id=current_user.id,
-    #                         numbers=winning_numbers_string,
-    #                         master_draw=True,
-    #                         lottery_round=lottery_round,
-    #                         secret_key=current_user.secret_key)
-    # create a new draw object with asymmetric encryption.
+    # get new winning numbers for draw, from the server side quick pick generator (any of 1 to 60)
+    winning_numbers_string = format_draws(quick_picks(1))[0]
+
+    # create a new draw object, encrypted with the configured cipher.
     new_winning_draw = Draw(user_id=current_user.id,
                             numbers=winning_numbers_string,
                             master_draw=True,
                             lottery_round=lottery_round,
-                            secret_key=current_user.public_key)
+                            keys=current_user)
 
     # add the new winning draw to the database
     db.session.add(new_winning_draw)
@@ -81,11 +98,7 @@ def view_winning_draw():
         # Disconnect the draw from the database and decrypt it
         make_transient(current_winning_draw)
 
-        # # Symmetric encryption
-        # current_winning_draw.view_draw(current_user.secret_key)
-
-        # Asymmetric encryption
-        current_winning_draw.view_draw(current_user.private_key)
+        current_winning_draw.view_draw(current_user)
 
         # re-render admin page with current winning draw and lottery round
         return render_template('admin/admin.html', winning_draw=current_winning_draw, name=current_user.firstname)
@@ -95,109 +108,321 @@ def view_winning_draw():
     return redirect(url_for('admin.admin'))
 
 
-# view lottery results and winners
-@admin_blueprint.route('/run_lottery')
+# run the lottery round in a background worker
+@admin_blueprint.route('/run_lottery', methods=['POST'])
 @required_roles('admin')
 def run_lottery():
 
+    if not RunLotteryForm().validate_on_submit():
+        flash("Lottery round could not be run, please try again.")
+        return redirect(url_for('admin.admin'))
+
     # get current unplayed winning draw
     current_winning_draw = Draw.query.filter_by(master_draw=True, been_played=False).first()
 
     # if current unplayed winning draw exists
     if current_winning_draw:
 
-        # get all unplayed user draws
-        user_draws = Draw.query.filter_by(master_draw=False, been_played=False).all()
-        results = []
+        # create a job for every unplayed user draw and hand it to a worker process
+        job = create_job(current_winning_draw)
 
         # if at least one unplayed user draw exists
-        if user_draws:
+        if job:
+            spawn_worker(job)
+            return redirect(url_for('admin.lottery_job', job_id=job.id))
+
+        # the winning draw was claimed by another admin running the lottery at the same time
+        if current_winning_draw.been_played:
+            flash("A lottery round is already running.")
+            job = unfinished_job()
+            if job:
+                return redirect(url_for('admin.lottery_job', job_id=job.id))
+            return redirect(url_for('admin.admin'))
 
-            # update current winning draw as played
-            current_winning_draw.been_played = True
-            db.session.add(current_winning_draw)
-            db.session.commit()
+        flash("No user draws entered.")
+        return admin()
 
-            # # Decrypt the winning draw - symmetric
-            # current_winning_draw.view_draw(current_user.secret_key)
-            # Decrypt - asymmetric
-            current_winning_draw.view_draw(current_user.private_key)
+    # if the round is still being settled show its progress instead
+    job = unfinished_job()
+    if job:
+        return redirect(url_for('admin.lottery_job', job_id=job.id))
 
-            # for each unplayed user draw
-            for draw in user_draws:
+    # if current unplayed winning draw does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
+    return redirect(url_for('admin.admin'))
 
-                # Decrypt the players draw
-                player = User.query.filter_by(id=draw.user_id).first()
 
-                # # Symmetric encryption
-                # draw.view_draw(player.secret_key)
-                # Asymmetric encryption
-                draw.view_draw(player.private_key)
+# view progress of a lottery round, and its winners once it has finished
+@admin_blueprint.route('/lottery_job/<int:job_id>')
+@required_roles('admin')
+def lottery_job(job_id):
+    job = db.get_or_404(LotteryJob, job_id)
 
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
+    results = None
+    tiers = None
+    if job.status == 'finished':
+        results = job_results(job)
+        tiers = job_tiers(job)
 
-                # if user draw matches current unplayed winning draw
-                if draw.numbers == current_winning_draw.numbers:
+        # if no winners
+        if len(results) == 0:
+            flash("No winners.")
+    elif job.status == 'failed':
+        flash("Lottery round %s failed: %s" % (job.lottery_round, job.error))
 
-                    # add details of winner to list of results
-                    results.append((current_winning_draw.lottery_round, draw.numbers, draw.user_id, user.email))
+    return render_template('admin/admin.html',
+                           lottery_job=job,
+                           resume_form=ResumeJobForm() if job.is_stalled else None,
+                           results=results,
+                           tiers=tiers,
+                           name=current_user.firstname)
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    draw.matches_master = True
 
-                # update draw as played
-                draw.been_played = True
+# restart the worker of a lottery round that stopped before finishing it. Only the admin whose request takes over the
+# expired lease starts a worker, the others are sent back to the progress page.
+@admin_blueprint.route('/lottery_job/<int:job_id>/resume', methods=['POST'])
+@required_roles('admin')
+def resume_lottery_job(job_id):
+    job = db.get_or_404(LotteryJob, job_id)
 
-                # update draw with current lottery round
-                draw.lottery_round = current_winning_draw.lottery_round
+    if ResumeJobForm().validate_on_submit() and take_over(job.id):
+        spawn_worker(job)
+    else:
+        flash("Lottery round %s is already being settled." % job.lottery_round)
 
-                # commit draw changes to DB
-                db.session.add(draw)
-                db.session.commit()
+    return redirect(url_for('admin.lottery_job', job_id=job.id))
 
-            # if no winners
-            if len(results) == 0:
-                flash("No winners.")
 
-            return render_template('admin/admin.html', results=results, name=current_user.firstname)
+# progress of a lottery round, polled by the admin page
+@admin_blueprint.route('/lottery_job_status/<int:job_id>')
+@required_roles('admin')
+def lottery_job_status(job_id):
+    job = db.get_or_404(LotteryJob, job_id)
+    return jsonify(job.to_dict())
 
-        flash("No user draws entered.")
-        return admin()
 
-    # if current unplayed winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
-    return redirect(url_for('admin.admin'))
+# Renders a page of players for one of the user tables, sorted, searched by email prefix and paginated by the
+# sort, email and after args
+def user_listing(table, endpoint):
+    sort = request.args.get('sort')
+    if sort not in SORTS:
+        sort = 'registered_on'
+    email = request.args.get('email', '').strip()
+
+    try:
+        page = user_page(sort, app.config['USER_PAGE_SIZE'], request.args.get('after'), email)
+    except ValueError:
+        flash('User page no longer exists, showing the first page.')
+        page = user_page(sort, app.config['USER_PAGE_SIZE'], None, email)
+
+    next_users = None
+    if page.next:
+        next_users = url_for(endpoint, sort=sort, email=email or None, after=page.next)
+
+    if not page.users:
+        flash('No users found.')
+
+    return render_template('admin/admin.html',
+                           name=current_user.firstname,
+                           user_sorts=SORT_LABELS,
+                           user_filter=request.args,
+                           next_users=next_users,
+                           **{table: page.users})
 
 
 # view all registered users
 @admin_blueprint.route('/view_all_users')
 @required_roles('admin')
+@read_only
 def view_all_users():
-    current_users = User.query.filter_by(role='user').all()
-
-    return render_template('admin/admin.html',
-                           name=current_user.firstname,
-                           current_users=current_users)
+    return user_listing('current_users', 'admin.view_all_users')
 
 
 # View user activity
 @admin_blueprint.route('/view_user_activity')
 @required_roles('admin')
+@read_only
 def view_user_activity():
-    current_users = User.query.filter_by(role='user').all()
+    return user_listing('users_activity', 'admin.view_user_activity')
 
-    return render_template('admin/admin.html',
-                           name=current_user.firstname,
-                           users_activity=current_users)
 
-# view last 10 log entries
+# download every registered user as CSV or JSON lines, streamed as rows are read from the database
+@admin_blueprint.route('/export_users')
+@required_roles('admin')
+@read_only
+def export_users():
+    email = request.args.get('email', '').strip()
+    if request.args.get('format') == 'jsonl':
+        rows, mimetype, filename = export_jsonl(email), 'application/x-ndjson', 'users.jsonl'
+    else:
+        rows, mimetype, filename = export_csv(email), 'text/csv', 'users.csv'
+
+    return Response(stream_with_context(rows),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
+# view security log entries, newest first, optionally filtered by event type and time range, with a link to the
+# older entries
 @admin_blueprint.route('/logs')
 @required_roles('admin')
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    events = [event for event in request.args.getlist('event') if event in EVENTS]
+    since = parse_time(request.args.get('since'))
+    until = parse_time(request.args.get('until'))
+
+    try:
+        page = log_reader.page(app.config['LOG_PAGE_SIZE'], request.args.get('before'), events, since, until)
+    except ValueError:
+        flash('Log page no longer exists, showing the latest entries.')
+        page = log_reader.page(app.config['LOG_PAGE_SIZE'], None, events, since, until)
+
+    older_logs = None
+    if page.older:
+        older_logs = url_for('admin.logs',
+                             before=page.older,
+                             event=events,
+                             since=request.args.get('since') or None,
+                             until=request.args.get('until') or None)
+
+    if not page.entries:
+        flash('No log entries found.')
+
+    return render_template('admin/admin.html',
+                           logs=page.entries,
+                           older_logs=older_logs,
+                           log_events=EVENTS,
+                           log_filter=request.args,
+                           name=current_user.firstname)
+
+
+# security dashboard: events per minute, top offending IPs and accounts and the failed to successful login ratio,
+# read from counters that are kept up to date as events are stored
+@admin_blueprint.route('/security_dashboard')
+@required_roles('admin')
+def security_dashboard():
+    minutes = min(max(request.args.get('minutes', 60, type=int), 1), 24 * 60)
+
+    # store the events this process is still holding back, so the dashboard includes them
+    app.extensions['security_events'].flush()
+
+    failed_logins, successful_logins, login_failure_ratio = login_ratio(minutes)
+
+    return render_template('admin/admin.html',
+                           security_dashboard=True,
+                           dashboard_minutes=minutes,
+                           events_per_minute=events_per_minute(minutes),
+                           event_labels=EVENTS,
+                           offending_ips=top_offenders('ip'),
+                           offending_emails=top_offenders('email'),
+                           failed_logins=failed_logins,
+                           successful_logins=successful_logins,
+                           login_failure_ratio=login_failure_ratio,
+                           name=current_user.firstname)
+
+
+# queries per endpoint, the latest slow queries and N+1 suspects of the requests this process profiled
+@admin_blueprint.route('/query_profile')
+@required_roles('admin')
+def query_profile():
+    return render_template('admin/admin.html',
+                           query_profile=True,
+                           query_sample_rate=query_profiler.sample_rate,
+                           query_endpoints=query_profiler.endpoint_stats(),
+                           slow_queries=list(query_profiler.slow_queries),
+                           n_plus_one_suspects=list(query_profiler.n_plus_one_suspects),
+                           name=current_user.firstname)
 
-    return render_template('admin/admin.html', logs=content, name=current_user.firstname)
+
+# saved request profiles, newest first, and the functions with the most cumulative time over the chosen profile or
+# over every profile of the chosen endpoint
+@admin_blueprint.route('/profiles')
+@required_roles('admin')
+def profiles():
+    endpoint = request.args.get('route') or None
+    profiles = request_profiler.profiles(endpoint)
+
+    selected = [profile for profile in profiles if profile.name == request.args.get('name')] or profiles
+    if not profiles:
+        flash('No profiles saved.')
+
+    if len(selected) == 1:
+        profiled = '%s at %s' % (selected[0].endpoint, selected[0].time.strftime('%Y-%m-%d %H:%M:%S'))
+    else:
+        profiled = '%s profiles of %s' % (len(selected), endpoint or 'all endpoints')
+
+    return render_template('admin/admin.html',
+                           profiles=profiles,
+                           profile_functions=request_profiler.top_functions(selected),
+                           profiled=profiled,
+                           profile_endpoints=sorted({profile.endpoint for profile in request_profiler.profiles()}),
+                           profile_filter=request.args,
+                           profile_settings_form=ProfileSettingsForm(
+                               formdata=None,
+                               routes=', '.join(sorted(request_profiler.routes)),
+                               sample_rate=request_profiler.sample_rate * 100),
+                           name=current_user.firstname)
+
+
+# switches request profiling on or off for every worker process, posted from the profiles page
+@admin_blueprint.route('/profile_settings', methods=['POST'])
+@required_roles('admin')
+def profile_settings():
+    form = ProfileSettingsForm()
+    if not form.validate_on_submit():
+        for errors in form.errors.values():
+            flash('%s, profiling settings unchanged.' % errors[0])
+        return redirect(url_for('admin.profiles'))
+
+    routes = [route.strip() for route in (form.routes.data or '').split(',') if route.strip()]
+    unknown = [route for route in routes if route not in app.view_functions]
+    sample_rate = (form.sample_rate.data or 0) / 100
+
+    if unknown:
+        flash('Unknown endpoint %s, profiling settings unchanged.' % ', '.join(unknown))
+    else:
+        request_profiler.configure(routes, sample_rate)
+        flash('Profiling %s and %.1f%% of other requests.' % (', '.join(routes) or 'no endpoints', sample_rate * 100))
+    return redirect(url_for('admin.profiles'))
+
+
+# request latency, status, in-flight and crypto metrics of every worker process, in the Prometheus text format
+@admin_blueprint.route('/metrics')
+@required_roles('admin')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# key cache hit/miss counters of this process, for monitoring
+@admin_blueprint.route('/key_cache_stats')
+@required_roles('admin')
+def key_cache_stats():
+    return jsonify(key_cache.stats())
+
+
+# key pair pool depth and fallback counters of this process, for monitoring
+@admin_blueprint.route('/key_pool_stats')
+@required_roles('admin')
+def key_pool_stats():
+    return jsonify(key_pool.stats())
+
+
+# crypto thread counters of this process: calls run, calls in flight and calls turned away because the queue was full
+@admin_blueprint.route('/crypto_executor_stats')
+@required_roles('admin')
+def crypto_executor_stats():
+    return jsonify(crypto_executor.stats())
+
+
+# login rate limiter counters of this process, including the password checks it saved
+@admin_blueprint.route('/rate_limit_stats')
+@required_roles('admin')
+def rate_limit_stats():
+    return jsonify(login_limiter.stats())
+
+
+# current_user cache counters of this process, including the user queries it saved
+@admin_blueprint.route('/identity_cache_stats')
+@required_roles('admin')
+def identity_cache_stats():
+    return jsonify(identity_cache.stats())
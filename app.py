@@ -3,34 +3,19 @@ from flask import Flask, render_template, redirect, url_for, flash, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_qrcode import QRcode
 from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
 import os
 from dotenv import load_dotenv
 from functools import wraps
 import logging
 from flask_talisman import Talisman
-
-
-# Get our filter, we only want messages that include the word SECURITY
-class SecurityFilter(logging.Filter):
-    def filter(self, record):
-        return 'SECURITY' in record.getMessage()
-
-
-# Our general logger
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-
-# File handler for saving into lottery.log
-file_handler = logging.FileHandler('lottery.log', 'a')
-file_handler.setLevel(logging.WARNING)
-file_handler.addFilter(SecurityFilter())
-
-# How we want our logs formatted
-formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
-file_handler.setFormatter(formatter)
-
-# Adding our filehandler to our logger
-logger.addHandler(file_handler)
+from werkzeug.middleware.proxy_fix import ProxyFix
+from security_logging import configure_logging, add_handler
+from query_profiler import QueryProfiler
+from metrics import Metrics
+from request_profiler import RequestProfiler
+from database import READ_BIND, RoutingSession, engine_options, configure_engine
+from crypto.executor import ExecutorBusy
 
 # Load up our .env file
 load_dotenv()
@@ -39,10 +24,87 @@ load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.environ.get('SQLALCHEMY_TRACK_MODIFICATIONS')
+app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO', 'False').lower() == 'true'
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = (os.environ.get('SQLALCHEMY_TRACK_MODIFICATIONS', 'False').lower()
+                                                 == 'true')
+app.config['READ_DATABASE_URI'] = os.environ.get('READ_DATABASE_URI', app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_READ_POOL_SIZE'] = int(os.environ.get('DB_READ_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', 'True').lower() == 'true'
+app.config['DB_BUSY_TIMEOUT'] = int(os.environ.get('DB_BUSY_TIMEOUT', 5000))
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_CACHE_KB'] = int(os.environ.get('SQLITE_CACHE_KB', 65536))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['SQLITE_BEGIN'] = os.environ.get('SQLITE_BEGIN', 'deferred')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+app.config['SQLALCHEMY_BINDS'] = {READ_BIND: {'url': app.config['READ_DATABASE_URI'],
+                                              **engine_options(app.config['READ_DATABASE_URI'], app.config,
+                                                               read_only=True)}}
 app.config['RECAPTCHA_PUBLIC_KEY'] = os.environ.get('RECAPTCHA_PUBLIC_KEY')
 app.config['RECAPTCHA_PRIVATE_KEY'] = os.environ.get('RECAPTCHA_PRIVATE_KEY')
+app.config['RECAPTCHA_ENABLED'] = os.environ.get('RECAPTCHA_ENABLED', 'True').lower() == 'true'
+app.config['SETTLEMENT_CHUNK_SIZE'] = int(os.environ.get('SETTLEMENT_CHUNK_SIZE', 2000))
+app.config['JOB_LEASE_SECONDS'] = int(os.environ.get('JOB_LEASE_SECONDS', 60))
+app.config['DECRYPT_WORKERS'] = int(os.environ.get('DECRYPT_WORKERS', os.cpu_count()))
+app.config['CRYPTO_WORKERS'] = int(os.environ.get('CRYPTO_WORKERS', 0))
+app.config['CRYPTO_QUEUE_SIZE'] = int(os.environ.get('CRYPTO_QUEUE_SIZE', 64))
+app.config['CRYPTO_QUEUE_TIMEOUT'] = float(os.environ.get('CRYPTO_QUEUE_TIMEOUT', 10))
+app.config['DECRYPT_PARALLEL_MIN_BATCH'] = int(os.environ.get('DECRYPT_PARALLEL_MIN_BATCH', 64))
+app.config['KEY_CACHE_SIZE'] = int(os.environ.get('KEY_CACHE_SIZE', 1024))
+app.config['KEY_CACHE_TTL'] = int(os.environ.get('KEY_CACHE_TTL', 0))
+app.config['DRAW_CIPHER'] = os.environ.get('DRAW_CIPHER', 'rsa')
+app.config['KEY_POOL_SIZE'] = int(os.environ.get('KEY_POOL_SIZE', 32))
+app.config['KEY_POOL_PROCESS'] = os.environ.get('KEY_POOL_PROCESS', 'True').lower() == 'true'
+app.config['DRAW_INDEX'] = os.environ.get('DRAW_INDEX', 'off')
+app.config['DRAW_INDEX_SECRET'] = os.environ.get('DRAW_INDEX_SECRET', app.config['SECRET_KEY'])
+app.config['PRIZE_TIER_MIN'] = int(os.environ.get('PRIZE_TIER_MIN', 3))
+app.config['RESULTS_PER_TIER'] = int(os.environ.get('RESULTS_PER_TIER', 50))
+app.config['USER_PAGE_SIZE'] = int(os.environ.get('USER_PAGE_SIZE', 50))
+app.config['DRAW_PAGE_SIZE'] = int(os.environ.get('DRAW_PAGE_SIZE', 20))
+app.config['DRAW_CACHE_SIZE'] = int(os.environ.get('DRAW_CACHE_SIZE', 10000))
+app.config['MAX_PLAYABLE_DRAWS'] = int(os.environ.get('MAX_PLAYABLE_DRAWS', 1000))
+app.config['LOG_PAGE_SIZE'] = int(os.environ.get('LOG_PAGE_SIZE', 10))
+app.config['LOG_FILE'] = os.environ.get('LOG_FILE', 'lottery.log')
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'text')
+app.config['SERVER_WORKERS'] = int(os.environ.get('SERVER_WORKERS', 1))
+app.config['LOG_ROTATE'] = os.environ.get('LOG_ROTATE', 'size' if app.config['SERVER_WORKERS'] == 1 else 'external')
+app.config['LOG_MAX_BYTES'] = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+app.config['LOG_BACKUP_COUNT'] = int(os.environ.get('LOG_BACKUP_COUNT', 10))
+app.config['LOG_ROTATE_WHEN'] = os.environ.get('LOG_ROTATE_WHEN', 'midnight')
+app.config['LOG_COMPRESS'] = os.environ.get('LOG_COMPRESS', 'False').lower() == 'true'
+app.config['SECURITY_EVENTS_BATCH_SIZE'] = int(os.environ.get('SECURITY_EVENTS_BATCH_SIZE', 100))
+app.config['SECURITY_EVENTS_FLUSH_INTERVAL'] = float(os.environ.get('SECURITY_EVENTS_FLUSH_INTERVAL', 5))
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+app.config['RATE_LIMIT_DB'] = os.environ.get('RATE_LIMIT_DB', os.path.join(app.instance_path, 'rate_limit.db'))
+app.config['LOGIN_ATTEMPTS_PER_EMAIL'] = int(os.environ.get('LOGIN_ATTEMPTS_PER_EMAIL', 3))
+app.config['LOGIN_ATTEMPTS_PER_IP'] = int(os.environ.get('LOGIN_ATTEMPTS_PER_IP', 20))
+app.config['LOGIN_ATTEMPT_WINDOW'] = int(os.environ.get('LOGIN_ATTEMPT_WINDOW', 900))
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+app.config['BCRYPT_ROUNDS'] = int(os.environ.get('BCRYPT_ROUNDS', 12))
+app.config['BCRYPT_CHECK_MS'] = float(os.environ.get('BCRYPT_CHECK_MS', 250))
+app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', 1024))
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 30))
+app.config['QUERY_PROFILE_SAMPLE_RATE'] = float(os.environ.get('QUERY_PROFILE_SAMPLE_RATE', 0.1))
+app.config['QUERY_SLOW_MS'] = float(os.environ.get('QUERY_SLOW_MS', 100))
+app.config['QUERY_N_PLUS_ONE'] = int(os.environ.get('QUERY_N_PLUS_ONE', 10))
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILE_ROUTES'] = [route for route in os.environ.get('PROFILE_ROUTES', '').split(',') if route]
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 100))
+
+# Security log, written to LOG_FILE by a background thread so requests never wait on the disk
+security_log = configure_logging(app.config)
+
+# Behind TRUSTED_PROXIES reverse proxies request.remote_addr and the scheme come from their X-Forwarded-For and
+# X-Forwarded-Proto headers, otherwise every client would share the proxy's address (and its login attempts)
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
 
 
 def required_roles(*roles):
@@ -65,7 +127,12 @@ def required_roles(*roles):
                                 current_user.id,
                                 current_user.email,
                                 current_user.role,
-                                request.remote_addr
+                                request.remote_addr,
+                                extra={'event': 'unauthorized',
+                                       'user_id': current_user.id,
+                                       'email': current_user.email,
+                                       'role': current_user.role,
+                                       'ip': request.remote_addr}
                                 )
 
                 return render_template('errors/403.html')
@@ -77,8 +144,28 @@ def required_roles(*roles):
     return wrapper
 
 
-# initialise database
-db = SQLAlchemy(app)
+# initialise database, with a second engine for the read only views
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+with app.app_context():
+    configure_engine(db.engines[None], app.config)
+    configure_engine(db.engines[READ_BIND], app.config, read_only=True)
+
+# Query counts and timings of a sample of requests, read on the admin profiling page
+query_profiler = QueryProfiler(sample_rate=app.config['QUERY_PROFILE_SAMPLE_RATE'],
+                               slow_ms=app.config['QUERY_SLOW_MS'],
+                               n_plus_one=app.config['QUERY_N_PLUS_ONE'])
+query_profiler.init_app(app)
+
+# Request latency, status and crypto counters, added up over every worker process on the admin metrics endpoint
+metrics = Metrics(app.config['METRICS_DIR'], flush_interval=app.config['METRICS_FLUSH_INTERVAL'])
+metrics.init_app(app)
+
+# cProfile profiles of chosen endpoints and a sample of requests, off unless switched on here or on the admin page
+request_profiler = RequestProfiler(app.config['PROFILE_DIR'],
+                                   routes=app.config['PROFILE_ROUTES'],
+                                   sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+                                   keep=app.config['PROFILE_KEEP'])
+request_profiler.init_app(app)
 
 # Create our security headers
 csp = {'default-src': [
@@ -110,6 +197,9 @@ talisman = Talisman(app,
 # Initialize QR Code
 qrcode = QRcode(app)
 
+# CSRF token of the session for templates, JSON clients send it back in the X-CSRFToken header
+app.jinja_env.globals['csrf_token'] = generate_csrf
+
 
 # HOME PAGE VIEW
 @app.route('/')
@@ -138,10 +228,35 @@ login_manager.init_app(app)
 
 from models import User
 
+# Security events are also stored in the database for the admin dashboard, in batches written by the logging thread
+from security_events import SecurityEventHandler
+
+security_events = SecurityEventHandler(capacity=app.config['SECURITY_EVENTS_BATCH_SIZE'],
+                                       interval=app.config['SECURITY_EVENTS_FLUSH_INTERVAL'])
+add_handler(security_log, security_events)
+app.extensions['security_events'] = security_events
+
+
+# current_user is served from a short lived cache of users instead of a query on every request
+from users.identity_cache import identity_cache
+
 
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return identity_cache.load(int(id))
+
+
+# Cache, key pool, crypto thread and rate limiter counters of this process, exported with the request metrics
+from models import key_cache, key_pool, crypto_executor
+from users.rate_limit import login_limiter
+from lottery.history import plaintext_cache
+
+metrics.register('key_cache', key_cache.stats)
+metrics.register('key_pool', key_pool.stats)
+metrics.register('crypto_executor', crypto_executor.stats)
+metrics.register('login_limiter', login_limiter.stats)
+metrics.register('identity_cache', identity_cache.stats)
+metrics.register('plaintext_cache', plaintext_cache.stats)
 
 
 # Error handling for Errors: 400,403,404,500,503
@@ -170,6 +285,13 @@ def service_unavailable(error):
     return render_template('errors/503.html'), 404
 
 
+# Every crypto thread busy and their queue full for CRYPTO_QUEUE_TIMEOUT seconds, the client should retry shortly
+@app.errorhandler(ExecutorBusy)
+def crypto_busy(error):
+    return render_template('errors/503.html'), 503, {'Retry-After': '1'}
+
+
 if __name__ == "__main__":
+    # Development server, serve.py runs the app in production
     # Run it as HTTPS by using the following certificates:
     app.run(ssl_context=('cert.pem', 'key.pem'))
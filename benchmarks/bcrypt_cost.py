@@ -0,0 +1,49 @@
+# Measures how long bcrypt takes at every work factor on this machine and recommends BCRYPT_ROUNDS for a login
+# latency budget, and BCRYPT_CHECK_MS (what one password check takes at that work factor, failed logins are padded to
+# it). Run it on the production hardware:  python -m benchmarks.bcrypt_cost --budget-ms 250
+import argparse
+import statistics
+import time
+
+import bcrypt
+
+# Lowest work factor worth recommending
+MIN_ROUNDS = 10
+
+
+def measure(rounds, repeat):
+    hashed = bcrypt.hashpw(b'calibrate', bcrypt.gensalt(rounds))
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        bcrypt.checkpw(b'calibrate', hashed)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time bcrypt per work factor and recommend BCRYPT_ROUNDS.')
+    parser.add_argument('--budget-ms', type=float, default=250, help='time one password check may take')
+    parser.add_argument('--min-rounds', type=int, default=8)
+    parser.add_argument('--max-rounds', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3, help='checks per work factor, the median is reported')
+    args = parser.parse_args()
+
+    recommended = None
+    print('%6s %12s' % ('rounds', 'check ms'))
+    for rounds in range(args.min_rounds, args.max_rounds + 1):
+        elapsed = measure(rounds, args.repeat)
+        print('%6s %12.1f' % (rounds, elapsed))
+
+        if elapsed <= args.budget_ms:
+            recommended = rounds
+        # every extra round doubles the time, the next one would only be further over budget
+        else:
+            break
+
+    if recommended is None or recommended < MIN_ROUNDS:
+        print('No work factor of at least %s fits in %.0f ms on this machine, use BCRYPT_ROUNDS=%s'
+              % (MIN_ROUNDS, args.budget_ms, MIN_ROUNDS))
+    else:
+        print('BCRYPT_ROUNDS=%s fits in %.0f ms per login on this machine, set BCRYPT_CHECK_MS=%.0f'
+              % (recommended, args.budget_ms, measure(recommended, args.repeat)))
@@ -0,0 +1,131 @@
+# Write and read throughput of concurrent create_draw and view_draws style transactions against an SQLite file, with
+# SQLAlchemy's default engine settings and with the engine tuning of database.py.
+# Run from the project root:  python -m benchmarks.db_concurrency [--writers 8 --readers 8 --seconds 5]
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.exc import OperationalError
+
+from app import db, app
+from database import engine_options, configure_engine
+from models import Draw
+
+# Draws already in the database before the run, spread over USERS players
+SEEDED_DRAWS = 20000
+USERS = 100
+
+draws = Draw.__table__
+
+
+# Engines for a new database file configured as the app would with the given settings: one for writes and one for
+# the read only views. With settings None both are a single engine with SQLAlchemy's defaults, as before.
+def make_engines(path, settings):
+    url = 'sqlite:///' + path
+    if settings is None:
+        engine = read_engine = create_engine(url)
+    else:
+        config = dict(app.config, **settings)
+        engine = create_engine(url, **engine_options(url, config))
+        configure_engine(engine, config)
+        read_engine = create_engine(url, **engine_options(url, config, read_only=True))
+        configure_engine(read_engine, config, read_only=True)
+
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(draws), [dict(user_id=i % USERS + 1, numbers='seeded', numbers_key=None,
+                                                been_played=False, matches_master=False, master_draw=False,
+                                                lottery_round=0) for i in range(SEEDED_DRAWS)])
+    return engine, read_engine
+
+
+# create_draw: count the player's playable draws against the cap, then add one
+def write(engine, user_id):
+    with engine.begin() as connection:
+        connection.execute(select(func.count()).select_from(draws)
+                           .where(draws.c.user_id == user_id, draws.c.been_played == False))  # noqa: E712
+        connection.execute(insert(draws).values(user_id=user_id, numbers='benchmark', numbers_key=None,
+                                                been_played=False, matches_master=False, master_draw=False,
+                                                lottery_round=0))
+
+
+# view_draws: the newest page of the player's playable draws
+def read(engine, user_id):
+    with engine.connect() as connection:
+        connection.execute(select(draws).where(draws.c.user_id == user_id, draws.c.been_played == False)  # noqa: E712
+                           .order_by(draws.c.id.desc()).limit(20)).all()
+
+
+# Runs writers and readers threads for seconds, returns (commits, lock errors, reads, read latencies in seconds)
+def run(engine, read_engine, writers, readers, seconds):
+    results = {'commits': 0, 'locked': 0, 'reads': 0, 'latencies': []}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def writer(n):
+        commits = locked = 0
+        while time.perf_counter() < deadline:
+            try:
+                write(engine, n % USERS + 1)
+                commits += 1
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                locked += 1
+        with lock:
+            results['commits'] += commits
+            results['locked'] += locked
+
+    def reader(n):
+        latencies = []
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            read(read_engine, n % USERS + 1)
+            latencies.append(time.perf_counter() - started)
+        with lock:
+            results['reads'] += len(latencies)
+            results['latencies'].extend(latencies)
+
+    threads = ([threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+               + [threading.Thread(target=reader, args=(n,)) for n in range(readers)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results['commits'], results['locked'], results['reads'], sorted(results['latencies'])
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+# Engine settings compared: SQLAlchemy's defaults (rollback journal, synchronous FULL, one pool for reads and writes),
+# the app's tuning and the app's tuning with SQLITE_BEGIN=immediate (write lock taken when a transaction starts)
+SETTINGS = [('default engine', None),
+            ('tuned', {'SQLITE_BEGIN': 'deferred'}),
+            ('tuned, immediate', {'SQLITE_BEGIN': 'immediate'})]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark concurrent database writes and reads.')
+    parser.add_argument('--writers', type=int, default=8, help='threads adding draws')
+    parser.add_argument('--readers', type=int, default=8, help='threads reading pages of draws')
+    parser.add_argument('--seconds', type=float, default=5.0, help='time each engine setting runs for')
+    args = parser.parse_args()
+
+    print('%s writers and %s readers for %ss, pool size %s, busy timeout %sms' % (
+        args.writers, args.readers, args.seconds, app.config['DB_POOL_SIZE'], app.config['DB_BUSY_TIMEOUT']))
+    print('%16s %10s %10s %10s %12s %12s' % ('engine', 'commits/s', 'locked', 'reads/s', 'read p50 ms',
+                                               'read p99 ms'))
+    workdir = tempfile.mkdtemp(prefix='lottery-db-bench-')
+    for name, settings in SETTINGS:
+        engine, read_engine = make_engines(os.path.join(workdir, '%s.db' % name.replace(' ', '').replace(',', '-')),
+                                           settings)
+        commits, locked, reads, latencies = run(engine, read_engine, args.writers, args.readers, args.seconds)
+        engine.dispose()
+        read_engine.dispose()
+        print('%16s %10.0f %10s %10.0f %12.2f %12.2f' % (name, commits / args.seconds, locked, reads / args.seconds,
+                                                         percentile(latencies, 0.5) * 1000,
+                                                         percentile(latencies, 0.99) * 1000))
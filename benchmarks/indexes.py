@@ -0,0 +1,125 @@
+# Benchmark of the hot Draw/User queries on a seeded database, before and after the composite indexes are created.
+# Run from the project root:  python -m benchmarks.indexes --draws 1000000
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description='Query plans and timings before and after the Draw/User indexes.')
+parser.add_argument('--draws', type=int, default=1000000)
+parser.add_argument('--users', type=int, default=10000)
+parser.add_argument('--rounds', type=int, default=20)
+parser.add_argument('--repeat', type=int, default=5, help='runs per query, the median is reported')
+parser.add_argument('--db', help='database file to seed (default: a temporary file)')
+args = parser.parse_args()
+
+# Point the app at the benchmark database before it is imported
+db_path = os.path.abspath(args.db or tempfile.mkstemp(suffix='.db')[1])
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+os.environ['SQLALCHEMY_ECHO'] = 'False'
+
+from sqlalchemy import select, func, text
+
+from app import app, db
+from migrations import create_missing_indexes
+from models import User, Draw
+
+
+# Recreates the schema as it was before the indexes: only primary keys, the unique email and the index key
+def create_unindexed_schema():
+    db.drop_all()
+    db.create_all()
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name != 'ix_draws_numbers_key':
+                    connection.execute(text('DROP INDEX %s' % index.name))
+
+
+# Bulk inserts users and draws with placeholder keys and ciphertexts, only the indexed columns matter here
+def seed(users, draws, rounds):
+    now = datetime.now()
+    with db.engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(),
+            [{'email': 'user%s@email.com' % i, 'password': b'x', 'firstname': 'Bench', 'lastname': 'User',
+              'phone': '0191-123-4567', 'role': 'admin' if i == 0 else 'user', 'pin_key': 'A' * 32,
+              'date_of_birth': '01/01/2000', 'postcode': 'NE4 5TG', 'registered_on': now, 'total_logins': 0,
+              'public_key': b'x', 'private_key': b'x'} for i in range(users)]
+        )
+
+        batch = []
+        for i in range(draws):
+            played = random.random() < 0.5
+            match_count = random.choice((0, 0, 0, 1, 1, 2, 3, 4, 5, 6)) if played else None
+            batch.append({'user_id': random.randint(2, users), 'numbers': os.urandom(48), 'been_played': played,
+                          'matches_master': match_count == 6, 'match_count': match_count, 'master_draw': False,
+                          'lottery_round': random.randint(1, rounds) if played else 0})
+            if len(batch) == 50000:
+                connection.execute(Draw.__table__.insert(), batch)
+                batch = []
+        # same keys as the other rows, the last batch is inserted in one executemany
+        batch.append({'user_id': 1, 'numbers': os.urandom(48), 'been_played': False, 'matches_master': False,
+                      'match_count': None, 'master_draw': True, 'lottery_round': rounds + 1})
+        connection.execute(Draw.__table__.insert(), batch)
+
+
+# The query patterns of the lottery, admin and settlement code
+def queries(user_id, lottery_round):
+    return [
+        ('view_draws', select(Draw).filter_by(been_played=False, user_id=user_id)),
+        ('check_draws', select(Draw).filter_by(been_played=True, user_id=user_id)),
+        ('current winning draw', select(Draw).filter_by(master_draw=True, been_played=False).limit(1)),
+        ('settlement chunk', select(Draw.id, Draw.user_id, Draw.numbers)
+         .where(Draw.master_draw == False, Draw.been_played == False, Draw.id > 0)
+         .order_by(Draw.id).limit(2000)),
+        ('prize tiers', select(Draw.match_count, func.count(Draw.id))
+         .where(Draw.master_draw == False, Draw.lottery_round == lottery_round, Draw.match_count >= 3)
+         .group_by(Draw.match_count)),
+        ('view_all_users', select(User.id, User.email).filter_by(role='user')),
+    ]
+
+
+def measure(label, user_id, lottery_round):
+    print('\n%s' % label)
+    print('%-22s %12s  %s' % ('query', 'median ms', 'plan'))
+    with db.engine.connect() as connection:
+        for name, statement in queries(user_id, lottery_round):
+            sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            plan = '; '.join(row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                connection.execute(statement).all()
+                timings.append((time.perf_counter() - started) * 1000)
+
+            print('%-22s %12.2f  %s' % (name, statistics.median(timings), plan))
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        print('Seeding %s users and %s draws into %s' % (args.users, args.draws, db_path))
+        started = time.perf_counter()
+        create_unindexed_schema()
+        seed(args.users, args.draws, args.rounds)
+        print('Seeded in %.1fs' % (time.perf_counter() - started))
+
+        user_id = random.randint(2, args.users)
+        lottery_round = random.randint(1, args.rounds)
+
+        measure('Before indexes', user_id, lottery_round)
+
+        started = time.perf_counter()
+        created = create_missing_indexes()
+        with db.engine.begin() as connection:
+            connection.execute(text('ANALYZE'))
+        print('\nCreated %s in %.1fs' % (', '.join(created), time.perf_counter() - started))
+
+        measure('After indexes', user_id, lottery_round)
+
+    if not args.db:
+        os.remove(db_path)
@@ -0,0 +1,104 @@
+# Checks that the server side quick pick generator is uniform and measures how many draws per second it produces.
+# Run from the project root:  python -m benchmarks.quick_pick [--samples 1000000] [--batches 1 100 10000]
+import argparse
+import math
+import random
+import secrets
+import time
+
+import numpy as np
+
+from lottery.draw_index import HIGHEST_NUMBER
+from lottery.matching import BALLS
+from lottery.quick_pick import COMBINATIONS, quick_picks, rank
+
+# Equal width ranges of ranks the rank test counts draws in
+RANK_BUCKETS = 1000
+
+# Largest |z| of a chi-squared statistic accepted as uniform, a uniform generator fails one of the tests in about one
+# run in 2,000
+MAX_Z = 4.0
+
+
+# z-score of a chi-squared statistic with dof degrees of freedom (Wilson-Hilferty approximation), about standard
+# normal when the counts really are uniform
+def chi_squared_z(observed, expected):
+    statistic = float(((observed - expected) ** 2 / expected).sum())
+    dof = len(observed) - 1
+    return ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+
+
+# Every number should come up in BALLS / HIGHEST_NUMBER of the draws, the ranks should spread evenly over all
+# COMBINATIONS draws, and every number should be as likely at each position of the sorted draw as a uniform draw makes
+# it. Returns a list of (test, z).
+def uniformity(samples):
+    draws = quick_picks(samples)
+
+    numbers = np.bincount(draws.ravel(), minlength=HIGHEST_NUMBER + 1)[1:]
+    results = [('numbers', chi_squared_z(numbers, samples * BALLS / HIGHEST_NUMBER))]
+
+    buckets = np.bincount((rank(draws) * RANK_BUCKETS // COMBINATIONS).astype(np.int64), minlength=RANK_BUCKETS)
+    # bucket i holds the ranks from ceil(i * COMBINATIONS / RANK_BUCKETS), sizes differ by one rank at most
+    edges = np.array([-(-i * COMBINATIONS // RANK_BUCKETS) for i in range(RANK_BUCKETS + 1)])
+    results.append(('ranks', chi_squared_z(buckets, samples * np.diff(edges) / COMBINATIONS)))
+
+    # P(number n at position k) = C(n-1, k-1) * C(60-n, 6-k) / C(60, 6)
+    for position in range(BALLS):
+        observed = np.bincount(draws[:, position], minlength=HIGHEST_NUMBER + 1)[1:]
+        expected = np.array([math.comb(n - 1, position) * math.comb(HIGHEST_NUMBER - n, BALLS - 1 - position)
+                             for n in range(1, HIGHEST_NUMBER + 1)]) * samples / COMBINATIONS
+        # positions a number can't take are left out
+        possible = expected > 0
+        results.append(('position %s' % (position + 1), chi_squared_z(observed[possible], expected[possible])))
+    return results
+
+
+# Draws per second of generate(batch) over at least seconds
+def throughput(generate, batch, seconds=1.0):
+    draws = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        generate(batch)
+        draws += batch
+    return draws / (time.perf_counter() - started)
+
+
+# What the app did before: random.sample for the master draw, a retry loop for the browser's lucky dip (here with
+# secrets instead of crypto.getRandomValues)
+def random_sample(batch):
+    return [sorted(random.sample(range(1, HIGHEST_NUMBER + 1), BALLS)) for _ in range(batch)]
+
+
+def secrets_retry(batch):
+    draws = []
+    for _ in range(batch):
+        draw = set()
+        while len(draw) < BALLS:
+            draw.add(secrets.randbelow(HIGHEST_NUMBER) + 1)
+        draws.append(sorted(draw))
+    return draws
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and benchmark the quick pick generator.')
+    parser.add_argument('--samples', type=int, default=1000000, help='draws generated for the uniformity tests')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 100, 10000], help='draws per request')
+    parser.add_argument('--seconds', type=float, default=1.0, help='time spent measuring each batch size')
+    args = parser.parse_args()
+
+    print('Uniformity of %s draws (|z| <= %s passes)' % (args.samples, MAX_Z))
+    failed = False
+    for test, z in uniformity(args.samples):
+        failed = failed or abs(z) > MAX_Z
+        print('%12s %8.2f %s' % (test, z, 'ok' if abs(z) <= MAX_Z else 'FAIL'))
+
+    print()
+    print('%8s %16s %16s %16s' % ('batch', 'quick_picks/s', 'random.sample/s', 'secrets retry/s'))
+    for batch in args.batches:
+        print('%8s %16.0f %16.0f %16.0f' % (batch,
+                                            throughput(quick_picks, batch, args.seconds),
+                                            throughput(random_sample, batch, args.seconds),
+                                            throughput(secrets_retry, batch, args.seconds)))
+
+    if failed:
+        raise SystemExit('Quick picks are not uniform')
@@ -0,0 +1,254 @@
+# Latency and throughput of the main routes, driven through the Flask test client against a freshly seeded database.
+# Run from the project root:  python -m benchmarks.routes [--users 200 --draws 5000 --requests 50 --json out.json]
+import argparse
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description='Benchmark the main routes through the Flask test client.')
+parser.add_argument('--users', type=int, default=200, help='seeded users')
+parser.add_argument('--draws', type=int, default=5000, help='seeded draws')
+parser.add_argument('--rounds', type=int, default=3, help='rounds the seeded draws are spread over')
+parser.add_argument('--requests', type=int, default=50, help='timed requests per route')
+parser.add_argument('--warmup', type=int, default=3, help='untimed requests per route before timing')
+parser.add_argument('--lottery-runs', type=int, default=3, help='lottery rounds run, each one settles --lottery-draws')
+parser.add_argument('--lottery-draws', type=int, default=1000, help='draws entered before every lottery run')
+parser.add_argument('--clients', type=int, default=10, help='logged in players the lottery routes rotate through')
+parser.add_argument('--json', help='write the results to this file')
+parser.add_argument('--compare', help='results file of an earlier run to compare against')
+args = parser.parse_args()
+args.json = args.json and os.path.abspath(args.json)
+args.compare = args.compare and os.path.abspath(args.compare)
+
+# Run in a scratch directory with its own database and lottery.log
+workdir = tempfile.mkdtemp(prefix='lottery-bench-')
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+os.environ['SQLALCHEMY_ECHO'] = 'False'
+os.chdir(workdir)
+
+import pyotp
+
+from app import app
+from benchmarks.seed import SEED_PASSWORD, SEED_POSTCODE, seed, seed_draws
+from models import User, init_db
+
+# reCAPTCHA is not checked in testing mode, CSRF still is
+app.config['TESTING'] = True
+
+BASE_URL = 'https://localhost'
+
+# The admin created by init_db
+ADMIN_EMAIL = 'admin@email.com'
+ADMIN_PASSWORD = 'Admin1!'
+ADMIN_PIN_KEY = 'BFB5S34STBLZCOB22K6PPYDCMZMH46OJ'
+
+ROUTES = ['register', 'login', 'create_draw', 'view_draws', 'check_draws', 'view_all_users', 'logs', 'run_lottery',
+          'run_lottery (settled)']
+
+# Status every successful request is expected to return
+EXPECTED = {'register': 302, 'login': 302, 'create_draw': 302, 'view_draws': 200, 'check_draws': 200,
+            'view_all_users': 200, 'logs': 200, 'run_lottery': 302}
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, route, seconds, ok=True):
+        self.samples[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+    # Times a single request, which counts as an error unless it returns the route's expected status
+    def request(self, route, send):
+        started = time.perf_counter()
+        response = send()
+        self.add(route, time.perf_counter() - started, response.status_code == EXPECTED[route])
+        return response
+
+    def results(self):
+        return {route: summarize(self.samples[route], self.errors[route]) for route in ROUTES if self.samples[route]}
+
+
+# Nearest-rank percentile of sorted samples
+def percentile(samples, p):
+    return samples[max(math.ceil(p / 100 * len(samples)) - 1, 0)]
+
+
+def summarize(samples, errors):
+    samples = sorted(samples)
+    return {'requests': len(samples),
+            'errors': errors,
+            'mean_ms': round(sum(samples) / len(samples) * 1000, 2),
+            'p50_ms': round(percentile(samples, 50) * 1000, 2),
+            'p95_ms': round(percentile(samples, 95) * 1000, 2),
+            'p99_ms': round(percentile(samples, 99) * 1000, 2),
+            'max_ms': round(samples[-1] * 1000, 2),
+            # requests per second of a single client sending them back to back
+            'throughput_rps': round(len(samples) / sum(samples), 1)}
+
+
+def csrf_token(client, path):
+    page = client.get(path, base_url=BASE_URL).get_data(as_text=True)
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+
+
+def login_data(client, email, password, pin_key, postcode):
+    return dict(csrf_token=csrf_token(client, '/login'),
+                email=email,
+                password=password,
+                postcode=postcode,
+                pin=pyotp.TOTP(pin_key).now())
+
+
+# A test client logged in as the given user, its CSRF token is kept for the forms posted later
+def logged_in(email, password, pin_key, postcode=SEED_POSTCODE):
+    client = app.test_client()
+    data = login_data(client, email, password, pin_key, postcode)
+    response = client.post('/login', base_url=BASE_URL, data=data)
+    if response.status_code != 302:
+        raise SystemExit('Could not log in as %s' % email)
+    client.csrf_token = data['csrf_token']
+    return client
+
+
+def random_draw(client):
+    numbers = sorted(random.sample(range(1, 61), 6))
+    data = {'number%s' % (i + 1): number for i, number in enumerate(numbers)}
+    data['csrf_token'] = client.csrf_token
+    return data
+
+
+def bench_register(recorder, count):
+    for _ in range(count):
+        client = app.test_client()
+        data = dict(csrf_token=csrf_token(client, '/register'),
+                    email='bench%s@email.com' % random.getrandbits(48),
+                    firstname='Bench',
+                    lastname='User',
+                    phone='0191-123-4567',
+                    password=SEED_PASSWORD,
+                    confirm_password=SEED_PASSWORD,
+                    date_of_birth='01/01/2000',
+                    postcode=SEED_POSTCODE)
+        recorder.request('register', lambda: client.post('/register', base_url=BASE_URL, data=data))
+
+
+def bench_login(recorder, count, players):
+    for _ in range(count):
+        client = app.test_client()
+        email, pin_key = random.choice(players)
+        data = login_data(client, email, SEED_PASSWORD, pin_key, SEED_POSTCODE)
+        recorder.request('login', lambda: client.post('/login', base_url=BASE_URL, data=data))
+
+
+def bench_lottery(recorder, count, clients):
+    for i in range(count):
+        client = clients[i % len(clients)]
+        recorder.request('create_draw',
+                         lambda: client.post('/create_draw', base_url=BASE_URL, data=random_draw(client)))
+    for i in range(count):
+        client = clients[i % len(clients)]
+        recorder.request('view_draws', lambda: client.post('/view_draws', base_url=BASE_URL))
+    for i in range(count):
+        client = clients[i % len(clients)]
+        recorder.request('check_draws', lambda: client.post('/check_draws', base_url=BASE_URL))
+
+
+def bench_admin(recorder, count, admin):
+    for route in ('view_all_users', 'logs'):
+        for _ in range(count):
+            recorder.request(route, lambda: admin.get('/' + route, base_url=BASE_URL))
+
+
+# Enters new draws and a new winning draw, then runs the round. The request only starts the worker, the time until
+# the worker has settled the round is recorded separately.
+def bench_run_lottery(recorder, count, admin, owners, draws):
+    for _ in range(count):
+        with app.app_context():
+            seed_draws(owners, draws)
+        admin.get('/generate_winning_draw', base_url=BASE_URL)
+
+        started = time.perf_counter()
+        response = recorder.request('run_lottery', lambda: admin.post('/run_lottery', base_url=BASE_URL,
+                                                                        data={'csrf_token': admin.csrf_token}))
+        job_id = response.headers.get('Location', '').rsplit('/', 1)[-1]
+        if not job_id.isdigit():
+            recorder.add('run_lottery (settled)', time.perf_counter() - started, False)
+            continue
+
+        while True:
+            status = admin.get('/lottery_job_status/' + job_id, base_url=BASE_URL).get_json()
+            if status['status'] in ('finished', 'failed'):
+                break
+            time.sleep(0.05)
+        recorder.add('run_lottery (settled)', time.perf_counter() - started, status['status'] == 'finished')
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=app.root_path,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_results(results, baseline=None):
+    print('%-22s %8s %6s %9s %9s %9s %9s %9s' % ('route', 'requests', 'errors', 'mean ms', 'p50 ms', 'p95 ms',
+                                                 'p99 ms', 'req/s'))
+    for route, result in results.items():
+        line = '%-22s %8s %6s %9.2f %9.2f %9.2f %9.2f %9.1f' % (route, result['requests'], result['errors'],
+                                                                result['mean_ms'], result['p50_ms'],
+                                                                result['p95_ms'], result['p99_ms'],
+                                                                result['throughput_rps'])
+        if baseline and route in baseline:
+            line += '  p50 %+.0f%% p95 %+.0f%%' % (change(baseline[route]['p50_ms'], result['p50_ms']),
+                                                  change(baseline[route]['p95_ms'], result['p95_ms']))
+        print(line)
+
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+if __name__ == '__main__':
+    init_db()
+    with app.app_context():
+        started = time.perf_counter()
+        owners = seed(args.users, args.draws, max(args.rounds, 1))
+        players = [(user.email, user.pin_key) for user in User.query.filter_by(role='user').limit(100)]
+        print('Seeded %s users and %s draws in %.1fs' % (args.users, args.draws, time.perf_counter() - started))
+
+    admin = logged_in(ADMIN_EMAIL, ADMIN_PASSWORD, ADMIN_PIN_KEY)
+    clients = [logged_in(email, SEED_PASSWORD, pin_key) for email, pin_key in players[:args.clients]]
+
+    # warm up every route first, then time them
+    for recorder, count in ((Recorder(), args.warmup), (Recorder(), args.requests)):
+        bench_register(recorder, count)
+        bench_login(recorder, count, players)
+        bench_lottery(recorder, count, clients)
+        bench_admin(recorder, count, admin)
+    bench_run_lottery(recorder, args.lottery_runs, admin, owners, args.lottery_draws)
+
+    results = recorder.results()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['routes']
+    print_results(results, baseline)
+
+    if args.json:
+        settings = {name: value for name, value in vars(args).items() if name not in ('json', 'compare')}
+        with open(args.json, 'w') as f:
+            json.dump({'commit': current_commit(),
+                       'created_on': datetime.now().isoformat(timespec='seconds'),
+                       'settings': settings,
+                       'routes': results}, f, indent=2)
@@ -0,0 +1,166 @@
+# Fills the configured database with synthetic users and encrypted draws through bulk inserts.
+# Run from the project root:  python -m benchmarks.seed --users 1000 --draws 100000 --rounds 5 [--reset]
+import argparse
+import pickle
+import random
+import time
+from datetime import datetime
+
+import pyotp
+from cryptography.fernet import Fernet
+from sqlalchemy import func, insert, select
+
+from app import db, app
+from crypto import ciphers
+from lottery.draw_index import HIGHEST_NUMBER
+from lottery.matching import BALLS, to_masks, match_counts
+from models import User, Draw, encrypt, index_key, key_pool, init_db, hash_password
+
+# Every seeded user logs in with this password and postcode
+SEED_PASSWORD = 'Seed1!pw'
+SEED_POSTCODE = 'NE4 5TG'
+
+# Rows per INSERT
+BATCH_SIZE = 5000
+
+
+# Key pair shared by several seeded users, so seeding only searches for a handful of primes.
+# Has the same get_*_key methods as User, so draws are encrypted exactly as the app would.
+class SeedKeys:
+    def __init__(self, public_key, private_key):
+        self.public_key = public_key
+        self.private_key = private_key
+        self.secret_key = Fernet.generate_key()
+        self.data_key, wrapped_data_key = ciphers.new_data_key(public_key)
+
+        # Stored form of the keys, pickled once for every user sharing them
+        self.columns = {'public_key': pickle.dumps(public_key),
+                        'private_key': pickle.dumps(private_key),
+                        'secret_key': self.secret_key,
+                        'data_key': wrapped_data_key}
+
+    def get_public_key(self):
+        return self.public_key
+
+    def get_private_key(self):
+        return self.private_key
+
+    def get_secret_key(self):
+        return self.secret_key
+
+    def get_data_key(self):
+        return self.data_key
+
+
+# Takes key pairs from the registration key pool
+def seed_keys(count):
+    key_pool.start()
+    return [SeedKeys(*key_pool.take()) for _ in range(count)]
+
+
+def random_numbers():
+    return ' '.join(str(number) for number in sorted(random.sample(range(1, HIGHEST_NUMBER + 1), BALLS)))
+
+
+# Inserts count users with the role 'user', returns a list of (user id, keys)
+def seed_users(count, keys):
+    password = hash_password(SEED_PASSWORD)
+    first_id = (db.session.scalar(select(func.max(User.id))) or 0) + 1
+    now = datetime.now()
+    owners = []
+
+    for start in range(0, count, BATCH_SIZE):
+        rows = []
+        for number in range(first_id + start, first_id + min(start + BATCH_SIZE, count)):
+            user_keys = keys[number % len(keys)]
+            rows.append(dict(email='seed%s@email.com' % number,
+                             password=password,
+                             firstname='Seed',
+                             lastname='User',
+                             phone='0191-123-4567',
+                             role='user',
+                             pin_key=pyotp.random_base32(),
+                             date_of_birth='01/01/2000',
+                             postcode=SEED_POSTCODE,
+                             registered_on=now,
+                             total_logins=0,
+                             **user_keys.columns))
+
+        ids = db.session.scalars(insert(User).returning(User.id, sort_by_parameter_order=True), rows).all()
+        owners.extend((user_id, keys[(first_id + start + i) % len(keys)]) for i, user_id in enumerate(ids))
+        db.session.commit()
+
+    return owners
+
+
+# Inserts count draws spread over the owners. Draws of a settled round are stored played, with the prize tier they
+# would have been given against winning_numbers, otherwise they wait for the next round.
+def seed_draws(owners, count, lottery_round=0, winning_numbers=None):
+    for start in range(0, count, BATCH_SIZE):
+        batch = [(random.choice(owners), random_numbers()) for _ in range(min(BATCH_SIZE, count - start))]
+
+        counts = [None] * len(batch)
+        if winning_numbers:
+            counts = match_counts(to_masks([numbers for _, numbers in batch]), to_masks([winning_numbers])[0])
+
+        db.session.execute(insert(Draw), [
+            dict(user_id=user_id,
+                 numbers=encrypt(numbers, user_keys),
+                 numbers_key=index_key(numbers),
+                 been_played=winning_numbers is not None,
+                 matches_master=match_count == BALLS,
+                 match_count=None if match_count is None else int(match_count),
+                 master_draw=False,
+                 lottery_round=lottery_round if winning_numbers else 0)
+            for ((user_id, user_keys), numbers), match_count in zip(batch, counts)
+        ])
+        db.session.commit()
+
+
+# Replaces the current winning draw with a new one for the given round, as generate_winning_draw does
+def seed_winning_draw(admin, lottery_round):
+    Draw.query.filter_by(master_draw=True).delete(synchronize_session=False)
+    db.session.add(Draw(user_id=admin.id,
+                        numbers=random_numbers(),
+                        master_draw=True,
+                        lottery_round=lottery_round,
+                        keys=admin))
+    db.session.commit()
+
+
+# Seeds users and draws over the given number of rounds: every round but the last is settled, the last one is open
+# with a winning draw ready to be run
+def seed(users, draws, rounds, key_pairs=16):
+    admin = User.query.filter_by(role='admin').first()
+    if admin is None:
+        raise SystemExit('No admin user, create the database with --reset first')
+
+    first_round = (db.session.scalar(select(func.max(Draw.lottery_round))) or 0) + 1
+    owners = seed_users(users, seed_keys(key_pairs))
+
+    per_round = draws // rounds
+    for lottery_round in range(first_round, first_round + rounds - 1):
+        seed_draws(owners, per_round, lottery_round, random_numbers())
+    seed_draws(owners, draws - per_round * (rounds - 1))
+    seed_winning_draw(admin, first_round + rounds - 1)
+
+    return owners
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed the database with synthetic users and draws.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--draws', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5, help='rounds to spread the draws over, the last one is open')
+    parser.add_argument('--key-pairs', type=int, default=16, help='distinct RSA key pairs shared by the users')
+    parser.add_argument('--reset', action='store_true', help='drop every table and recreate the admin first')
+    args = parser.parse_args()
+
+    if args.reset:
+        init_db()
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(args.users, args.draws, max(args.rounds, 1), args.key_pairs)
+        print('Seeded %s users and %s draws over %s rounds in %.1fs (password %s)'
+              % (args.users, args.draws, args.rounds, time.perf_counter() - started, SEED_PASSWORD))
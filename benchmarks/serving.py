@@ -0,0 +1,154 @@
+# Requests per second and latency of the development server (python app.py), the production entry point (python
+# serve.py) with its defaults and serve.py with gunicorn and a crypto thread per CPU, over HTTPS, with light clients loading the home page while heavy clients log in (bcrypt) over and
+# over. Each server runs in a scratch directory with its own database, reCAPTCHA is switched off so the clients can log
+# in. Run from the project root:  python -m benchmarks.serving [--seconds 10 --light 8 --heavy 2]
+import argparse
+import http.cookiejar
+import os
+import re
+import shutil
+import signal
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import pyotp
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Admin account created by init_db
+EMAIL = 'admin@email.com'
+PASSWORD = 'Admin1!'
+POSTCODE = 'NE4 5TG'
+PIN_KEY = 'BFB5S34STBLZCOB22K6PPYDCMZMH46OJ'
+
+# Command and settings of every server. The development server is started the way app.py starts it, from an import:
+# running app.py as a script imports it a second time through the blueprints
+SERVERS = {'dev': (['-c', "from app import app; app.run(ssl_context=('cert.pem', 'key.pem'))"], {}),
+           'serve': ([os.path.join(PROJECT, 'serve.py')], {}),
+           'gunicorn': ([os.path.join(PROJECT, 'serve.py')],
+                        {'SERVER_BACKEND': 'gunicorn', 'SERVER_WORKERS': '2', 'CRYPTO_WORKERS': str(os.cpu_count())})}
+
+# The servers use the self signed certificate of the project
+TLS = ssl.create_default_context()
+TLS.check_hostname = False
+TLS.verify_mode = ssl.CERT_NONE
+
+
+def opener():
+    return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                       urllib.request.HTTPSHandler(context=TLS))
+
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('Server exited with code %s' % process.returncode)
+        try:
+            opener().open(url, timeout=2).read()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise SystemExit('Server did not start within %ss' % timeout)
+
+
+# Loads the home page
+def light_request(base):
+    opener().open(base + '/', timeout=60).read()
+
+
+# Logs in from a new session: the login form, then the form posted with the credentials
+def heavy_request(base):
+    session = opener()
+    form = session.open(base + '/login', timeout=60).read().decode()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', form).group(1)
+    data = urllib.parse.urlencode({'csrf_token': token, 'email': EMAIL, 'password': PASSWORD, 'postcode': POSTCODE,
+                                   'pin': pyotp.TOTP(PIN_KEY).now()}).encode()
+    page = session.open(base + '/login', data, timeout=60)
+    page.read()
+    if page.url.endswith('/login'):
+        raise RuntimeError('login failed')
+
+
+# Runs the clients for seconds, returns {kind: (latencies in seconds, errors)}
+def load(base, light, heavy, seconds):
+    results = {'light': ([], [0]), 'heavy': ([], [0])}
+    deadline = time.perf_counter() + seconds
+
+    def client(kind, request):
+        latencies, errors = results[kind]
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                request(base)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors[0] += 1
+
+    threads = ([threading.Thread(target=client, args=('light', light_request)) for _ in range(light)]
+               + [threading.Thread(target=client, args=('heavy', heavy_request)) for _ in range(heavy)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {kind: (sorted(latencies), errors[0]) for kind, (latencies, errors) in results.items()}
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the development server against serve.py.')
+    parser.add_argument('--seconds', type=float, default=10.0, help='time each server is loaded for')
+    parser.add_argument('--light', type=int, default=8, help='clients loading the home page')
+    parser.add_argument('--heavy', type=int, default=2, help='clients logging in')
+    parser.add_argument('--port', type=int, default=5000, help='port of serve.py (app.py always uses 5000)')
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+    args = parser.parse_args()
+
+    print('%s light and %s heavy clients for %ss' % (args.light, args.heavy, args.seconds))
+    print('%8s %10s %12s %12s %10s %12s %8s' % ('server', 'light rps', 'light p50 ms', 'light p99 ms', 'logins/s',
+                                                'login p50 ms', 'errors'))
+    for server in args.servers:
+        # Run in a scratch directory with its own database and logs, and copies of the settings and certificate
+        workdir = tempfile.mkdtemp(prefix='lottery-serve-bench-')
+        for name in ('.env', 'cert.pem', 'key.pem'):
+            shutil.copy(os.path.join(PROJECT, name), workdir)
+        env = dict(os.environ,
+                   SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(workdir, 'bench.db'),
+                   RATE_LIMIT_DB=os.path.join(workdir, 'rate_limit.db'),
+                   METRICS_DIR=os.path.join(workdir, 'metrics'),
+                   PROFILE_DIR=os.path.join(workdir, 'profiles'),
+                   RECAPTCHA_ENABLED='False',
+                   SERVER_HOST='127.0.0.1',
+                   SERVER_PORT=str(args.port),
+                   PYTHONPATH=PROJECT)
+        subprocess.run([sys.executable, '-c', 'import app; from models import init_db; init_db()'],
+                       cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+
+        command, settings = SERVERS[server]
+        process = subprocess.Popen([sys.executable, *command], cwd=workdir, env=dict(env, **settings),
+                                   start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base = 'https://127.0.0.1:%s' % (5000 if server == 'dev' else args.port)
+        try:
+            wait_until_up(base + '/', process)
+            results = load(base, args.light, args.heavy, args.seconds)
+        finally:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        light, light_errors = results['light']
+        heavy, heavy_errors = results['heavy']
+        print('%8s %10.1f %12.1f %12.1f %10.2f %12.1f %8s' % (server, len(light) / args.seconds,
+                                                              percentile(light, 0.5), percentile(light, 0.99),
+                                                              len(heavy) / args.seconds, percentile(heavy, 0.5),
+                                                              light_errors + heavy_errors))
@@ -0,0 +1,148 @@
+# IMPORTS
+import os
+import pickle
+
+import rsa
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Every ciphertext written since versioning starts with this header followed by a one byte cipher version.
+# Draws written before have no header and are plain 512-bit RSA ciphertexts, which are always exactly 64 bytes long,
+# while a versioned ciphertext never is.
+HEADER = b'LD'
+LEGACY_LENGTH = 64
+
+# Size of the per-user AES data key of the hybrid scheme
+DATA_KEY_SIZE = 32
+
+
+# Runs fn(*args) in the calling thread, callers can pass another runner (a thread pool's) for the RSA work
+def inline(fn, *args):
+    return fn(*args)
+
+
+# Asymmetric encryption of every ticket with the user's RSA key pair. The keys are looked up in the calling thread,
+# only the RSA operation itself is handed to run.
+class RSACipher:
+    name = 'rsa'
+    version = 1
+
+    @staticmethod
+    def available(keys):
+        return True
+
+    @staticmethod
+    def encrypt(data, keys, run=inline):
+        return run(rsa.encrypt, data, keys.get_public_key())
+
+    @staticmethod
+    def decrypt(data, keys, run=inline):
+        return run(rsa.decrypt, data, keys.get_private_key())
+
+
+# Symmetric encryption with the user's Fernet key (AES-128-CBC + HMAC). Takes microseconds, so it always runs in the
+# calling thread.
+class FernetCipher:
+    name = 'fernet'
+    version = 2
+
+    @staticmethod
+    def available(keys):
+        return keys.get_secret_key() is not None
+
+    @staticmethod
+    def encrypt(data, keys, run=inline):
+        return Fernet(keys.get_secret_key()).encrypt(data)
+
+    @staticmethod
+    def decrypt(data, keys, run=inline):
+        return Fernet(keys.get_secret_key()).decrypt(data)
+
+
+# Envelope encryption: tickets are encrypted with AES-256-GCM under a per-user data key, the data key itself is stored
+# encrypted with the user's RSA public key. Only one RSA decryption per user is needed to read all their tickets, the
+# AES work runs in the calling thread.
+class HybridCipher:
+    name = 'hybrid'
+    version = 3
+    nonce_size = 12
+
+    @staticmethod
+    def available(keys):
+        return keys.get_data_key() is not None
+
+    @staticmethod
+    def encrypt(data, keys, run=inline):
+        nonce = os.urandom(HybridCipher.nonce_size)
+        return nonce + AESGCM(keys.get_data_key()).encrypt(nonce, data, None)
+
+    @staticmethod
+    def decrypt(data, keys, run=inline):
+        nonce, ciphertext = data[:HybridCipher.nonce_size], data[HybridCipher.nonce_size:]
+        return AESGCM(keys.get_data_key()).decrypt(nonce, ciphertext, None)
+
+
+CIPHERS = {cipher.name: cipher for cipher in (RSACipher, FernetCipher, HybridCipher)}
+VERSIONS = {cipher.version: cipher for cipher in CIPHERS.values()}
+
+
+# Creates a new data key for the hybrid scheme, returned as (data key, data key encrypted with the public key)
+def new_data_key(public_key):
+    data_key = AESGCM.generate_key(bit_length=DATA_KEY_SIZE * 8)
+    return data_key, rsa.encrypt(data_key, public_key)
+
+
+# Splits a ciphertext into its cipher version and the cipher's own payload, legacy untagged ciphertexts are RSA
+def split(data):
+    if len(data) != LEGACY_LENGTH and data[:len(HEADER)] == HEADER:
+        return data[len(HEADER)], data[len(HEADER) + 1:]
+    return RSACipher.version, data
+
+
+def version_of(data):
+    return split(data)[0]
+
+
+# Encrypts a string with the named cipher, falling back to RSA if the user doesn't have the keys it needs yet.
+# run(fn, *args) runs the RSA operation, if there is one.
+def encrypt(data, keys, scheme='rsa', run=inline):
+    cipher = CIPHERS[scheme]
+    if not cipher.available(keys):
+        cipher = RSACipher
+
+    return HEADER + bytes([cipher.version]) + cipher.encrypt(data.encode(), keys, run)
+
+
+# Decrypts a ciphertext written by any cipher version, run(fn, *args) runs the RSA operation if there is one
+def decrypt(data, keys, run=inline):
+    version, payload = split(data)
+    return VERSIONS[version].decrypt(payload, keys, run).decode()
+
+
+# Keys of a user rebuilt from the values stored in the database, for code that only has the raw columns (decryption
+# workers, bulk queries). material is (private_key, secret_key, data_key), or just the pickled private key.
+class StoredKeys:
+    def __init__(self, material):
+        if isinstance(material, bytes):
+            material = (material, None, None)
+        self.private_key, self.secret_key, self.data_key = material
+        self.unpickled_private_key = None
+        self.unwrapped_data_key = None
+
+    def get_public_key(self):
+        raise TypeError('Stored keys can only be used to decrypt')
+
+    def get_private_key(self):
+        if self.unpickled_private_key is None:
+            self.unpickled_private_key = pickle.loads(self.private_key)
+        return self.unpickled_private_key
+
+    def get_secret_key(self):
+        return self.secret_key
+
+    def get_data_key(self):
+        if self.data_key is None:
+            return None
+        if self.unwrapped_data_key is None:
+            self.unwrapped_data_key = rsa.decrypt(self.data_key, self.get_private_key())
+        return self.unwrapped_data_key
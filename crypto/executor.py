@@ -0,0 +1,70 @@
+# IMPORTS
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Raised when every crypto thread is busy and the queue in front of them stays full for the whole timeout
+class ExecutorBusy(Exception):
+    pass
+
+
+class CryptoExecutor:
+    # Runs CPU heavy crypto (bcrypt hashes and checks, RSA key generation and decryption) on a fixed number of threads,
+    # so however many requests need it at once, at most workers of them use the CPU and the other request threads stay
+    # responsive. bcrypt releases the GIL while it hashes, so those calls also run in parallel with the request threads.
+    # The pure Python RSA code holds the GIL, so for it the executor only limits how many calls run at once.
+    # workers: threads running crypto, 0 runs every call inline in the request thread
+    # queue_size: calls that may wait for a thread, further calls wait up to timeout seconds for a place in the queue
+    # and then raise ExecutorBusy
+    # inline: returns True while calls have to run in the calling thread, e.g. while it's being profiled
+    def __init__(self, workers=2, queue_size=64, timeout=10.0, inline=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.inline = inline
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = None
+        self.pid = None
+
+        # Counters exposed through stats()
+        self.calls = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+    # The threads are only started on first use, and again in a forked process, which doesn't inherit them
+    def get_executor(self):
+        if self.executor is None or self.pid != os.getpid():
+            with self.lock:
+                if self.executor is None or self.pid != os.getpid():
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='crypto',
+                                                       initializer=self.mark_worker)
+                    self.pid = os.getpid()
+        return self.executor
+
+    def mark_worker(self):
+        self.local.worker = True
+
+    # Returns fn(*args), computed on one of the crypto threads
+    def run(self, fn, *args):
+        # a call made from a crypto thread runs there, waiting for another thread could deadlock a full pool
+        if self.workers <= 0 or getattr(self.local, 'worker', False) or (self.inline and self.inline()):
+            return fn(*args)
+
+        if not self.slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise ExecutorBusy('%s crypto calls in flight on %s threads' % (self.in_flight, self.workers))
+        self.in_flight += 1
+        try:
+            self.calls += 1
+            return self.get_executor().submit(fn, *args).result()
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    def stats(self):
+        return {'workers': self.workers,
+                'calls': self.calls,
+                'in_flight': self.in_flight,
+                'rejected': self.rejected}
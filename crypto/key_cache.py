@@ -0,0 +1,77 @@
+# IMPORTS
+import threading
+import time
+from collections import OrderedDict
+
+
+class KeyCache:
+    # max_size: number of keys kept before the least recently used one is evicted
+    # ttl: seconds a key stays cached, None keeps keys until they are evicted or invalidated
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # (user id, key kind) -> (key, expiry time)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # Returns the key of the given kind ('public', 'private', 'data') for a user.
+    # loader is only called on a miss and returns the deserialized key, so the key BLOB is only read when it's needed.
+    def get(self, user_id, kind, loader):
+        cache_key = (user_id, kind)
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None:
+                key, expires = entry
+                if expires is None or expires > now:
+                    self.entries.move_to_end(cache_key)
+                    self.hits += 1
+                    return key
+
+                del self.entries[cache_key]
+                self.expirations += 1
+            self.misses += 1
+
+        # load outside the lock, two threads missing on the same key at once just both load it
+        key = loader()
+        expires = now + self.ttl if self.ttl else None
+
+        with self.lock:
+            self.entries[cache_key] = (key, expires)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return key
+
+    # Drops every cached key of a user, called whenever the user's keys change
+    def invalidate(self, user_id):
+        with self.lock:
+            for cache_key in [cache_key for cache_key in self.entries if cache_key[0] == user_id]:
+                del self.entries[cache_key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations}
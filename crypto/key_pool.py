@@ -0,0 +1,94 @@
+# IMPORTS
+import logging
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import rsa
+
+
+class KeyPool:
+    # size: number of ready key pairs kept, 0 disables the pool and every key pair is generated inline
+    # bits: RSA key size
+    # use_process: generate key pairs in a separate process, so the pure-Python prime search doesn't hold the GIL
+    # of the web process
+    # on_generate: called after every key pair generated, in the pool or inline
+    def __init__(self, size=32, bits=512, use_process=True, on_generate=None):
+        self.size = size
+        self.bits = bits
+        self.use_process = use_process
+        self.on_generate = on_generate
+        self.keys = queue.Queue(maxsize=max(size, 1))
+        self.wanted = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.executor = None
+
+        # Counters exposed through stats()
+        self.generated = 0
+        self.taken = 0
+        self.fallbacks = 0
+
+    # Starts the background producer, safe to call on every request
+    def start(self):
+        if self.size <= 0 or self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.produce, name='key-pool', daemon=True)
+                self.thread.start()
+
+    def generate(self):
+        if self.use_process:
+            try:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=1)
+                return self.executor.submit(rsa.newkeys, self.bits).result()
+            except BrokenProcessPool:
+                logging.exception('Key pool process broken, generating key pairs in the producer thread')
+                self.executor = None
+                self.use_process = False
+        return rsa.newkeys(self.bits)
+
+    # Tops the pool up whenever a key pair has been taken
+    def produce(self):
+        while True:
+            while not self.keys.full():
+                try:
+                    keys = self.generate()
+                except Exception:
+                    logging.exception('Key pool failed to generate a key pair')
+                    break
+                self.generated += 1
+                if self.on_generate:
+                    self.on_generate()
+                self.keys.put(keys)
+
+            self.wanted.wait()
+            self.wanted.clear()
+
+    # Returns a ready (public key, private key) pair, or generates one inline if the pool has run dry
+    def take(self):
+        self.start()
+        try:
+            keys = self.keys.get_nowait()
+            self.taken += 1
+        except queue.Empty:
+            self.fallbacks += 1
+            logging.info('Key pool empty, generating key pair inline (%s fallbacks so far)', self.fallbacks)
+            keys = rsa.newkeys(self.bits)
+            if self.on_generate:
+                self.on_generate()
+
+        self.wanted.set()
+        return keys
+
+    def stats(self):
+        return {'depth': self.keys.qsize() if self.size > 0 else 0,
+                'size': self.size,
+                'generated': self.generated,
+                'taken': self.taken,
+                'fallbacks': self.fallbacks,
+                'running': self.thread is not None and self.thread.is_alive()}
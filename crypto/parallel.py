@@ -0,0 +1,90 @@
+# IMPORTS
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from crypto.ciphers import StoredKeys, decrypt
+
+# Keys of the current (worker) process, keyed by the stored key material they were built from
+worker_keys = {}
+WORKER_KEY_LIMIT = 1024
+
+
+# Unpickles (and unwraps) the keys of a user at most once per process
+def worker_key(material):
+    keys = worker_keys.get(material)
+    if keys is None:
+        if len(worker_keys) >= WORKER_KEY_LIMIT:
+            worker_keys.clear()
+        keys = worker_keys[material] = StoredKeys(material)
+    return keys
+
+
+# Decrypts a group of ciphertexts that all belong to the same user
+def decrypt_group(material, ciphertexts):
+    keys = worker_key(material)
+    return [decrypt(ciphertext, keys) for ciphertext in ciphertexts]
+
+
+class DecryptionService:
+    # workers: size of the process pool, 0 or 1 decrypts serially in the calling process
+    # min_batch: batches smaller than this are decrypted serially, the pool round trip isn't worth it
+    # task_size: largest number of ciphertexts sent to a worker at once, so one heavy player still spreads over workers
+    def __init__(self, workers=None, min_batch=64, task_size=256):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.min_batch = min_batch
+        self.task_size = task_size
+        self.pool = None
+
+    @property
+    def parallel(self):
+        return self.workers > 1
+
+    # The pool is only started on first use, so processes that never decrypt in bulk never fork workers
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self.pool
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    # Groups the indices of the batch by key material and splits every group into tasks of at most task_size
+    def tasks(self, pairs):
+        groups = {}
+        for index, (ciphertext, material) in enumerate(pairs):
+            groups.setdefault(material, []).append(index)
+
+        for material, indices in groups.items():
+            for start in range(0, len(indices), self.task_size):
+                yield material, indices[start:start + self.task_size]
+
+    # Decrypts a batch of (ciphertext, key material) pairs and returns the plaintexts in the same order.
+    # Key material is what StoredKeys is built from: (private_key, secret_key, data_key) as stored on the user row.
+    def decrypt(self, pairs):
+        pairs = list(pairs)
+        plaintexts = [None] * len(pairs)
+        tasks = list(self.tasks(pairs))
+
+        if self.parallel and len(pairs) >= self.min_batch:
+            try:
+                pool = self.get_pool()
+                futures = [(indices, pool.submit(decrypt_group, material, [pairs[i][0] for i in indices]))
+                           for material, indices in tasks]
+                for indices, future in futures:
+                    for index, plaintext in zip(indices, future.result()):
+                        plaintexts[index] = plaintext
+                return plaintexts
+
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for memory), drop the pool and finish the batch serially
+                logging.exception('Decryption pool broken, falling back to serial decryption')
+                self.pool = None
+
+        for material, indices in tasks:
+            for index, plaintext in zip(indices, decrypt_group(material, [pairs[i][0] for i in indices])):
+                plaintexts[index] = plaintext
+        return plaintexts
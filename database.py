@@ -0,0 +1,91 @@
+# IMPORTS
+from functools import wraps
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Bind key of the engine read only views query
+READ_BIND = 'read'
+
+
+# SQLAlchemy engine options for uri from the DB_* settings of config, read_only for the engine of the read only views.
+# SQLite waits up to DB_BUSY_TIMEOUT ms for a lock before raising "database is locked" (the rest of its tuning is done
+# by configure_engine, once a connection is open), PostgreSQL waits as long for row and table locks and refuses writes
+# on the read only engine's connections.
+def engine_options(uri, config, read_only=False):
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        # in memory databases have one connection shared by every thread, so there's no pool to size
+        if url.database in (None, '', ':memory:'):
+            return options
+        options['connect_args'] = {'timeout': config['DB_BUSY_TIMEOUT'] / 1000}
+    elif url.get_backend_name() == 'postgresql':
+        settings = '-c lock_timeout=%d' % config['DB_BUSY_TIMEOUT']
+        if read_only:
+            settings += ' -c default_transaction_read_only=on'
+        options['connect_args'] = {'options': settings}
+
+    options.update(pool_size=config['DB_READ_POOL_SIZE' if read_only else 'DB_POOL_SIZE'],
+                   max_overflow=config['DB_MAX_OVERFLOW'],
+                   pool_timeout=config['DB_POOL_TIMEOUT'],
+                   pool_recycle=config['DB_POOL_RECYCLE'])
+    return options
+
+
+# Sets the SQLite pragmas of config on every new connection of engine: journal mode (WAL lets readers carry on while a
+# draw is written), synchronous level, busy timeout, page cache and memory mapped I/O size. Connections of the read
+# only engine refuse writes (query_only). The driver starts a transaction at its first write, so what create_draw
+# reads before writing (the count of playable draws) can change before it commits. With SQLITE_BEGIN=immediate
+# transactions of the other engine take the write lock when they start instead, which costs write throughput (see
+# benchmarks/db_concurrency.py).
+def configure_engine(engine, config, read_only=False):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = ['PRAGMA journal_mode=%s' % config['SQLITE_JOURNAL_MODE'],
+               'PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'],
+               'PRAGMA busy_timeout=%d' % config['DB_BUSY_TIMEOUT'],
+               # a negative cache_size is in KiB rather than pages
+               'PRAGMA cache_size=-%d' % config['SQLITE_CACHE_KB'],
+               'PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE']]
+    if read_only:
+        pragmas.append('PRAGMA query_only=ON')
+    begin = 'BEGIN IMMEDIATE' if config['SQLITE_BEGIN'] == 'immediate' and not read_only else None
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        # the driver starts transactions itself unless it's in autocommit mode, begin_transaction() starts them instead
+        if begin:
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    if begin:
+        @event.listens_for(engine, 'begin')
+        def begin_transaction(connection):
+            connection.exec_driver_sql(begin)
+
+
+# db.session, sending the queries of views decorated with read_only to the read only engine. Flushes, and so every
+# change made through the session, still go to the default engine.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('read_only'):
+            return self._db.engines[READ_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# Decorator of views that only read, their queries use the read only engine's pool
+def read_only(f):
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+
+    return wrapped
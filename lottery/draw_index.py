@@ -0,0 +1,50 @@
+# IMPORTS
+import hashlib
+import hmac
+
+# A draw is 6 distinct numbers from 1 to 60, bit n-1 of the mask is set for number n
+HIGHEST_NUMBER = 60
+
+# Index keys are prefixed with their mode, so keys written under another mode are never mistaken for current ones
+PREFIXES = {'bitmask': 'm:', 'hmac': 'h:'}
+
+
+# Packs a draw ("1 2 3 4 5 6" or a list of numbers) into a 64-bit integer
+def to_mask(numbers):
+    if isinstance(numbers, str):
+        numbers = numbers.split()
+
+    mask = 0
+    for number in numbers:
+        number = int(number)
+        if not 1 <= number <= HIGHEST_NUMBER:
+            raise ValueError('Draw number %s out of range' % number)
+        mask |= 1 << (number - 1)
+    return mask
+
+
+# Unpacks a mask back into the sorted draw numbers
+def from_mask(mask):
+    return [number for number in range(1, HIGHEST_NUMBER + 1) if mask >> (number - 1) & 1]
+
+
+# Returns the mask stored in a bitmask index key
+def mask_of(key):
+    return int(key[len(PREFIXES['bitmask']):], 16)
+
+
+# Returns the index key of a draw for the given mode, or None if indexing is off.
+# bitmask: the mask itself in hex, which reveals the numbers to anyone who can read the database
+# hmac: a keyed SHA-256 digest of the mask, which only supports equality lookups but keeps the numbers confidential
+def index_key(numbers, mode, secret=None):
+    if mode not in PREFIXES:
+        return None
+
+    mask = to_mask(numbers)
+    if mode == 'bitmask':
+        return PREFIXES[mode] + '%015x' % mask
+
+    digest = hmac.new(secret.encode() if isinstance(secret, str) else secret,
+                      mask.to_bytes(8, 'big'),
+                      hashlib.sha256).hexdigest()
+    return PREFIXES[mode] + digest
@@ -1,8 +1,12 @@
 from flask import flash
 from flask_wtf import FlaskForm
-from wtforms import IntegerField, SubmitField
+from flask_wtf.file import FileField
+from wtforms import IntegerField, SubmitField, TextAreaField
 from wtforms.validators import NumberRange, InputRequired, ValidationError
 
+from lottery.draw_index import HIGHEST_NUMBER
+from lottery.matching import BALLS
+
 
 class DrawForm(FlaskForm):
     number1 = IntegerField(id='no1', validators=[
@@ -36,26 +40,52 @@ class DrawForm(FlaskForm):
         standard_validators = FlaskForm.validate(self)
         if standard_validators:
 
-            # Check that no number is the same using a dictionary
-            numbers = [self.number1.data, self.number2.data, self.number3.data,
-                       self.number4.data, self.number5.data, self.number6.data]
-            checker = {}
-
-            for num in numbers:
-                print(not checker.get(num))
-                if not checker.get(num):
-                    checker[num] = 1
-                else:
-                    flash('All numbers must be unique!')
-                    return False
-
-            # Check that each consecutive number is larger than the last
-            last_num = 0
-            for current_num in numbers:
-                if current_num < last_num:
-                    flash('The numbers must be in ascending order!')
-                    return False
-                last_num = current_num
+            # Then the rules every draw follows, shared with bulk submissions
+            error = draw_error([self.number1.data, self.number2.data, self.number3.data,
+                                self.number4.data, self.number5.data, self.number6.data])
+            if error:
+                flash(error)
+                return False
 
             return True
         return False
+
+
+# Many draws at once, typed one per line or uploaded as a text/CSV file with one draw per line
+class BulkDrawForm(FlaskForm):
+    draws = TextAreaField(id='draws')
+    file = FileField(id='draws_file')
+    submit = SubmitField("Submit Draws")
+
+
+# Number of random draws to generate on the server
+class QuickPickForm(FlaskForm):
+    count = IntegerField(id='quick_picks', validators=[
+        InputRequired('Number of draws required'),
+        NumberRange(min=1)
+    ])
+    submit = SubmitField("Lucky Dip Draws")
+
+
+# Returns why a list of numbers isn't a valid draw, None if it is. A draw is 6 unique numbers from 1 to 60 in
+# ascending order.
+def draw_error(numbers):
+    if len(numbers) != BALLS:
+        return 'A draw must have %s numbers!' % BALLS
+
+    for num in numbers:
+        if not 1 <= num <= HIGHEST_NUMBER:
+            return 'Number must be between 1 and %s.' % HIGHEST_NUMBER
+
+    # Check that no number is the same
+    if len(set(numbers)) != len(numbers):
+        return 'All numbers must be unique!'
+
+    # Check that each consecutive number is larger than the last
+    last_num = 0
+    for current_num in numbers:
+        if current_num < last_num:
+            return 'The numbers must be in ascending order!'
+        last_num = current_num
+
+    return None
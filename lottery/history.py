@@ -0,0 +1,126 @@
+# IMPORTS
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import case, func, select
+
+from app import db, app
+from models import Draw, decrypt_many
+
+# A page of draws, newest first, and the cursor of the next (older) page, None on the last page
+DrawPage = namedtuple('DrawPage', ['draws', 'older'])
+
+# Tickets of a player: draws waiting for the next round, played draws, and per played round (newest first) the number
+# of tickets, prize winning tickets and tickets matching the winning draw
+DrawSummary = namedtuple('DrawSummary', ['playable', 'played', 'rounds'])
+
+
+# Decrypted numbers of recently viewed draws, so paging back and forth through a player's draws only decrypts each page
+# once. Entries are keyed by (user id, hash of the draw's ciphertext) rather than the draw id: every process has its own
+# cache, and SQLite can give the id of a deleted draw to a new one, so an id doesn't always stand for the same numbers.
+# A ciphertext only ever decrypts to the same numbers, entries of deleted or re-encrypted draws are simply never looked
+# up again and leave when evicted.
+class PlaintextCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(user_id, draw):
+        ciphertext = draw.numbers if isinstance(draw.numbers, bytes) else draw.numbers.encode('utf-8')
+        return user_id, hashlib.sha256(ciphertext).digest()
+
+    # Returns the numbers of every draw, in the same order. decrypt is only called with the draws that aren't cached
+    # and returns their numbers in the same order.
+    def get_many(self, user_id, draws, decrypt):
+        keys = [self.key(user_id, draw) for draw in draws]
+        numbers = {}
+        with self.lock:
+            for key in keys:
+                cached = self.entries.get(key)
+                if cached is not None:
+                    self.entries.move_to_end(key)
+                    numbers[key] = cached
+            self.hits += len(numbers)
+            self.misses += len(draws) - len(numbers)
+
+        missing = [(key, draw) for key, draw in zip(keys, draws) if key not in numbers]
+        if missing:
+            numbers.update(zip((key for key, draw in missing), decrypt([draw for key, draw in missing])))
+
+            with self.lock:
+                for key, draw in missing:
+                    self.entries[key] = numbers[key]
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        return [numbers[key] for key in keys]
+
+    # Drops every cached draw of a user from this process's cache, called when the user's draws are deleted to free
+    # their entries early
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_id]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions}
+
+
+plaintext_cache = PlaintextCache(max_size=app.config['DRAW_CACHE_SIZE'])
+
+
+# Returns the count newest playable (played=False) or played draws of a user older than the draw with id before, read
+# from the (user_id, been_played) index in id order
+def draw_page(user_id, played, count=20, before=None):
+    query = select(Draw).filter_by(user_id=user_id, been_played=played)
+    if before is not None:
+        query = query.where(Draw.id < before)
+    draws = db.session.scalars(query.order_by(Draw.id.desc()).limit(count + 1)).all()
+
+    if len(draws) > count:
+        return DrawPage(draws[:count], draws[count - 1].id)
+    return DrawPage(draws, None)
+
+
+# Decrypts the numbers of a page of draws owned by user, serving the draws seen before from the plaintext cache. The
+# user's private key is only loaded when a draw isn't cached.
+def decrypt_page(user, draws):
+    return plaintext_cache.get_many(user.id, draws,
+                                    lambda missing: decrypt_many((draw.numbers, user.key_material())
+                                                                 for draw in missing))
+
+
+# Ticket counts of a user from aggregate queries, without loading any draw
+def draw_summary(user_id):
+    counts = dict(db.session.execute(
+        select(Draw.been_played, func.count())
+        .filter_by(user_id=user_id)
+        .group_by(Draw.been_played)
+    ).all())
+
+    winners = func.sum(case((Draw.match_count >= app.config['PRIZE_TIER_MIN'], 1), else_=0))
+    jackpots = func.sum(case((Draw.matches_master, 1), else_=0))
+    rounds = db.session.execute(
+        select(Draw.lottery_round, func.count(), winners, jackpots)
+        .filter_by(user_id=user_id, been_played=True)
+        .group_by(Draw.lottery_round)
+        .order_by(Draw.lottery_round.desc())
+    ).all()
+
+    return DrawSummary(counts.get(False, 0), counts.get(True, 0), rounds)
@@ -0,0 +1,62 @@
+# IMPORTS
+import numpy as np
+
+from lottery.draw_index import HIGHEST_NUMBER
+
+# Number of balls in a draw, a ticket matching all of them wins the jackpot
+BALLS = 6
+
+
+# Parses space separated numbers from the bytes of the text, digit by digit over every number at once, since
+# np.fromstring is deprecated and turning every number into a Python string costs several times as much.
+def parse_numbers(text):
+    chars = np.frombuffer(text.encode(), dtype=np.uint8)
+    digits = chars - np.uint8(ord('0'))
+    is_digit = digits < 10
+    if not np.all(is_digit | (chars == ord(' '))):
+        raise ValueError('Draw numbers must be whole numbers separated by spaces')
+
+    # a number starts where a run of digits begins and ends where it stops
+    edges = np.diff(is_digit.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    lengths = np.flatnonzero(edges == -1) - starts
+    if lengths.max(initial=0) > len(str(HIGHEST_NUMBER)):
+        raise ValueError('Draw number out of range')
+
+    numbers = np.zeros(starts.size, dtype=np.uint64)
+    for position in range(lengths.max(initial=0)):
+        longer = lengths > position
+        numbers[longer] = numbers[longer] * np.uint64(10) + digits[starts[longer] + position]
+    return numbers
+
+
+# Packs a list of draws ("1 2 3 4 5 6") into an array of 64-bit masks, bit n-1 set for number n. The draws are joined
+# into one buffer parsed by NumPy in a single pass, splitting every draw in Python costs more than the matching itself.
+def to_masks(draws):
+    if not draws:
+        return np.zeros(0, dtype=np.uint64)
+
+    numbers = parse_numbers(' '.join(draws))
+    if numbers.size != len(draws) * BALLS:
+        raise ValueError('Draws must have %s numbers each' % BALLS)
+    numbers = numbers.reshape(len(draws), BALLS)
+    if numbers.min() < 1 or numbers.max() > HIGHEST_NUMBER:
+        raise ValueError('Draw number out of range')
+
+    return np.bitwise_or.reduce(np.left_shift(np.uint64(1), numbers - np.uint64(1)), axis=1)
+
+
+# Counts set bits of every element, with NumPy's own popcount where available (NumPy 2) and a SWAR fallback otherwise
+def popcount(masks):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(masks).astype(np.uint8)
+
+    masks = masks - ((masks >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    masks = (masks & np.uint64(0x3333333333333333)) + ((masks >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    masks = (masks + (masks >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((masks * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.uint8)
+
+
+# Number of balls every ticket mask shares with the winning mask, for the whole batch at once
+def match_counts(masks, winning_mask):
+    return popcount(np.asarray(masks, dtype=np.uint64) & np.uint64(winning_mask))
@@ -0,0 +1,69 @@
+# IMPORTS
+import re
+
+from sqlalchemy import func, insert, select
+
+from app import db, app
+from lottery.forms import draw_error
+from models import Draw, encrypt, index_key
+
+
+# Separators allowed between the numbers of a submitted line: spaces, commas, semicolons or tabs
+SEPARATORS = re.compile(r'[\s,;]+')
+
+
+# Reads one submitted draw, a line of text ("1 2 3 4 5 6", "1,2,3,4,5,6") or a list of numbers, into a list of
+# numbers. Raises ValueError if something else than a whole number is in it.
+def parse_numbers(draw):
+    if isinstance(draw, str):
+        draw = [part for part in SEPARATORS.split(draw.strip()) if part]
+    if not isinstance(draw, list):
+        raise ValueError
+    return [number if isinstance(number, int) and not isinstance(number, bool) else int(number, 10)
+            for number in draw]
+
+
+# Checks every submitted draw with the same rules as DrawForm. Returns the valid draws in the stored form
+# ("1 2 3 4 5 6") and a list of (line number, error) for the invalid ones, lines counted from 1. Blank lines are
+# skipped.
+def validate_draws(draws):
+    valid = []
+    errors = []
+    for line, draw in enumerate(draws, start=1):
+        if isinstance(draw, str) and not draw.strip():
+            continue
+
+        try:
+            numbers = parse_numbers(draw)
+        except (ValueError, TypeError):
+            errors.append((line, 'Numbers must be whole numbers!'))
+            continue
+
+        error = draw_error(numbers)
+        if error:
+            errors.append((line, error))
+        else:
+            valid.append(' '.join(str(number) for number in numbers))
+    return valid, errors
+
+
+# Draws a user can still submit before reaching MAX_PLAYABLE_DRAWS playable draws
+def draws_left(user_id):
+    playable = db.session.scalar(select(func.count()).select_from(Draw).filter_by(user_id=user_id, been_played=False))
+    return max(app.config['MAX_PLAYABLE_DRAWS'] - playable, 0)
+
+
+# Encrypts the draws for user and inserts them with one statement in one transaction. The user's keys come from the
+# key cache, so only the first draw (if any) loads and unpickles them.
+def create_draws(user, draws):
+    db.session.execute(insert(Draw), [
+        dict(user_id=user.id,
+             numbers=encrypt(numbers, user),
+             numbers_key=index_key(numbers),
+             been_played=False,
+             matches_master=False,
+             master_draw=False,
+             lottery_round=0)
+        for numbers in draws
+    ])
+    db.session.commit()
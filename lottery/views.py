@@ -1,10 +1,16 @@
 # IMPORTS
 
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
 from flask_login import current_user
+from flask_wtf.csrf import validate_csrf
+from wtforms.validators import ValidationError
 
-from app import db, required_roles
-from lottery.forms import DrawForm
+from app import db, app, required_roles
+from database import read_only
+from lottery.forms import DrawForm, BulkDrawForm, QuickPickForm
+from lottery.history import draw_page, decrypt_page, draw_summary, plaintext_cache
+from lottery.quick_pick import quick_picks, format_draws
+from lottery.tickets import validate_draws, draws_left, create_draws
 from models import Draw
 from sqlalchemy.orm import make_transient
 
@@ -12,14 +18,18 @@ from sqlalchemy.orm import make_transient
 lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
 
 
-@required_roles('user')
+# Decrypts a page of the current user's draws in place, draws seen before come from the plaintext cache
 def decrypt_draws(draws):
-    for draw in draws:
+    numbers = decrypt_page(current_user, draws)
+
+    for draw, draw_numbers in zip(draws, numbers):
         make_transient(draw)
-        # # For symmetric encryption
-        # draw.view_draw(current_user.secret_key)
-        # For asymmetric encryption
-        draw.view_draw(current_user.private_key)
+        draw.numbers = draw_numbers
+
+
+# Cursor of the page to show from the before arg, None for the newest draws
+def page_cursor():
+    return request.args.get('before', type=int)
 
 
 # VIEWS
@@ -38,24 +48,23 @@ def create_draw():
     form = DrawForm()
 
     if form.validate_on_submit():
+        # make sure the user hasn't reached the most playable draws a user can have
+        if not draws_left(current_user.id):
+            flash('You already have the maximum of %s playable draws.' % app.config['MAX_PLAYABLE_DRAWS'])
+            return redirect(url_for('lottery.lottery'))
+
         submitted_numbers = (str(form.number1.data) + ' '
                              + str(form.number2.data) + ' '
                              + str(form.number3.data) + ' '
                              + str(form.number4.data) + ' '
                              + str(form.number5.data) + ' '
                              + str(form.number6.data))
-        # # create a new draw with the form data. # Symmetric encryption
-        # new_draw = Draw(user_id=current_user.id,
-        #                 numbers=submitted_numbers,
-        #                 master_draw=False,
-        #                 lottery_round=0,
-        #                 secret_key=current_user.secret_key)
-        # create a new draw with the form data. # asymmetric encryption
+        # create a new draw with the form data, encrypted with the configured cipher
         new_draw = Draw(user_id=current_user.id,
                         numbers=submitted_numbers,
                         master_draw=False,
                         lottery_round=0,
-                        secret_key=current_user.public_key)
+                        keys=current_user)
         # add the new draw to the database
         db.session.add(new_draw)
         db.session.commit()
@@ -69,41 +78,172 @@ def create_draw():
                            form=form)
 
 
-# view all draws that have not been played
-@lottery_blueprint.route('/view_draws', methods=['POST'])
+# Checks and stores many submitted draws, returns the number stored and a list of (line number, error), the line
+# number is None for errors about the whole submission. Nothing is stored unless every draw is valid.
+def submit_draws(draws):
+    # the cap is checked first, so oversized submissions are turned away before any draw is parsed or encrypted
+    left = draws_left(current_user.id)
+    submitted = sum(1 for draw in draws if not isinstance(draw, str) or draw.strip())
+    if submitted > left:
+        return 0, [(None, 'You can have at most %s playable draws, %s more can be submitted.'
+                    % (app.config['MAX_PLAYABLE_DRAWS'], left))]
+
+    valid, errors = validate_draws(draws)
+    if errors:
+        return 0, errors
+    if not valid:
+        return 0, [(None, 'No draws submitted.')]
+
+    create_draws(current_user, valid)
+    return len(valid), []
+
+
+# JSON requests carry no form, they send the CSRF token of the session (the csrf-token meta tag of every page seen
+# while logged in) in the X-CSRFToken header instead. Returns the reason the token was refused, None if it is valid.
+def json_csrf_error():
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return None
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+    except ValidationError as error:
+        return str(error)
+    return None
+
+
+# submit many draws at once, from the bulk form (typed or uploaded, one draw per line) or as JSON
+# ({"draws": [[1, 2, 3, 4, 5, 6], "7 8 9 10 11 12", ...]})
+@lottery_blueprint.route('/create_draws', methods=['POST'])
 @required_roles('user')
+def bulk_create_draws():
+    if request.is_json:
+        csrf_error = json_csrf_error()
+        if csrf_error:
+            return jsonify(created=0, errors=[{'line': None, 'error': csrf_error}]), 400
+
+        payload = request.get_json(silent=True)
+        draws = payload.get('draws') if isinstance(payload, dict) else None
+        if not isinstance(draws, list):
+            return jsonify(created=0, errors=[{'line': None, 'error': 'Expected {"draws": [...]}'}]), 400
+
+        created, errors = submit_draws(draws)
+        return (jsonify(created=created, errors=[{'line': line, 'error': error} for line, error in errors]),
+                400 if errors else 201)
+
+    form = BulkDrawForm()
+
+    if form.validate_on_submit():
+        draws = (form.draws.data or '').splitlines()
+        if form.file.data:
+            draws += form.file.data.read().decode('utf-8', errors='replace').splitlines()
+
+        created, errors = submit_draws(draws)
+        if not errors:
+            flash('%s draws submitted.' % created)
+            return redirect(url_for('lottery.lottery'))
+
+        flash('No draws were submitted, correct the lines below and try again.')
+        return render_template('lottery/lottery.html',
+                               name=current_user.firstname,
+                               bulk_form=form,
+                               quick_pick_form=QuickPickForm(),
+                               draw_errors=errors)
+
+    return render_template('lottery/lottery.html',
+                           name=current_user.firstname,
+                           bulk_form=form,
+                           quick_pick_form=QuickPickForm())
+
+
+# submit count random draws generated on the server, from the quick pick form or as JSON ({"count": 100})
+@lottery_blueprint.route('/create_quick_picks', methods=['POST'])
+@required_roles('user')
+def create_quick_picks():
+    if request.is_json:
+        csrf_error = json_csrf_error()
+        if csrf_error:
+            return jsonify(created=0, draws=[], error=csrf_error), 400
+
+        payload = request.get_json(silent=True)
+        count = payload.get('count') if isinstance(payload, dict) else None
+        if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            return jsonify(created=0, draws=[], error='Expected {"count": <number of draws>}'), 400
+    else:
+        form = QuickPickForm()
+        if not form.validate_on_submit():
+            return render_template('lottery/lottery.html',
+                                   name=current_user.firstname,
+                                   bulk_form=BulkDrawForm(),
+                                   quick_pick_form=form)
+        count = form.count.data
+
+    left = draws_left(current_user.id)
+    if count > left:
+        error = ('You can have at most %s playable draws, %s more can be submitted.'
+                 % (app.config['MAX_PLAYABLE_DRAWS'], left))
+        if request.is_json:
+            return jsonify(created=0, draws=[], error=error), 400
+        flash(error)
+        return redirect(url_for('lottery.lottery'))
+
+    draws = format_draws(quick_picks(count))
+    create_draws(current_user, draws)
+
+    if request.is_json:
+        return jsonify(created=len(draws), draws=draws), 201
+    flash('%s lucky dip draws submitted.' % len(draws))
+    return redirect(url_for('lottery.lottery'))
+
+
+# view the draws that have not been played, a page at a time
+@lottery_blueprint.route('/view_draws', methods=['GET', 'POST'])
+@required_roles('user')
+@read_only
 def view_draws():
-    # get all draws that have not been played [played=0]
+    # get a page of the draws that have not been played [played=0]
     # And only get the draws made by the current user
-    playable_draws = Draw.query.filter_by(been_played=False, user_id=current_user.id).all()
+    page = draw_page(current_user.id, False, app.config['DRAW_PAGE_SIZE'], page_cursor())
 
     # if playable draws exist
-    if len(playable_draws) != 0:
-        # Decrypt our draws
-        decrypt_draws(playable_draws)
+    if len(page.draws) != 0:
+        # Decrypt this page of draws only
+        decrypt_draws(page.draws)
+
+        older_draws = None
+        if page.older:
+            older_draws = url_for('lottery.view_draws', before=page.older)
 
         # re-render lottery page with playable draws
         return render_template('lottery/lottery.html',
-                               playable_draws=playable_draws,
+                               playable_draws=page.draws,
+                               older_draws=older_draws,
+                               summary=draw_summary(current_user.id),
                                name=current_user.firstname)
     else:
         flash('No playable draws.')
         return lottery()
 
 
-# view lottery results
-@lottery_blueprint.route('/check_draws', methods=['POST'])
+# view lottery results, a page at a time, with the tickets and wins of every round played
+@lottery_blueprint.route('/check_draws', methods=['GET', 'POST'])
 @required_roles('user')
+@read_only
 def check_draws():
-    # get played draws
+    # get a page of the played draws
     # And only get the draws made by the current user
-    played_draws = Draw.query.filter_by(been_played=True, user_id=current_user.id).all()
+    page = draw_page(current_user.id, True, app.config['DRAW_PAGE_SIZE'], page_cursor())
 
     # if played draws exist
-    if len(played_draws) != 0:
+    if len(page.draws) != 0:
+        decrypt_draws(page.draws)
+
+        older_results = None
+        if page.older:
+            older_results = url_for('lottery.check_draws', before=page.older)
 
         return render_template('lottery/lottery.html',
-                               results=played_draws,
+                               results=page.draws,
+                               older_results=older_results,
+                               summary=draw_summary(current_user.id),
                                played=True,
                                name=current_user.firstname)
 
@@ -120,6 +260,7 @@ def play_again():
     # Again, only delete draws made by current user
     Draw.query.filter_by(been_played=True, master_draw=False, user_id=current_user.id).delete(synchronize_session=False)
     db.session.commit()
+    plaintext_cache.invalidate(current_user.id)
 
     flash("All played draws deleted.")
     return lottery()
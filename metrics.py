@@ -0,0 +1,255 @@
+# IMPORTS
+import atexit
+import json
+import os
+import threading
+import time
+
+from flask import g, request
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Metric families: name -> (type, help)
+FAMILIES = {
+    'lottery_http_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'lottery_http_request_duration_seconds': ('histogram', 'Time spent handling a request, by endpoint.'),
+    'lottery_http_requests_in_flight': ('gauge', 'Requests being handled right now.'),
+    'lottery_crypto_operations_total': ('counter', 'Draw encryptions and decryptions, bcrypt hashes and checks '
+                                                   'and RSA key pairs generated.'),
+    'lottery_component_stats': ('gauge', 'Counters of the caches, key pool and rate limiter of each live process.'),
+}
+
+
+# Labels are kept as sorted (name, value) tuples, so they can be dictionary keys
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Request and crypto metrics of this process, written to a file of its own in directory every flush_interval
+# seconds. The metrics endpoint adds up the files of every process (worker processes and lottery jobs included), so
+# any worker answering a scrape reports the whole server. Counters of processes that have exited stay in the total,
+# gauges only count live processes. Clear the directory when the server is redeployed.
+class Metrics:
+    def __init__(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = None
+
+        # (name, labels) -> value
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count per bucket, sum, count]
+        self.histograms = {}
+        # (component, function returning a stats dict), read whenever the metrics are written
+        self.collectors = []
+        self.thread = None
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self.start()
+
+    def add_gauge(self, name, amount, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Exports the numbers of stats(), e.g. KeyCache.stats, as lottery_component_stats{component=..., stat=...}
+    def register(self, component, stats):
+        self.collectors.append((component, stats))
+
+    # REQUEST HOOKS
+    def start_request(self):
+        g.metrics_started = time.perf_counter()
+        self.add_gauge('lottery_http_requests_in_flight', 1)
+        self.start()
+
+    def finish_request(self, response):
+        self.record_request(response.status_code)
+        return response
+
+    # Requests that raised never reach after_request, they are recorded as 500s here
+    def teardown_request(self, error):
+        if 'metrics_started' not in g:
+            return
+        if not g.get('metrics_recorded'):
+            self.record_request(500)
+        self.add_gauge('lottery_http_requests_in_flight', -1)
+
+    def record_request(self, status):
+        g.metrics_recorded = True
+        # requests that matched no route share one label, so random URLs don't create new series
+        endpoint = request.endpoint or 'unmatched'
+        self.inc('lottery_http_requests_total', endpoint=endpoint, method=request.method, status=status)
+        self.observe('lottery_http_request_duration_seconds', time.perf_counter() - g.metrics_started,
+                     endpoint=endpoint)
+
+    # FILE STORE
+    def path(self, pid):
+        return os.path.join(self.directory, '%s.json' % pid)
+
+    # Starts the thread that writes this process's metrics, in every process that records any
+    def start(self):
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                # a forked worker starts with the parent's numbers, which the parent reports already
+                if self.pid is not None:
+                    self.counters.clear()
+                    self.gauges.clear()
+                    self.histograms.clear()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.flush_periodically, name='metrics', daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {'pid': os.getpid(),
+                        'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                        'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                        'histograms': [[name, labels, *histogram] for (name, labels), histogram
+                                       in self.histograms.items()]}
+
+        components = []
+        for component, stats in self.collectors:
+            for stat, value in stats().items():
+                if isinstance(value, (int, float)):
+                    components.append([component, stat, value])
+        snapshot['components'] = components
+        return snapshot
+
+    # Replaces this process's file, written to a temporary file first so readers never see half of it
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temporary = self.path(self.pid) + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temporary, self.path(self.pid))
+        except OSError:
+            pass
+
+    # Snapshots of every process, this one read from memory so it's always current
+    def snapshots(self):
+        snapshots = [self.snapshot()]
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            if not name.endswith('.json') or name == '%s.json' % os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    # EXPOSITION
+    # Every process's metrics added up, in the Prometheus text format
+    def render(self):
+        counters = {}
+        gauges = {}
+        histograms = {}
+        components = []
+
+        for snapshot in self.snapshots():
+            alive = snapshot['pid'] == os.getpid() or process_alive(snapshot['pid'])
+
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                histogram = histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+            if alive:
+                for name, labels, value in snapshot['gauges']:
+                    key = (name, tuple(map(tuple, labels)))
+                    gauges[key] = gauges.get(key, 0) + value
+                for component, stat, value in snapshot['components']:
+                    components.append(((('component', component), ('pid', str(snapshot['pid'])), ('stat', stat)),
+                                       value))
+
+        lines = []
+        for family, (kind, description) in FAMILIES.items():
+            lines.append('# HELP %s %s' % (family, description))
+            lines.append('# TYPE %s %s' % (family, kind))
+
+            if kind == 'histogram':
+                for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+                    if name != family:
+                        continue
+                    cumulative = 0
+                    for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                        cumulative += bucket
+                        lines.append('%s_bucket%s %s' % (name, format_labels(labels, [('le', str(bound))]),
+                                                         cumulative))
+                    lines.append('%s_bucket%s %s' % (name, format_labels(labels, [('le', '+Inf')]), count))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+                    lines.append('%s_count%s %s' % (name, format_labels(labels), count))
+            elif family == 'lottery_component_stats':
+                for labels, value in sorted(components):
+                    lines.append('%s%s %s' % (family, format_labels(labels), float(value)))
+            else:
+                values = counters if kind == 'counter' else gauges
+                for (name, labels), value in sorted(values.items()):
+                    if name == family:
+                        lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
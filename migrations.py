@@ -0,0 +1,224 @@
+# IMPORTS
+import argparse
+
+from cryptography.fernet import Fernet
+from sqlalchemy import inspect, select, text, update, or_, not_, LargeBinary, String
+
+from app import db, app
+from crypto import ciphers
+from models import User, Draw, decrypt_many, index_key, index_prefix
+
+
+# Adds every column declared on the models that is missing from an existing table.
+# New columns are added as nullable since SQLite cannot add a NOT NULL column without a default.
+def add_missing_columns():
+    inspector = inspect(db.engine)
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column_type)))
+            added.append('%s.%s' % (table.name, column.name))
+
+    return added
+
+
+# Changes text columns the models now declare as binary to the binary type, keeping their contents. Draw numbers
+# used to be a VARCHAR(100), which PostgreSQL rejects versioned ciphertexts for. SQLite keeps every value with the type
+# it was written with whatever the column declares, so only PostgreSQL columns are altered.
+def convert_binary_columns():
+    if db.engine.dialect.name != 'postgresql':
+        return []
+
+    inspector = inspect(db.engine)
+    converted = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if not isinstance(column.type, LargeBinary) or not isinstance(existing.get(column.name), String):
+                continue
+
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(text("ALTER TABLE %s ALTER COLUMN %s TYPE %s USING convert_to(%s, 'UTF8')"
+                                        % (table.name, column.name, column_type, column.name)))
+            converted.append('%s.%s' % (table.name, column.name))
+
+    return converted
+
+
+# Creates every index declared on the models that is missing from the database
+def create_missing_indexes():
+    inspector = inspect(db.engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+
+    return created
+
+
+# Upgrades an existing database in place: creates missing tables, converts column types, adds missing columns and
+# indexes
+def upgrade_db():
+    with app.app_context():
+        db.create_all()
+        for column in convert_binary_columns():
+            print('Converted column %s to binary' % column)
+        for column in add_missing_columns():
+            print('Added column %s' % column)
+        created = create_missing_indexes()
+        for index in created:
+            print('Created index %s' % index)
+
+        # refresh the planner statistics so SQLite picks the new indexes up
+        if created and db.engine.dialect.name == 'sqlite':
+            with db.engine.begin() as connection:
+                connection.execute(text('ANALYZE'))
+
+
+# Gives users created before symmetric/hybrid encryption their Fernet key and AES data key
+def backfill_user_keys(batch_size):
+    backfilled = 0
+    last_id = 0
+
+    while True:
+        users = (User.query
+                 .options(db.undefer_group('keys'))
+                 .filter(User.id > last_id, or_(User.secret_key.is_(None), User.data_key.is_(None)))
+                 .order_by(User.id)
+                 .limit(batch_size)
+                 .all())
+        if not users:
+            break
+
+        for user in users:
+            if user.secret_key is None:
+                user.secret_key = Fernet.generate_key()
+            if user.data_key is None:
+                user.data_key = ciphers.new_data_key(user.get_public_key())[1]
+        db.session.commit()
+
+        last_id = users[-1].id
+        backfilled += len(users)
+
+    return backfilled
+
+
+# Re-encrypts every draw not yet written with the given cipher, in batches of batch_size draws with one commit each
+def reencrypt_draws(scheme, batch_size):
+    target_version = ciphers.CIPHERS[scheme].version
+    reencrypted = 0
+    last_id = 0
+
+    while True:
+        batch = db.session.execute(
+            select(Draw.id, Draw.user_id, Draw.numbers)
+            .where(Draw.id > last_id)
+            .order_by(Draw.id)
+            .limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        stale = [draw for draw in batch if ciphers.version_of(draw.numbers) != target_version]
+        if not stale:
+            continue
+
+        owners = {user.id: user for user in User.query.options(db.undefer_group('keys'))
+                  .filter(User.id.in_({draw.user_id for draw in stale}))}
+        numbers = decrypt_many((draw.numbers, owners[draw.user_id].key_material()) for draw in stale)
+
+        db.session.execute(
+            update(Draw),
+            [{'id': draw.id, 'numbers': ciphers.encrypt(draw_numbers, owners[draw.user_id], scheme)}
+             for draw, draw_numbers in zip(stale, numbers)]
+        )
+        db.session.commit()
+
+        reencrypted += len(stale)
+        print('Re-encrypted %s draws (up to draw %s)' % (reencrypted, last_id))
+
+    return reencrypted
+
+
+# Writes the index key of every draw that has none under the current DRAW_INDEX mode (or of every draw with
+# rebuild, e.g. after changing DRAW_INDEX_SECRET), in batches of batch_size draws with one commit each
+def backfill_draw_index(batch_size, rebuild=False):
+    prefix = index_prefix()
+    if prefix is None:
+        return 0
+
+    backfilled = 0
+    last_id = 0
+
+    while True:
+        query = select(Draw.id, Draw.user_id, Draw.numbers).where(Draw.id > last_id)
+        if not rebuild:
+            query = query.where(or_(Draw.numbers_key.is_(None), not_(Draw.numbers_key.startswith(prefix))))
+        batch = db.session.execute(query.order_by(Draw.id).limit(batch_size)).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        owners = {user.id: user for user in User.query.options(db.undefer_group('keys'))
+                  .filter(User.id.in_({draw.user_id for draw in batch}))}
+        numbers = decrypt_many((draw.numbers, owners[draw.user_id].key_material()) for draw in batch)
+
+        db.session.execute(
+            update(Draw),
+            [{'id': draw.id, 'numbers_key': index_key(draw_numbers)} for draw, draw_numbers in zip(batch, numbers)]
+        )
+        db.session.commit()
+
+        backfilled += len(batch)
+        print('Indexed %s draws (up to draw %s)' % (backfilled, last_id))
+
+    return backfilled
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upgrade an existing lottery database in place.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('upgrade', help='create missing tables, columns and indexes and convert column types')
+
+    reencrypt = commands.add_parser('reencrypt', help='re-encrypt draws with the configured cipher')
+    reencrypt.add_argument('--cipher', choices=sorted(ciphers.CIPHERS), default=app.config['DRAW_CIPHER'])
+    reencrypt.add_argument('--batch-size', type=int, default=1000)
+
+    backfill_index = commands.add_parser('backfill-index', help='write the index key of draws that have none')
+    backfill_index.add_argument('--batch-size', type=int, default=1000)
+    backfill_index.add_argument('--rebuild', action='store_true', help='recompute the index key of every draw')
+
+    args = parser.parse_args()
+
+    if args.command == 'upgrade':
+        upgrade_db()
+    elif args.command == 'reencrypt':
+        upgrade_db()
+        with app.app_context():
+            print('Backfilled keys of %s users' % backfill_user_keys(args.batch_size))
+            print('Re-encrypted %s draws with %s' % (reencrypt_draws(args.cipher, args.batch_size), args.cipher))
+    elif args.command == 'backfill-index':
+        upgrade_db()
+        with app.app_context():
+            print('Indexed %s draws' % backfill_draw_index(args.batch_size, args.rebuild))
@@ -5,30 +5,97 @@ import bcrypt
 import pyotp
 import rsa
 from cryptography.fernet import Fernet
+from flask import g, has_request_context
 from flask_login import UserMixin
 
-from app import db, app
+from app import db, app, metrics
+from crypto import ciphers
+from crypto.executor import CryptoExecutor
+from crypto.key_cache import KeyCache
+from crypto.key_pool import KeyPool
+from crypto.parallel import DecryptionService
+from lottery import draw_index
 
 
-def encrypt(data, secret_key):
+# Draws are encrypted with the cipher chosen by DRAW_CIPHER (rsa, fernet or hybrid), keys is the owning user (or any
+# object with the same get_*_key methods). Every ciphertext carries its cipher version, so rows written with another
+# cipher still decrypt. The RSA operations run on the crypto executor, the keys are looked up in the calling thread.
+def encrypt(data, keys):
+    metrics.inc('lottery_crypto_operations_total', operation='encrypt')
+    return ciphers.encrypt(data, keys, app.config['DRAW_CIPHER'], crypto_executor.run)
 
-    # Asymmetric encryption
-    return rsa.encrypt(data.encode(), pickle.loads(secret_key))
-    # # Symmetric encryption
-    # return Fernet(secret_key).encrypt(bytes(data, 'utf-8'))
 
+def decrypt(data, keys):
+    metrics.inc('lottery_crypto_operations_total', operation='decrypt')
+    return ciphers.decrypt(data, keys, crypto_executor.run)
 
-def decrypt(data, secret_key):
 
-    # Asymmetric decryption
-    return rsa.decrypt(data, pickle.loads(secret_key)).decode()
-    # # Symmetric decryption
-    # return Fernet(secret_key).decrypt(data).decode('utf-8')
+# Index key of a draw under the configured DRAW_INDEX mode (bitmask, hmac or off), used to look up winners without
+# decrypting every draw
+def index_key(numbers):
+    return draw_index.index_key(numbers, app.config['DRAW_INDEX'], app.config['DRAW_INDEX_SECRET'])
+
+
+# Prefix every current index key starts with, None if indexing is off
+def index_prefix():
+    return draw_index.PREFIXES.get(app.config['DRAW_INDEX'])
+
+
+# bcrypt and RSA work of the request threads, run on a bounded set of threads
+crypto_executor = CryptoExecutor(workers=app.config['CRYPTO_WORKERS'],
+                                 queue_size=app.config['CRYPTO_QUEUE_SIZE'],
+                                 timeout=app.config['CRYPTO_QUEUE_TIMEOUT'],
+                                 # cProfile only sees its own thread, a profiled request keeps its crypto
+                                 inline=lambda: has_request_context() and 'profile' in g)
+
+
+# Unpickled public/private keys and unwrapped data keys of recently active users, keyed by user id
+key_cache = KeyCache(max_size=app.config['KEY_CACHE_SIZE'],
+                     ttl=app.config['KEY_CACHE_TTL'] or None)
+
+
+# Ready RSA key pairs for new users, topped up in the background so registration doesn't search for primes
+key_pool = KeyPool(size=app.config['KEY_POOL_SIZE'],
+                   bits=512,
+                   use_process=app.config['KEY_POOL_PROCESS'],
+                   on_generate=lambda: metrics.inc('lottery_crypto_operations_total', operation='rsa_keygen'))
+
+
+# Decrypts draws in bulk on a process pool, falls back to decrypting in this process for small batches
+decryption_service = DecryptionService(workers=app.config['DECRYPT_WORKERS'],
+                                       min_batch=app.config['DECRYPT_PARALLEL_MIN_BATCH'])
+
+
+# Decrypts a batch of (data, User.key_material()) pairs and returns the plaintexts in the same order
+def decrypt_many(pairs):
+    # the pairs are read here, in the request thread, which has the session and current_user
+    numbers = crypto_executor.run(decryption_service.decrypt, list(pairs))
+    metrics.inc('lottery_crypto_operations_total', len(numbers), operation='decrypt')
+    return numbers
+
+
+# Passwords are hashed with bcrypt at the BCRYPT_ROUNDS work factor
+def hash_password(password):
+    metrics.inc('lottery_crypto_operations_total', operation='bcrypt_hash')
+    return crypto_executor.run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(app.config['BCRYPT_ROUNDS']))
+
+
+# Work factor a bcrypt hash ($2b$12$...) was created with
+def hash_rounds(hashed):
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    return int(hashed.split(b'$')[2])
 
 
 class User(db.Model, UserMixin):
     __tablename__ = 'users'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # Admin listings of every player, one index per sort order so every page is a range of its index
+        db.Index('ix_users_role_registered_on', 'role', 'registered_on', 'id'),
+        db.Index('ix_users_role_current_login', 'role', 'current_login', 'id'),
+        db.Index('ix_users_role_total_logins', 'role', 'total_logins', 'id'),
+        {'extend_existing': True}
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -61,12 +128,18 @@ class User(db.Model, UserMixin):
     # Total number of successful logins
     total_logins = db.Column(db.Integer)
 
-    # # Encryption keys - symmetric encryption
-    # secret_key = db.Column(db.BLOB, nullable=False, default=Fernet.generate_key())
+    # Encryption keys - symmetric encryption (fernet cipher)
+    secret_key = db.Column(db.BLOB, nullable=True)
+
+    # Encryption keys - asymmetric encryption, only loaded by the views that encrypt or decrypt
+    public_key = db.deferred(db.Column(db.BLOB, nullable=False), group='keys')
+    private_key = db.deferred(db.Column(db.BLOB, nullable=False), group='keys')
 
-    # Encryption keys - asymmetric encryption
-    public_key = db.Column(db.BLOB, nullable=False)
-    private_key = db.Column(db.BLOB, nullable=False)
+    # Encryption keys - hybrid encryption, AES data key encrypted with the public key
+    data_key = db.Column(db.BLOB, nullable=True)
+
+    # Bumped by every update of the row, so caches of other processes can tell their copy of the user is stale
+    version = db.Column(db.Integer, nullable=True, default=0)
 
 
     # Define the relationship to Draw
@@ -77,7 +150,7 @@ class User(db.Model, UserMixin):
         self.firstname = firstname
         self.lastname = lastname
         self.phone = phone
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.password = hash_password(password)
         self.role = role
         self.pin_key = pin_key
         self.date_of_birth = date_of_birth
@@ -89,11 +162,42 @@ class User(db.Model, UserMixin):
         self.last_ip = None
         self.total_logins = 0
 
-        # Encryption keys - asymmetric
-        public_key, private_key = rsa.newkeys(512)
+        # Encryption keys - asymmetric, taken from the pre-generated pool (generated on a crypto thread if it's empty)
+        public_key, private_key = crypto_executor.run(key_pool.take)
         self.public_key = pickle.dumps(public_key)
         self.private_key = pickle.dumps(private_key)
 
+        # Encryption keys - symmetric and hybrid
+        self.secret_key = Fernet.generate_key()
+        self.data_key = ciphers.new_data_key(public_key)[1]
+
+    # Unpickled encryption keys, served from the key cache once the user has been saved
+    def get_public_key(self):
+        if self.id is None:
+            return pickle.loads(self.public_key)
+        return key_cache.get(self.id, 'public', lambda: pickle.loads(self.public_key))
+
+    def get_private_key(self):
+        if self.id is None:
+            return pickle.loads(self.private_key)
+        return key_cache.get(self.id, 'private', lambda: pickle.loads(self.private_key))
+
+    def get_secret_key(self):
+        return self.secret_key
+
+    # Unwrapped AES data key, None for users created before hybrid encryption until their keys are backfilled
+    def get_data_key(self):
+        if self.data_key is None:
+            return None
+        if self.id is None:
+            return ciphers.StoredKeys(self.key_material()).get_data_key()
+        return key_cache.get(self.id, 'data',
+                             lambda: crypto_executor.run(rsa.decrypt, self.data_key, self.get_private_key()))
+
+    # Stored keys needed to decrypt this user's draws, in the form the decryption workers take
+    def key_material(self):
+        return self.private_key, self.secret_key, self.data_key
+
     # Return a key to be input to either QR-Code or into the authentication app
     def get_2fa_uri(self):
         return str(pyotp.totp.TOTP(self.pin_key).provisioning_uri(
@@ -103,11 +207,16 @@ class User(db.Model, UserMixin):
 
     # Check if the password is correct
     def verify_password(self, password):
-        return bcrypt.checkpw(password.encode('utf-8'), self.password)
+        metrics.inc('lottery_crypto_operations_total', operation='bcrypt_check')
+        return crypto_executor.run(bcrypt.checkpw, password.encode('utf-8'), self.password)
 
     # Update the password with Hashing :)
     def update_password(self, new_password):
-        self.password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        self.password = hash_password(new_password)
+
+    # True if the password was hashed with another work factor than the configured one
+    def password_needs_rehash(self):
+        return hash_rounds(self.password) != app.config['BCRYPT_ROUNDS']
 
     # Make sure two postcodes are the same (I account for user error for example he adds whitespace/
     # doesn't add the space in between or uses lowercase characters
@@ -121,17 +230,49 @@ class User(db.Model, UserMixin):
         return pyotp.TOTP(self.pin_key).verify(submitted_pin)
 
 
+# Drop cached keys whenever a user's keys are replaced or the user is deleted
+@db.event.listens_for(User.public_key, 'set')
+@db.event.listens_for(User.private_key, 'set')
+@db.event.listens_for(User.data_key, 'set')
+def invalidate_keys(target, value, oldvalue, initiator):
+    if target.id is not None:
+        key_cache.invalidate(target.id)
+
+
+@db.event.listens_for(User, 'after_delete')
+def invalidate_deleted_keys(mapper, connection, target):
+    key_cache.invalidate(target.id)
+
+
+# Bump the version of every user that is changed, in SQL so concurrent updates never end on the same version
+@db.event.listens_for(User, 'before_update')
+def bump_version(mapper, connection, target):
+    if db.session.is_modified(target, include_collections=False):
+        target.version = db.func.coalesce(User.version, 0) + 1
+
+
 class Draw(db.Model):
     __tablename__ = 'draws'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # A player's playable/played draws (lottery views)
+        db.Index('ix_draws_user_id_been_played', 'user_id', 'been_played'),
+        # Master draw lookups and unplayed user draws in id order (admin views, settlement)
+        db.Index('ix_draws_master_draw_been_played', 'master_draw', 'been_played'),
+        # Prize tiers of a round
+        db.Index('ix_draws_lottery_round_match_count', 'lottery_round', 'match_count'),
+        {'extend_existing': True}
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
     # ID of user who submitted draw
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
 
-    # 6 draw numbers submitted
-    numbers = db.Column(db.String(100), nullable=False)
+    # 6 draw numbers submitted, stored as the versioned ciphertext of the cipher that wrote them
+    numbers = db.Column(db.LargeBinary, nullable=False)
+
+    # Compact, indexed form of the numbers (packed bitmask or keyed digest of it), None if indexing is off
+    numbers_key = db.Column(db.String(66), nullable=True, index=True)
 
     # Draw has already been played (can only play draw once)
     been_played = db.Column(db.BOOLEAN, nullable=False, default=False)
@@ -139,24 +280,150 @@ class Draw(db.Model):
     # Draw matches with master draw created by admin (True = draw is a winner)
     matches_master = db.Column(db.BOOLEAN, nullable=False, default=False)
 
+    # Number of balls the draw shares with the master draw once played (prize tier), None until then
+    match_count = db.Column(db.SmallInteger, nullable=True)
+
     # True = draw is master draw created by admin. User draws are matched to master draw
     master_draw = db.Column(db.BOOLEAN, nullable=False)
 
     # Lottery round that draw is used
     lottery_round = db.Column(db.Integer, nullable=False, default=0)
 
-    def __init__(self, user_id, numbers, master_draw, lottery_round, secret_key):
+    def __init__(self, user_id, numbers, master_draw, lottery_round, keys):
         self.user_id = user_id
-        # Secret key for symmetric/Public key in the case os asymmetric encryption
-        self.numbers = encrypt(numbers, secret_key)
+        # Keys of the owning user, the configured cipher decides which one is used
+        self.numbers = encrypt(numbers, keys)
+        self.numbers_key = index_key(numbers)
         self.been_played = False
         self.matches_master = False
         self.master_draw = master_draw
         self.lottery_round = lottery_round
 
-    def view_draw(self, secret_key):
-        # Secret key for symmetric/Private key in the case os asymmetric decryption
-        self.numbers = decrypt(self.numbers, secret_key)
+    def view_draw(self, keys):
+        # Keys of the owning user, the cipher version stored with the draw decides which one is used
+        self.numbers = decrypt(self.numbers, keys)
+
+
+class LotteryJob(db.Model):
+    __tablename__ = 'lottery_jobs'
+    __table_args__ = {'extend_existing': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Master draw being settled, no foreign key since generating a new winning draw deletes the old one
+    master_draw_id = db.Column(db.Integer, nullable=False)
+    lottery_round = db.Column(db.Integer, nullable=False)
+
+    # Only user draws with an id up to this one take part in the round, later draws wait for the next round
+    upto_draw_id = db.Column(db.Integer, nullable=False)
+
+    # queued, running, finished or failed
+    status = db.Column(db.String(20), nullable=False, default='queued')
+
+    # Progress, updated in the same transaction as every settled chunk so a resumed job carries on where it stopped
+    total_draws = db.Column(db.Integer, nullable=False, default=0)
+    draws_processed = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.Integer, nullable=False, default=0)
+    last_draw_id = db.Column(db.Integer, nullable=False, default=0)
+
+    # Worker process currently running the job, for information only: whether it's still running is decided by heartbeat
+    pid = db.Column(db.Integer, nullable=True)
+    # Lease on the job, renewed in every settled chunk's transaction. A job whose heartbeat is older than
+    # JOB_LEASE_SECONDS has no worker and can be resumed.
+    heartbeat = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+
+    created_on = db.Column(db.DateTime, nullable=False)
+    started_on = db.Column(db.DateTime, nullable=True)
+    finished_on = db.Column(db.DateTime, nullable=True)
+
+    def __init__(self, master_draw_id, lottery_round, upto_draw_id, total_draws):
+        self.master_draw_id = master_draw_id
+        self.lottery_round = lottery_round
+        self.upto_draw_id = upto_draw_id
+        self.status = 'queued'
+        self.total_draws = total_draws
+        self.draws_processed = 0
+        self.winners = 0
+        self.last_draw_id = 0
+        self.created_on = datetime.now()
+        # the request creating the job holds its lease until the worker it starts claims it
+        self.heartbeat = self.created_on
+
+    @property
+    def is_finished(self):
+        return self.status in ('finished', 'failed')
+
+    # Draws settled per second since the worker started
+    @property
+    def throughput(self):
+        if not self.started_on:
+            return 0.0
+        elapsed = ((self.finished_on or datetime.now()) - self.started_on).total_seconds()
+        if elapsed <= 0:
+            return 0.0
+        return self.draws_processed / elapsed
+
+    # True if the job isn't finished and its worker stopped renewing the lease
+    @property
+    def is_stalled(self):
+        return not self.is_finished and (self.heartbeat is None or (datetime.now() - self.heartbeat).total_seconds()
+                                         > app.config['JOB_LEASE_SECONDS'])
+
+    def to_dict(self):
+        return {'id': self.id,
+                'lottery_round': self.lottery_round,
+                'status': self.status,
+                'total_draws': self.total_draws,
+                'draws_processed': self.draws_processed,
+                'winners': self.winners,
+                'throughput': round(self.throughput, 1),
+                'stalled': self.is_stalled,
+                'error': self.error}
+
+
+class SecurityEvent(db.Model):
+    __tablename__ = 'security_events'
+    __table_args__ = (
+        # Events of one kind, from one IP or against one account over time
+        db.Index('ix_security_events_event_created_on', 'event', 'created_on'),
+        db.Index('ix_security_events_ip_created_on', 'ip', 'created_on'),
+        db.Index('ix_security_events_email_created_on', 'email', 'created_on'),
+        {'extend_existing': True}
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # login, logout, invalid_login, unauthorized or registration
+    event = db.Column(db.String(20), nullable=False)
+    created_on = db.Column(db.DateTime, nullable=False)
+
+    # Who and where from, as far as known when the event was logged
+    user_id = db.Column(db.Integer, nullable=True)
+    email = db.Column(db.String(100), nullable=True)
+    ip = db.Column(db.String(45), nullable=True)
+
+
+# Number of security events of each kind per minute, kept up to date as events are stored
+class SecurityEventCount(db.Model):
+    __tablename__ = 'security_event_counts'
+    __table_args__ = {'extend_existing': True}
+
+    minute = db.Column(db.DateTime, primary_key=True)
+    event = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Number of failed logins and unauthorized access attempts per hour from an IP (kind 'ip') or against an account
+# (kind 'email'), kept up to date as events are stored
+class SecurityOffenderCount(db.Model):
+    __tablename__ = 'security_offender_counts'
+    __table_args__ = {'extend_existing': True}
+
+    hour = db.Column(db.DateTime, primary_key=True)
+    kind = db.Column(db.String(5), primary_key=True)
+    value = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 
 def init_db():
@@ -0,0 +1,130 @@
+# IMPORTS
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Queries a single request ran
+class RequestQueries:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # statement -> number of times it ran, to spot the same query running once per row of an earlier one
+        self.statements = Counter()
+        # (seconds, statement) of the slowest query
+        self.slowest = (0.0, None)
+        # (seconds, statement) of every query over the slow threshold
+        self.slow = []
+
+    def add(self, statement, seconds, slow_seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+        if seconds > self.slowest[0]:
+            self.slowest = (seconds, statement)
+        if seconds >= slow_seconds:
+            self.slow.append((seconds, statement))
+
+
+# Totals of the sampled requests to one endpoint
+class EndpointQueries:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries = 0
+
+    def to_dict(self):
+        return {'requests': self.requests,
+                'queries': self.queries,
+                'avg_queries': self.queries / self.requests if self.requests else 0.0,
+                'max_queries': self.max_queries,
+                'avg_ms': self.seconds * 1000 / self.requests if self.requests else 0.0}
+
+
+# Counts and times the queries of every sampled request through SQLAlchemy engine events, instead of echoing every
+# statement to the log. Keeps per endpoint totals, the latest slow queries and the latest requests that ran the same
+# statement at least n_plus_one times (an N+1 pattern: one query per row of an earlier query), for this process. In
+# debug mode every profiled response also gets an X-Query-Stats header with the counts of its request.
+# sample_rate: share of requests profiled, 0 turns profiling off
+# slow_ms: queries taking at least this long are recorded as slow
+class QueryProfiler:
+    # Slow queries and N+1 suspects kept for the admin page
+    history = 50
+
+    def __init__(self, sample_rate=1.0, slow_ms=100, n_plus_one=10):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_ms / 1000
+        self.n_plus_one = n_plus_one
+
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        # (time, endpoint, milliseconds, statement)
+        self.slow_queries = deque(maxlen=self.history)
+        # (time, endpoint, times run, statement)
+        self.n_plus_one_suspects = deque(maxlen=self.history)
+
+    def init_app(self, app):
+        if not self.sample_rate:
+            return
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def start_request(self):
+        g.query_stats = RequestQueries() if random.random() < self.sample_rate else None
+
+    # Queries outside a sampled request (worker processes, background threads) aren't timed
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and g.get('query_stats') is not None:
+            context.query_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'query_started', None)
+        if started is not None and has_request_context() and g.get('query_stats') is not None:
+            g.query_stats.add(statement, time.perf_counter() - started, self.slow_seconds)
+
+    def finish_request(self, response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        endpoint = request.endpoint or request.path
+        now = datetime.now()
+        repeated = [(count, statement) for statement, count in stats.statements.items() if count >= self.n_plus_one]
+
+        with self.lock:
+            totals = self.endpoints.setdefault(endpoint, EndpointQueries())
+            totals.requests += 1
+            totals.queries += stats.count
+            totals.seconds += stats.seconds
+            totals.max_queries = max(totals.max_queries, stats.count)
+
+            for seconds, statement in stats.slow:
+                self.slow_queries.appendleft((now, endpoint, seconds * 1000, statement))
+            for count, statement in repeated:
+                self.n_plus_one_suspects.appendleft((now, endpoint, count, statement))
+
+        if current_app.debug:
+            response.headers['X-Query-Stats'] = 'count=%s; total_ms=%.1f; slowest_ms=%.1f' % (
+                stats.count, stats.seconds * 1000, stats.slowest[0] * 1000)
+        return response
+
+    # Per endpoint totals, busiest first
+    def endpoint_stats(self):
+        with self.lock:
+            return sorted(((endpoint, totals.to_dict()) for endpoint, totals in self.endpoints.items()),
+                          key=lambda item: item[1]['queries'], reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.slow_queries.clear()
+            self.n_plus_one_suspects.clear()
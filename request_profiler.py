@@ -0,0 +1,159 @@
+# IMPORTS
+import cProfile
+import json
+import os
+import pstats
+import random
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from flask import g, request
+
+# A saved profile: when the request finished, its endpoint, how long it took and the file it was saved to
+Profile = namedtuple('Profile', ['time', 'endpoint', 'milliseconds', 'name'])
+
+# A function of a profile: calls, seconds spent in the function itself and in it and everything it called
+FunctionStats = namedtuple('FunctionStats', ['function', 'calls', 'total_seconds', 'cumulative_seconds'])
+
+
+# Shortens a pstats function key (file, line, name) to "package/module.py:line(name)"
+def function_name(key):
+    filename, line, name = key
+    if filename == '~':
+        return name
+    return '%s:%s(%s)' % ('/'.join(filename.split(os.sep)[-2:]), line, name)
+
+
+# Profiles requests with cProfile and saves every profile to directory, keeping the newest keep of them.
+# Requests to the endpoints in routes are always profiled, other requests with probability sample_rate. Both can be
+# changed from the admin page while the server runs: the settings are written to a file in directory, which every
+# worker process checks for changes every few seconds. While nothing is profiled a request only pays for a clock read
+# and two attribute checks.
+class RequestProfiler:
+    # Seconds between checks of the settings file
+    refresh_interval = 5.0
+
+    def __init__(self, directory, routes=(), sample_rate=0.0, keep=100):
+        self.directory = directory
+        self.routes = frozenset(routes)
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.settings_mtime = None
+        self.next_refresh = 0.0
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+
+    def settings_path(self):
+        return os.path.join(self.directory, 'settings.json')
+
+    # Picks up settings changed from the admin page, in any process
+    def refresh(self):
+        now = time.monotonic()
+        if now < self.next_refresh:
+            return
+        self.next_refresh = now + self.refresh_interval
+
+        try:
+            mtime = os.stat(self.settings_path()).st_mtime
+        except OSError:
+            return
+        if mtime != self.settings_mtime:
+            try:
+                with open(self.settings_path()) as f:
+                    settings = json.load(f)
+            except (OSError, ValueError):
+                return
+            self.settings_mtime = mtime
+            self.routes = frozenset(settings.get('routes', ()))
+            self.sample_rate = float(settings.get('sample_rate', 0))
+
+    # Saves new settings for every process, this one uses them straight away
+    def configure(self, routes, sample_rate):
+        self.routes = frozenset(routes)
+        self.sample_rate = sample_rate
+
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self.settings_path() + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'routes': sorted(self.routes), 'sample_rate': sample_rate}, f)
+        os.replace(temporary, self.settings_path())
+        self.settings_mtime = os.stat(self.settings_path()).st_mtime
+
+    def start_request(self):
+        self.refresh()
+        if not self.routes and not self.sample_rate:
+            return
+        if request.endpoint in self.routes or (self.sample_rate and random.random() < self.sample_rate):
+            g.profile_started = time.perf_counter()
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    def finish_request(self, response):
+        self.stop()
+        return response
+
+    # Requests that raised never reach after_request, their profile is stopped and saved here so cProfile isn't left
+    # running in the thread
+    def teardown_request(self, error):
+        self.stop()
+
+    def stop(self):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+
+        milliseconds = (time.perf_counter() - g.profile_started) * 1000
+        try:
+            self.save(profile, request.endpoint or 'unmatched', milliseconds)
+        except OSError:
+            pass
+
+    # Profiles are named <unix time>_<pid>_<endpoint>_<milliseconds>.prof
+    def save(self, profile, endpoint, milliseconds):
+        os.makedirs(self.directory, exist_ok=True)
+        name = '%.6f_%s_%s_%.0f.prof' % (time.time(), os.getpid(), endpoint, milliseconds)
+        profile.dump_stats(os.path.join(self.directory, name))
+
+        for old in self.profiles()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, old.name))
+            except OSError:
+                pass
+
+    # Saved profiles, newest first, optionally only those of one endpoint
+    def profiles(self, endpoint=None):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        profiles = []
+        for name in names:
+            if not name.endswith('.prof'):
+                continue
+            try:
+                created, _, rest = name[:-len('.prof')].split('_', 2)
+                profile_endpoint, milliseconds = rest.rsplit('_', 1)
+                profile = Profile(datetime.fromtimestamp(float(created)), profile_endpoint, int(milliseconds), name)
+            except ValueError:
+                continue
+            if endpoint is None or profile.endpoint == endpoint:
+                profiles.append(profile)
+        return sorted(profiles, reverse=True)
+
+    # The count functions with the most cumulative time over the given profiles together
+    def top_functions(self, profiles, count=30):
+        paths = [os.path.join(self.directory, profile.name) for profile in profiles]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            return []
+
+        stats = pstats.Stats(*paths)
+        functions = [FunctionStats(function_name(key), calls, total, cumulative)
+                     for key, (_, calls, total, cumulative, _) in stats.stats.items()]
+        return sorted(functions, key=lambda function: function.cumulative_seconds, reverse=True)[:count]
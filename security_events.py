@@ -0,0 +1,130 @@
+# IMPORTS
+import logging.handlers
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db, app
+from models import SecurityEvent, SecurityEventCount, SecurityOffenderCount
+
+# Events that count against the IP they come from and the account they target
+OFFENCES = ('invalid_login', 'unauthorized')
+
+
+def to_row(record):
+    return {'event': record.event,
+            'created_on': datetime.fromtimestamp(record.created),
+            'user_id': getattr(record, 'user_id', None),
+            'email': record.email[:100] if getattr(record, 'email', None) else None,
+            'ip': getattr(record, 'ip', None)}
+
+
+# Adds counts to the counter rows with the given keys, creating the rows that don't exist yet
+def add_counts(connection, table, keys, counts):
+    if not counts:
+        return
+
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(table)
+    statement = statement.on_conflict_do_update(index_elements=keys,
+                                                set_={'count': table.c['count'] + statement.excluded['count']})
+    connection.execute(statement, counts)
+
+
+# Stores a batch of events and adds them to the per-minute and per-offender counts in the same transaction
+def store_events(rows):
+    per_minute = Counter((row['created_on'].replace(second=0, microsecond=0), row['event']) for row in rows)
+
+    offenders = Counter()
+    for row in rows:
+        if row['event'] in OFFENCES:
+            hour = row['created_on'].replace(minute=0, second=0, microsecond=0)
+            if row['ip']:
+                offenders[hour, 'ip', row['ip']] += 1
+            if row['email']:
+                offenders[hour, 'email', row['email']] += 1
+
+    with app.app_context(), db.engine.begin() as connection:
+        connection.execute(insert(SecurityEvent.__table__), rows)
+        add_counts(connection, SecurityEventCount.__table__, ['minute', 'event'],
+                   [{'minute': minute, 'event': event, 'count': count}
+                    for (minute, event), count in per_minute.items()])
+        add_counts(connection, SecurityOffenderCount.__table__, ['hour', 'kind', 'value'],
+                   [{'hour': hour, 'kind': kind, 'value': value, 'count': count}
+                    for (hour, kind, value), count in offenders.items()])
+
+
+# Collects the security events handed to the security log (records logged with an event field) and writes them to the
+# database in batches: whenever capacity events are waiting, and every interval seconds otherwise.
+class SecurityEventHandler(logging.handlers.BufferingHandler):
+    def __init__(self, capacity=100, interval=5.0):
+        super().__init__(capacity)
+        self.interval = interval
+        self.thread = threading.Thread(target=self.flush_periodically, name='security-events', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        if getattr(record, 'event', None) is not None:
+            super().emit(record)
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                store_events([to_row(record) for record in self.buffer])
+                self.buffer = []
+        except Exception:
+            logging.getLogger(__name__).exception('Could not store %s security events', len(self.buffer))
+            # keep the batch for the next flush, but don't grow without bound while the database is unavailable
+            self.buffer = self.buffer[-self.capacity * 10:]
+        finally:
+            self.release()
+
+
+# Events per minute over the last minutes, newest first, as (minute, {event: count})
+def events_per_minute(minutes=60):
+    since = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=minutes - 1)
+    per_minute = {}
+    for minute, event, count in db.session.execute(
+            select(SecurityEventCount.minute, SecurityEventCount.event, SecurityEventCount.count)
+            .where(SecurityEventCount.minute >= since)
+            .order_by(SecurityEventCount.minute.desc())):
+        per_minute.setdefault(minute, {})[event] = count
+    return list(per_minute.items())
+
+
+# IPs (kind 'ip') or accounts (kind 'email') with the most failed logins and unauthorized access attempts over the
+# last hours, as (value, count)
+def top_offenders(kind, hours=24, limit=10):
+    since = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    total = func.sum(SecurityOffenderCount.count)
+    return db.session.execute(
+        select(SecurityOffenderCount.value, total)
+        .where(SecurityOffenderCount.kind == kind, SecurityOffenderCount.hour >= since)
+        .group_by(SecurityOffenderCount.value)
+        .order_by(total.desc())
+        .limit(limit)
+    ).all()
+
+
+# Failed and successful logins over the last minutes, and failed logins per successful one (None without any)
+def login_ratio(minutes=60):
+    since = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=minutes - 1)
+    counts = dict(db.session.execute(
+        select(SecurityEventCount.event, func.sum(SecurityEventCount.count))
+        .where(SecurityEventCount.minute >= since, SecurityEventCount.event.in_(('invalid_login', 'login')))
+        .group_by(SecurityEventCount.event)
+    ).all())
+
+    failed = counts.get('invalid_login', 0)
+    successful = counts.get('login', 0)
+    return failed, successful, (failed / successful if successful else None)
@@ -0,0 +1,119 @@
+# IMPORTS
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from datetime import datetime
+
+# Fields call sites pass with extra={...}, written as their own keys in the JSON lines format
+STRUCTURED_FIELDS = ('event', 'user_id', 'email', 'role', 'ip')
+
+
+# Get our filter, we only want messages that start with the word SECURITY.
+# Checks the unformatted message, so records that are dropped are never formatted.
+class SecurityFilter(logging.Filter):
+    def filter(self, record):
+        return isinstance(record.msg, str) and record.msg.startswith('SECURITY')
+
+
+# One JSON object per line, so tooling can read entries without parsing the text format
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='seconds'),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+# Rotated files are gzipped: lottery.log.1.gz, lottery.log.2026-01-01.gz
+def compressed_name(name):
+    return name + '.gz'
+
+
+def compress(source, destination):
+    with open(source, 'rb') as f, gzip.open(destination, 'wb') as compressed:
+        shutil.copyfileobj(f, compressed)
+    os.remove(source)
+
+
+# File handler for the security log.
+# rotate: 'size' rolls over at max_bytes, 'time' at every when interval (e.g. midnight), 'external' leaves rotation to
+# another tool (logrotate) and reopens the file once it has been moved, 'off' never.
+# Only one process may rotate a log file: processes rotating the same file race each other, lose records and break
+# the offset index of the log viewer.
+def file_handler(path, rotate='size', max_bytes=10 * 1024 * 1024, backup_count=10, when='midnight',
+                 compressed=False):
+    if rotate == 'size':
+        handler = logging.handlers.RotatingFileHandler(path, 'a', maxBytes=max_bytes, backupCount=backup_count,
+                                                       delay=True)
+    elif rotate == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, delay=True)
+    elif rotate == 'external':
+        handler = logging.handlers.WatchedFileHandler(path, 'a', delay=True)
+    else:
+        handler = logging.FileHandler(path, 'a', delay=True)
+
+    if compressed and rotate in ('size', 'time'):
+        handler.namer = compressed_name
+        handler.rotator = compress
+
+    return handler
+
+
+# Routes security records through a queue: the request thread only puts the record on the queue, a background
+# thread formats it and writes it to the file. Returns the listener, which is stopped (and the queue flushed) at exit.
+# With more than one SERVER_WORKERS process writing the file, rotation is left to an external tool.
+def configure_logging(config):
+    rotate = config['LOG_ROTATE']
+    if config['SERVER_WORKERS'] > 1 and rotate in ('size', 'time'):
+        logging.getLogger(__name__).warning('LOG_ROTATE=%s with %s worker processes, rotate %s externally (e.g. '
+                                            'logrotate) instead', rotate, config['SERVER_WORKERS'], config['LOG_FILE'])
+        rotate = 'external'
+
+    handler = file_handler(config['LOG_FILE'],
+                           rotate=rotate,
+                           max_bytes=config['LOG_MAX_BYTES'],
+                           backup_count=config['LOG_BACKUP_COUNT'],
+                           when=config['LOG_ROTATE_WHEN'],
+                           compressed=config['LOG_COMPRESS'])
+
+    # How we want our logs formatted
+    if config['LOG_FORMAT'] == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p'))
+
+    # Only security warnings are queued, everything else is dropped on the calling thread
+    queue_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+    queue_handler.setLevel(logging.WARNING)
+    queue_handler.addFilter(SecurityFilter())
+
+    # Our general logger
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    listener.start()
+
+    # flush whatever is still queued when the process exits, unless the listener was stopped already
+    @atexit.register
+    def stop_listener():
+        if listener._thread is not None:
+            listener.stop()
+        for listener_handler in listener.handlers:
+            listener_handler.flush()
+
+    return listener
+
+
+# Hands every security record to another handler as well, on the listener's thread
+def add_handler(listener, handler):
+    listener.handlers = listener.handlers + (handler,)
@@ -0,0 +1,70 @@
+# Production entry point:  python serve.py
+# Serves the app with Werkzeug's threaded server in a single process, or with gunicorn, SERVER_WORKERS processes of
+# SERVER_THREADS threads each, when SERVER_BACKEND is gunicorn and it's installed. Settings are read from .env.
+# TLS is on while TLS_CERT and TLS_KEY are set, leave them empty behind a proxy that terminates TLS. With more than one
+# worker process the security log isn't rotated by the app (LOG_ROTATE=external), rotate it with logrotate.
+import logging
+import os
+
+from dotenv import load_dotenv
+
+# Load up our .env file
+load_dotenv()
+
+BACKEND = os.environ.get('SERVER_BACKEND', 'werkzeug')
+HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+PORT = int(os.environ.get('SERVER_PORT', 5000))
+WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+THREADS = int(os.environ.get('SERVER_THREADS', 8))
+TIMEOUT = int(os.environ.get('SERVER_TIMEOUT', 30))
+TLS_CERT = os.environ.get('TLS_CERT', 'cert.pem')
+TLS_KEY = os.environ.get('TLS_KEY', 'key.pem')
+
+
+def serve_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '%s:%s' % (HOST, PORT))
+            self.cfg.set('workers', WORKERS)
+            self.cfg.set('threads', THREADS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', TIMEOUT)
+            if TLS_CERT and TLS_KEY:
+                self.cfg.set('certfile', TLS_CERT)
+                self.cfg.set('keyfile', TLS_KEY)
+
+        # Every worker imports the app after it has been forked: importing it starts threads (security log writer,
+        # metrics, key pool) that a forked process wouldn't have
+        def load(self):
+            from app import app
+            return app
+
+    # the app leaves log rotation to an external tool when more than one process writes the log
+    os.environ['SERVER_WORKERS'] = str(WORKERS)
+    Server().run()
+
+
+# One process, one thread per request
+def serve_werkzeug():
+    from werkzeug.serving import run_simple
+
+    os.environ['SERVER_WORKERS'] = '1'
+    from app import app
+
+    run_simple(HOST, PORT, app, threaded=True, ssl_context=(TLS_CERT, TLS_KEY) if TLS_CERT and TLS_KEY else None)
+
+
+if __name__ == '__main__':
+    if BACKEND == 'gunicorn':
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            logging.warning('gunicorn is not installed, serving with Werkzeug in a single process')
+            BACKEND = 'werkzeug'
+
+    if BACKEND == 'gunicorn':
+        serve_gunicorn()
+    else:
+        serve_werkzeug()
@@ -0,0 +1,34 @@
+// JavaScript function to poll the progress of a running lottery round and reload the page once it has finished
+window.addEventListener('load', function () {
+
+    // Get Elements from the HTML document
+    let job = document.getElementById('lottery-job');
+
+    // Nothing to poll if the round has already finished, or its worker stopped
+    if (job.dataset.finished === 'true') {
+        return;
+    }
+
+    function poll() {
+        fetch(job.dataset.statusUrl, {credentials: 'same-origin'})
+            .then(function (response) {
+                return response.json();
+            })
+            .then(function (status) {
+                document.getElementById('lottery-job-status').textContent = status.status;
+                document.getElementById('lottery-job-processed').textContent = status.draws_processed;
+                document.getElementById('lottery-job-winners').textContent = status.winners;
+                document.getElementById('lottery-job-throughput').textContent = Math.round(status.throughput);
+
+                // Reload to show the winners once the round is finished, or the resume button if its worker stopped,
+                // otherwise poll again
+                if (status.status === 'finished' || status.status === 'failed' || status.stalled) {
+                    window.location.reload();
+                } else {
+                    setTimeout(poll, 1000);
+                }
+            });
+    }
+
+    setTimeout(poll, 1000);
+});
@@ -0,0 +1,127 @@
+# IMPORTS
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db, app
+from models import User
+
+
+# Column values of recently seen users, so loading current_user on every request only looks up the user's version
+# instead of loading the whole row. Entries are dropped as soon as a user is updated or deleted by this process, and
+# are only used while their version is still the one in the database, so changes made by other worker processes (a
+# demoted admin, a changed password) apply from their next request. Entries live for ttl seconds at most.
+class IdentityCache:
+    # max_size: number of users kept before the least recently used one is evicted
+    # ttl: seconds a user stays cached, 0 turns the cache off
+    def __init__(self, max_size=1024, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user id -> (column values, expiry time)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale = 0
+        self.version_checks = 0
+
+    # Column values worth caching, the deferred key columns are left out even when they were loaded
+    def snapshot(self, user):
+        loaded = inspect(user).dict
+        return {column.key: loaded[column.key] for column in User.__mapper__.column_attrs
+                if column.key in loaded and not column.deferred}
+
+    # User with the given id, attached to the current session. Built from the cached column values when possible,
+    # any column that wasn't cached is loaded from the database the first time it's used.
+    def load(self, user_id):
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] <= now:
+                del self.entries[user_id]
+                self.expirations += 1
+                entry = None
+
+        # the cached copy is only used if no process has changed the user since it was cached
+        if entry is not None:
+            version = db.session.execute(select(User.version).where(User.id == user_id)).first()
+            with self.lock:
+                self.version_checks += 1
+            if version is None or version[0] != entry[0].get('version'):
+                with self.lock:
+                    if self.entries.pop(user_id, None) is not None:
+                        self.stale += 1
+                entry = None
+
+        if entry is not None:
+            with self.lock:
+                if user_id in self.entries:
+                    self.entries.move_to_end(user_id)
+                self.hits += 1
+
+            user = User.__mapper__.class_manager.new_instance()
+            # set as loaded values, without the attribute events a change of the user would fire
+            for key, value in entry[0].items():
+                set_committed_value(user, key, value)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+
+        with self.lock:
+            self.misses += 1
+        user = db.session.get(User, user_id)
+        if user is not None and self.ttl:
+            with self.lock:
+                self.entries[user_id] = (self.snapshot(user), now + self.ttl)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self.lock:
+            if self.entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations,
+                    'stale': self.stale,
+                    # every cached entry served or found stale cost one query for the user's version, every request
+                    # still makes a round trip to the database
+                    'version_checks': self.version_checks,
+                    # every hit is a full users row (and its ORM load) replaced by that version lookup
+                    'rows_avoided': self.hits,
+                    'rows_avoided_per_request': self.hits / lookups if lookups else 0.0}
+
+
+identity_cache = IdentityCache(max_size=app.config['IDENTITY_CACHE_SIZE'],
+                               ttl=app.config['IDENTITY_CACHE_TTL'])
+
+
+# Logging in, changing the password and changing the role all update the user's row, drop the cached copy whenever
+# that happens so the next request sees the change
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def invalidate_identity(mapper, connection, target):
+    identity_cache.invalidate(target.id)
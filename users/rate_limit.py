@@ -0,0 +1,190 @@
+# IMPORTS
+import os
+import sqlite3
+import threading
+import time
+
+from app import app
+
+
+# Token buckets of this process only
+class MemoryBuckets:
+    # Buckets kept before fully refilled ones are dropped
+    max_size = 10000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.buckets.get(key)
+
+    # Replaces the buckets of keys with change(buckets) in one step, change returns the new buckets or None to leave
+    # them as they are
+    def update(self, keys, change):
+        with self.lock:
+            buckets = change([self.buckets.get(key) for key in keys])
+            if buckets is not None:
+                self.buckets.update(zip(keys, buckets))
+
+    def delete(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+
+    def prune(self, before):
+        if len(self.buckets) < self.max_size:
+            return
+        with self.lock:
+            for key in [key for key, (tokens, updated) in self.buckets.items() if updated < before]:
+                del self.buckets[key]
+
+
+# Token buckets in an SQLite file, shared by every worker process on the machine
+class SQLiteBuckets:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    # One connection per thread, in autocommit mode so transactions are explicit
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        return self.connection().execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+
+    # BEGIN IMMEDIATE takes the write lock before reading, so concurrent updates of the buckets never lose a token
+    def update(self, keys, change):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            buckets = change([connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?',
+                                                 (key,)).fetchone() for key in keys])
+            if buckets is not None:
+                connection.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                                       [(key, *bucket) for key, bucket in zip(keys, buckets)])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM buckets WHERE key = ?', (key,))
+
+    def prune(self, before):
+        self.connection().execute('DELETE FROM buckets WHERE updated < ?', (before,))
+
+
+# Token bucket rate limiter. Every key has a bucket of capacity tokens that refills completely over window seconds,
+# every attempt takes one token and attempts are rejected while a bucket has less than one token left.
+class RateLimiter:
+    # Attempts between removing buckets that have refilled completely
+    prune_every = 1000
+
+    def __init__(self, buckets, window):
+        self.buckets = buckets
+        self.window = window
+
+        # Counters exposed through stats()
+        self.checks = 0
+        self.rejected = 0
+        self.hits = 0
+        self.refunds = 0
+
+    # Tokens left in a bucket (tokens, updated) once it has been refilled up to now
+    def level(self, bucket, capacity, now):
+        if bucket is None:
+            return capacity
+        tokens, updated = bucket
+        return min(capacity, tokens + (now - updated) * capacity / self.window)
+
+    # Seconds until every bucket of limits, a list of (key, capacity), with the given levels has a token left, 0 if
+    # none is empty
+    def wait(self, levels, limits):
+        wait = 0
+        for tokens, (key, capacity) in zip(levels, limits):
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) * self.window / capacity)
+        return wait
+
+    # Seconds until every bucket of limits has a token left, 0 if none is empty
+    def retry_after(self, limits):
+        now = time.time()
+        return self.wait([self.level(self.buckets.get(key), capacity, now) for key, capacity in limits], limits)
+
+    # Takes a token from every bucket of limits in one step, before any work is done for the request, so concurrent
+    # attempts can't all pass a check before any of them is counted. Nothing is taken if a bucket is empty.
+    # Returns (seconds until the attempt would be allowed, 0 if it was, whole tokens left in the emptiest bucket).
+    def acquire(self, limits):
+        self.checks += 1
+        now = time.time()
+        result = {}
+
+        def take(buckets):
+            levels = [self.level(bucket, capacity, now) for bucket, (key, capacity) in zip(buckets, limits)]
+            result['wait'] = self.wait(levels, limits)
+            result['remaining'] = min(levels) - (0 if result['wait'] else 1)
+            if result['wait']:
+                return None
+            return [(tokens - 1, now) for tokens in levels]
+
+        self.buckets.update([key for key, capacity in limits], take)
+        if result['wait']:
+            self.rejected += 1
+        else:
+            self.hits += 1
+            if self.hits % self.prune_every == 0:
+                self.buckets.prune(now - self.window)
+        return result['wait'], max(int(result['remaining']), 0)
+
+    # Gives back the tokens taken by acquire, for attempts that turned out not to count
+    def refund(self, limits):
+        self.refunds += 1
+        now = time.time()
+
+        def give(buckets):
+            return [(min(capacity, self.level(bucket, capacity, now) + 1), now)
+                    for bucket, (key, capacity) in zip(buckets, limits)]
+
+        self.buckets.update([key for key, capacity in limits], give)
+
+    def reset(self, key):
+        self.buckets.delete(key)
+
+    def stats(self):
+        return {'checks': self.checks,
+                'rejected': self.rejected,
+                'hits': self.hits,
+                'refunds': self.refunds,
+                # every rejected login is a password check (and user lookup and TOTP check) that didn't run
+                'hashes_saved': self.rejected,
+                # BCRYPT_CHECK_MS is what one password check takes, as calibrated by benchmarks/bcrypt_cost.py
+                'hash_seconds_saved': round(self.rejected * app.config['BCRYPT_CHECK_MS'] / 1000, 3)}
+
+
+def create_buckets(backend, path):
+    if backend == 'sqlite':
+        return SQLiteBuckets(path)
+    return MemoryBuckets()
+
+
+# Failed logins, limited per IP address and per account
+login_limiter = RateLimiter(create_buckets(app.config['RATE_LIMIT_BACKEND'], app.config['RATE_LIMIT_DB']),
+                            window=app.config['LOGIN_ATTEMPT_WINDOW'])
+
+
+def account_key(email):
+    return 'login-email:%s' % email.strip().lower()
+
+
+# Buckets a login attempt is counted against
+def login_limits(email, ip):
+    return [('login-ip:%s' % ip, app.config['LOGIN_ATTEMPTS_PER_IP']),
+            (account_key(email), app.config['LOGIN_ATTEMPTS_PER_EMAIL'])]
@@ -2,12 +2,14 @@
 import pyotp
 from flask import Blueprint, render_template, flash, redirect, url_for, session, request
 from flask_login import login_user, current_user, logout_user
-from app import db, required_roles
-from models import User
+from app import db, app, required_roles
+from models import User, key_pool
 from users.forms import RegisterForm, LoginForm, ChangePasswordForm
-from markupsafe import Markup
+from users.rate_limit import login_limiter, login_limits, account_key
 from datetime import datetime
 import logging
+import math
+import time
 
 # CONFIG
 users_blueprint = Blueprint('users', __name__, template_folder='templates')
@@ -19,6 +21,9 @@ users_blueprint = Blueprint('users', __name__, template_folder='templates')
 @users_blueprint.route('/register', methods=['GET', 'POST'])
 @required_roles('anonymous', 'admin')
 def register():
+    # make sure key pairs are being generated before the form is submitted
+    key_pool.start()
+
     # create signup form object
     form = RegisterForm()
 
@@ -59,7 +64,8 @@ def register():
         # Add a log that a user with email ... and ip ... was registered
         logging.warning('SECURITY - User registration [%s, %s]',
                         form.email.data,
-                        request.remote_addr
+                        request.remote_addr,
+                        extra={'event': 'registration', 'email': form.email.data, 'ip': request.remote_addr}
                         )
 
         # Adding the current users email to the session
@@ -103,7 +109,8 @@ def invalid_login(user: str):
     # Add a log that a user with  Email ... (from form) and IP ... has unsuccessfully tried to log in
     logging.warning('SECURITY - Invalid login attempt [%s, %s]',
                     user,
-                    request.remote_addr
+                    request.remote_addr,
+                    extra={'event': 'invalid_login', 'email': user, 'ip': request.remote_addr}
                     )
     pass
 
@@ -112,52 +119,63 @@ def invalid_login(user: str):
 @users_blueprint.route('/login', methods=['GET', 'POST'])
 @required_roles('anonymous')
 def login():
-    # Checking amount of login attempts
-    if not session.get('attempts'):
-        # Login attempts
-        session['attempts'] = 0
-
     # Creating login form
     form = LoginForm()
 
     if form.validate_on_submit():
-        # Make sure they cannot log in if they have already submitted 3 wrong answers
-        if session['attempts'] >= 3:
+        # Failed attempts are counted on the server, per IP address and per account, so clearing the session cookie
+        # doesn't reset them
+        limits = login_limits(form.email.data, request.remote_addr)
+
+        # Take an attempt from the buckets before the database, bcrypt or TOTP see the request, so they can't log in
+        # if they have already used up their attempts, however many requests they send at once
+        retry_after, remaining = login_limiter.acquire(limits)
+        if retry_after:
 
             # Log this attempt, even though we don't let him log in because the user exceeded the max amount we still
             # want make sure that this attempt is logged
             invalid_login(form.email.data)
 
-            flash(Markup('Number of incorrect login attempts exceeded. '
-                         'Please click <a href="/reset">here</a> to reset.'))
+            flash('Number of incorrect login attempts exceeded. '
+                  'Please try again in {} minutes.'.format(math.ceil(retry_after / 60)))
             return render_template('users/login.html', form=form)
 
+        started = time.perf_counter()
         user = User.query.filter_by(email=form.email.data).first()
 
-        # if email or password doesn't exist, we output the same message
+        # if email or password doesn't exist, we output the same message.
+        # The cheap checks run first, so bcrypt only runs for requests with the right postcode and PIN.
         if (not user
                 or not user.verify_postcode(form.postcode.data)
-                or not user.verify_password(form.password.data)
-                or not user.verify_pin(form.pin.data)):
-            session['attempts'] += 1
+                or not user.verify_pin(form.pin.data)
+                or not user.verify_password(form.password.data)):
+
+            # A failure found before bcrypt ran is padded to the time a password check takes, so how long the
+            # response takes doesn't tell whether the account exists or which of the details were wrong
+            time.sleep(max(0.0, app.config['BCRYPT_CHECK_MS'] / 1000 - (time.perf_counter() - started)))
 
             # If the data was input incorrect/doesn't match the database, we log the invalid attempt
             invalid_login(form.email.data)
 
             # Check if login attempts have been exceeded
-            # Same code as above but makes the reset code show earlier instead of 0 attempts remaining
-            if session['attempts'] >= 3:
-                flash(Markup('Number of incorrect login attempts exceeded. '
-                             'Please click <a href="/reset">here</a> to reset.'))
+            # Same message as above but shows straight away instead of 0 attempts remaining
+            if remaining < 1:
+                flash('Number of incorrect login attempts exceeded. '
+                      'Please try again in {} minutes.'.format(math.ceil(login_limiter.retry_after(limits) / 60)))
                 return render_template('users/login.html', form=form)
 
             flash('Please check your login details and try again, '
-                  '{} login attempts remaining'.format(3 - session.get('attempts')))
+                  '{} login attempts remaining'.format(remaining))
             return render_template('users/login.html', form=form)
 
-        # Log in the user and reset our login attempts
+        # Log in the user, give back the attempt and reset the login attempts of the account
         login_user(user)
-        session['attempts'] = 0
+        login_limiter.refund(limits)
+        login_limiter.reset(account_key(form.email.data))
+
+        # Rehash the password if it was hashed with an outdated work factor, while we have it in plain text
+        if user.password_needs_rehash():
+            user.update_password(form.password.data)
 
         # Update our current/last login variables
         current_user.last_login = current_user.current_login
@@ -176,7 +194,11 @@ def login():
         logging.warning('SECURITY - Log in [%s, %s, %s]',
                         current_user.id,
                         current_user.email,
-                        request.remote_addr
+                        request.remote_addr,
+                        extra={'event': 'login',
+                               'user_id': current_user.id,
+                               'email': current_user.email,
+                               'ip': request.remote_addr}
                         )
 
         # Check which page he should be redirected to
@@ -193,7 +215,8 @@ def login():
 @users_blueprint.route('/reset')
 @required_roles('anonymous')
 def reset():
-    session['attempts'] = 0
+    # Login attempts are limited on the server now and can't be reset from the browser
+    session.pop('attempts', None)
     return redirect(url_for('users.login'))
 
 
@@ -203,7 +226,11 @@ def logout():
     # Add a log that a user with Email ... and IP ... has logged out
     logging.warning('SECURITY - Log out [%s, %s]',
                     current_user.email,
-                    request.remote_addr
+                    request.remote_addr,
+                    extra={'event': 'logout',
+                           'user_id': current_user.id,
+                           'email': current_user.email,
+                           'ip': request.remote_addr}
                     )
     logout_user()
 